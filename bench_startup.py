@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Measures how long it takes PKICCU to start up, using Python's -X importtime
+# to report the import time of each module.  Exits with status 1 if the total
+# import time of the entry point is over the threshold, so it can be used to
+# catch changes that make startup slow again (e.g. importing requests or
+# cryptography at the top of main.py instead of in the stage that uses it).
+
+from pathlib import Path
+import argparse
+import subprocess
+import statistics
+import sys
+import os
+
+DEFAULT_MODULE = "pkiccu.main"
+DEFAULT_THRESHOLD_MS = 150
+
+
+class BenchStartup:
+    def __init__(self):
+        self.args = {}
+
+    def parse_args(self) -> dict:
+        parser = argparse.ArgumentParser(prog=Path(sys.argv[0]).name,
+                                         description="Report PKICCU startup import times")
+        parser.add_argument("--module",
+                            default=DEFAULT_MODULE,
+                            help=f"Module to import (defaults to '{DEFAULT_MODULE}')")
+        parser.add_argument("--threshold_ms",
+                            type=float,
+                            default=DEFAULT_THRESHOLD_MS,
+                            help=f"Fail if importing the module takes longer than this many milliseconds (defaults to {DEFAULT_THRESHOLD_MS})")
+        parser.add_argument("--runs",
+                            type=int,
+                            default=5,
+                            help="Number of times to measure, the median is reported (defaults to 5)")
+        parser.add_argument("--top",
+                            type=int,
+                            default=15,
+                            help="Number of slowest modules to list (defaults to 15)")
+        return vars(parser.parse_args())
+
+    # Import the module in a new interpreter and return
+    # {module: (self us, cumulative us)} from -X importtime
+    def measure(self, module: str) -> dict:
+        dict_return = {}
+        env = {**os.environ,
+               "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).parent / "src"),
+                                                           os.environ.get("PYTHONPATH")]))}
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True,
+                                   env=env)
+        if completed.returncode != 0:
+            raise RuntimeError(
+                f"Importing '{module}' failed:\n{completed.stderr}")
+        for line in completed.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                fields = line[len("import time:"):].split("|")
+                try:
+                    name = fields[2].strip()
+                    dict_return[name] = (int(fields[0]), int(fields[1]))
+                except ValueError:
+                    # the header line
+                    pass
+        if module not in dict_return:
+            # e.g. an interpreter older than 3.7 ignores -X importtime
+            raise RuntimeError(
+                f"No import times were reported for '{module}' by {sys.executable}")
+        return dict_return
+
+    def main(self) -> int:
+        exit_status_return: int = 0
+        self.args = self.parse_args()
+        if sys.version_info < (3, 7):
+            print("FAILED: -X importtime needs Python 3.7 or later", file=sys.stderr)
+            return 1
+        module = self.args.get("module")
+        runs = [self.measure(module)
+                for i in range(max(1, self.args.get("runs")))]
+        # use the run with the median total time for the module list
+        totals = [run.get(module, (0, 0))[1] for run in runs]
+        median = statistics.median_low(totals)
+        run = runs[totals.index(median)]
+        print(f"Slowest imports of '{module}' (cumulative ms, self ms):")
+        for name, (self_us, cumulative_us) in sorted(run.items(), key=lambda item: -item[1][1])[:self.args.get("top")]:
+            print(f"  {cumulative_us / 1000:9.1f} {self_us / 1000:9.1f}  {name}")
+        total_ms = median / 1000
+        threshold_ms = self.args.get("threshold_ms")
+        print(
+            f"Import time of '{module}': {total_ms:.1f} ms (median of {len(runs)}), threshold {threshold_ms:.1f} ms")
+        if total_ms > threshold_ms:
+            print(f"FAILED: startup import time is over the threshold")
+            exit_status_return = 1
+        return exit_status_return
+
+
+###
+# Actually call BenchStartup.main()
+###
+if __name__ == '__main__':
+    sys.exit(BenchStartup().main())
@@ -15,3 +15,14 @@
 #
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# stages of a run, in the order they run
+STAGES = ["disa_download", "url_download", "bundles", "scripts"]
+
+
+# pkiccu.run() is the Python API, see api.py.  It's imported when first used
+# so "import pkiccu" stays cheap.
+def run(*args, **kwargs) -> dict:
+    from pkiccu import api
+    return api.run(*args, **kwargs)
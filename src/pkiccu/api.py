@@ -0,0 +1,80 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Python API for running PKICCU in-process, e.g. from a long running service,
+# instead of running the pkiccu program and reading its log.
+#
+#   import pkiccu
+#   result = pkiccu.run("pkiccu.cfg", stages=["disa_download", "bundles"])
+#   if not result["ok"]:
+#       for stage in result["stages"]:
+#           print(stage["stage"], stage["errors"])
+#
+# See run() below for the result.
+
+from pathlib import Path
+from pkiccu.main import Main
+from pkiccu.config_utils import ConfigUtils
+from datetime import datetime
+import copy
+import time
+
+STAGES = Main.STAGES
+
+
+# Run PKICCU.  config is the name of a config file or a config dict (as read
+# from the YAML config file, variables are replaced in a copy of it).  stages
+# is a list of the stages to run (see STAGES), all of them if None.  Stages
+# still have to be enabled in the config.  options are the same as the
+# command line options, e.g. nodisacrls=True.
+#
+# Returns a dict:
+#   ok        true if every stage ran without errors
+#   started   ISO time the run started
+#   duration  seconds the run took
+#   error     message of an error that stopped the run, or None
+#   stages    a list of dicts for the stages that ran, see StageRecorder
+def run(config, stages: list = None, noprogress: bool = True, **options) -> dict:
+    if stages is not None:
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(
+                f"Unknown stage(s) {unknown}, must be some of {STAGES}")
+    result_return = {"ok": False,
+                     "started": datetime.now().isoformat(),
+                     "duration": 0.0,
+                     "error": None,
+                     "stages": []}
+    time_start = time.monotonic()
+    main = Main()
+    main.args = {**options, "noprogress": noprogress}
+    if isinstance(config, dict):
+        main.config = ConfigUtils.prepare(copy.deepcopy(config))
+    else:
+        main.args["config"] = str(Path(config))
+    try:
+        main.init()
+        result_return["ok"] = main.run(stages)
+    except Exception as e:
+        # KeyboardInterrupt and SystemExit are passed on to the caller
+        result_return["error"] = str(e)
+    finally:
+        main.close()
+        result_return["stages"] = main.stage_results
+        result_return["duration"] = time.monotonic() - time_start
+    return result_return
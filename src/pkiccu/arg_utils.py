@@ -64,6 +64,98 @@ class ArgUtils:
         parser.add_argument("--noprogress",
                             action="store_true",
                             help="Do not show progress bars (defaults to auto mode)")
+        parser.add_argument("--profile",
+                            action="store_true",
+                            help="Profile each stage with cProfile.  Writes a .pstats file and a summary of the hottest functions per stage to the log directory.")
+        parser.add_argument("--profile_memory",
+                            action="store_true",
+                            help="With --profile, also trace memory allocations with tracemalloc and report the peak of each stage and the sites holding the most memory at its end (slows the run down).")
+        parser.add_argument("--profile_top",
+                            type=int,
+                            default=25,
+                            help="Number of functions and allocation sites in the profile summaries (defaults to 25).")
+        subparsers = parser.add_subparsers(dest="command",
+                                           metavar="command",
+                                           help="Optional command.  Without one, PKICCU runs its update steps.")
+
+        query_parser = subparsers.add_parser("query",
+                                             help="Query the catalog of managed certs and CRLs")
+        query_parser.add_argument("-c", "--config",
+                                  default=argparse.SUPPRESS,
+                                  help="Config file location (defaults to './pkiccu.cfg').")
+        query_parser.add_argument("--expiring",
+                                  type=float,
+                                  metavar="DAYS",
+                                  help="List certs that expire within DAYS days")
+        query_parser.add_argument("--stale-crls",
+                                  dest="stale_crls",
+                                  type=float,
+                                  nargs="?",
+                                  const=0,
+                                  metavar="DAYS",
+                                  help="List CRLs whose nextUpdate is past or within DAYS days (defaults to 0)")
+        query_parser.add_argument("--ca",
+                                  metavar="NAME",
+                                  help="List certs and CRLs of CAs whose name contains NAME")
+        query_parser.add_argument("--changed",
+                                  action="store_true",
+                                  help="List files that changed in the last run")
+        query_parser.add_argument("--sql",
+                                  help="Run an SQL query against the catalog")
+
+        serve_parser = subparsers.add_parser("serve",
+                                             help="Publish the managed data over HTTP for other PKICCU nodes to sync from")
+        serve_parser.add_argument("-c", "--config",
+                                  default=argparse.SUPPRESS,
+                                  help="Config file location (defaults to './pkiccu.cfg').")
+        serve_parser.add_argument("--root",
+                                  help="Directory to publish (defaults to mirror.root in the config)")
+        serve_parser.add_argument("--bind",
+                                  help="Address to listen on (defaults to mirror.bind in the config, or all addresses)")
+        serve_parser.add_argument("--port",
+                                  type=int,
+                                  help="Port to listen on (defaults to mirror.port in the config, or 8080)")
+
+        sync_parser = subparsers.add_parser("sync",
+                                            help="Sync the data from another PKICCU node's Merkle manifest, only copying what changed")
+        sync_parser.add_argument("-c", "--config",
+                                 default=argparse.SUPPRESS,
+                                 help="Config file location (defaults to './pkiccu.cfg').")
+        sync_parser.add_argument("--from",
+                                 required=True,
+                                 help="URL of a 'pkiccu serve' mirror, or a directory, with a Merkle manifest")
+        sync_parser.add_argument("--to",
+                                 help="Directory to sync into (defaults to merkle.root in the config)")
+        sync_parser.add_argument("--delete",
+                                 action="store_true",
+                                 help="Remove files that aren't in the source")
+
+        snapshot_parser = subparsers.add_parser("snapshot",
+                                                help="Export or import a snapshot of the data for hosts that can't download it")
+        snapshot_subparsers = snapshot_parser.add_subparsers(dest="snapshot_command",
+                                                             metavar="snapshot_command")
+        snapshot_subparsers.required = True
+        export_parser = snapshot_subparsers.add_parser("export",
+                                                       help="Write the data directories to a compressed snapshot file")
+        export_parser.add_argument("-c", "--config",
+                                   default=argparse.SUPPRESS,
+                                   help="Config file location (defaults to './pkiccu.cfg').")
+        export_parser.add_argument("-o", "--output",
+                                   required=True,
+                                   help="Snapshot file to write (.tar.xz, .tar.gz, .tar.bz2 or .tar)")
+        export_parser.add_argument("--base",
+                                   help="Write a delta snapshot with only the changes since this snapshot")
+        import_parser = snapshot_subparsers.add_parser("import",
+                                                       help="Check a snapshot file and apply it to the data directories")
+        import_parser.add_argument("-c", "--config",
+                                   default=argparse.SUPPRESS,
+                                   help="Config file location (defaults to './pkiccu.cfg').")
+        import_parser.add_argument("file",
+                                   help="Snapshot file to import")
+
+        # no command means do the normal update run
+        parser.set_defaults(command="run")
+
         _args = parser.parse_args()
         if _args:
             args_return = vars(_args)
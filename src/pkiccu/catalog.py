@@ -0,0 +1,283 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from pkiccu.file_manifest import FileManifest
+from datetime import datetime, timedelta
+import sqlite3
+import os
+import logging
+
+
+class Catalog:
+    """
+    A SQLite catalog of the cert, CRL and bundle files PKICCU manages.  Each
+    download, extraction and bundle step records the files it touched, so
+    questions like "what expires soon" or "which CRLs are stale" can be
+    answered without walking the data directories and parsing every file.
+    A file is only re-hashed if its size or mtime changed, and only re-parsed
+    if its digest changed.
+    """
+
+    KIND_CERT = "cert"
+    KIND_CRL = "crl"
+    KIND_BUNDLE = "bundle"
+    KIND_OTHER = "other"
+
+    CERT_EXTS = [".cer", ".crt", ".der"]
+    CRL_EXTS = [".crl"]
+
+    # all times are stored as UTC text in this format so they sort properly
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            kind TEXT,
+            category TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            sha256 TEXT,
+            subject TEXT,
+            issuer TEXT,
+            ski TEXT,
+            aki TEXT,
+            serial TEXT,
+            not_before TEXT,
+            not_after TEXT,
+            this_update TEXT,
+            next_update TEXT,
+            crl_entries INTEGER,
+            source_url TEXT,
+            first_seen TEXT,
+            last_changed TEXT,
+            last_changed_run INTEGER,
+            last_seen TEXT)""",
+        "CREATE INDEX IF NOT EXISTS files_kind ON files (kind)",
+        "CREATE INDEX IF NOT EXISTS files_ski ON files (ski)",
+        "CREATE INDEX IF NOT EXISTS files_subject ON files (subject)",
+        "CREATE INDEX IF NOT EXISTS files_not_after ON files (not_after)",
+        "CREATE INDEX IF NOT EXISTS files_next_update ON files (next_update)",
+        """CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started TEXT,
+            finished TEXT)"""
+    ]
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        Path(fn).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(fn)
+        self.db.row_factory = sqlite3.Row
+        for sql in Catalog.SCHEMA:
+            self.db.execute(sql)
+        self.db.commit()
+        self.run_id = None
+
+    def close(self):
+        if self.db:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def format_time(dt: datetime) -> str:
+        return dt.strftime(Catalog.DATE_FORMAT) if dt else None
+
+    def now() -> str:
+        return Catalog.format_time(datetime.utcnow())
+
+    # start recording a run.  Files that change are tagged with the run.
+    def begin_run(self):
+        cursor = self.db.execute(
+            "INSERT INTO runs (started) VALUES (?)", (Catalog.now(),))
+        self.run_id = cursor.lastrowid
+        self.db.commit()
+
+    def end_run(self):
+        if self.run_id:
+            self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                            (Catalog.now(), self.run_id))
+            self.db.commit()
+
+    def get_kind(path: Path) -> str:
+        kind_return = Catalog.KIND_OTHER
+        ext = path.suffix.lower()
+        if ext in Catalog.CERT_EXTS:
+            kind_return = Catalog.KIND_CERT
+        elif ext in Catalog.CRL_EXTS:
+            kind_return = Catalog.KIND_CRL
+        return kind_return
+
+    # escape the LIKE wildcards in a string so it only matches itself
+    def escape_like(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    # the category of a file in the DisaDownloader layout,
+    # <data_dir>/<category>/certs|crls/<file>
+    def get_category(path: Path) -> str:
+        category_return = None
+        if path.parent.name in ("certs", "crls"):
+            category_return = path.parent.parent.name
+        return category_return
+
+    # read the catalog fields of a cert or CRL file.  X509Utils (and
+    # cryptography) is imported here so opening the catalog stays cheap.
+    def parse_file(fn: str, kind: str) -> dict:
+        from pkiccu.x509_utils import X509Utils
+        dict_return = {}
+        if kind == Catalog.KIND_CERT:
+            cert = X509Utils.load_cert_der(fn)
+            if cert:
+                dict_return = {
+                    "subject": X509Utils.cert_get_subject(cert),
+                    "issuer": X509Utils.cert_get_issuer(cert),
+                    "ski": X509Utils.cert_get_ski(cert),
+                    "aki": X509Utils.get_aki(cert),
+                    "serial": X509Utils.cert_get_serial(cert),
+                    "not_before": Catalog.format_time(X509Utils.cert_get_valid_from(cert)),
+                    "not_after": Catalog.format_time(X509Utils.cert_get_valid_to(cert))
+                }
+        elif kind == Catalog.KIND_CRL:
+            crl = X509Utils.load_crl_der(fn)
+            if crl:
+                dict_return = {
+                    "issuer": X509Utils.crl_get_issuer(crl),
+                    "aki": X509Utils.get_aki(crl),
+                    "this_update": Catalog.format_time(X509Utils.crl_get_this_update(crl)),
+                    "next_update": Catalog.format_time(X509Utils.crl_get_next_update(crl)),
+                    "crl_entries": len(crl)
+                }
+        return dict_return
+
+    # Record a file that a step downloaded, extracted or wrote.  Returns True
+    # if the file is new or its content changed.
+    def update_file(self, fn: str, kind: str = None, category: str = None, source_url: str = None, commit: bool = True) -> bool:
+        bool_return = False
+        path = Path(fn).resolve()
+        if not path.is_file():
+            self.remove_file(str(path), commit=commit)
+            return bool_return
+        if not kind:
+            kind = Catalog.get_kind(path)
+        if not category:
+            category = Catalog.get_category(path)
+        stat = path.stat()
+        now = Catalog.now()
+        row = self.db.execute(
+            "SELECT * FROM files WHERE path = ?", (str(path),)).fetchone()
+        if row and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+            self.db.execute("UPDATE files SET last_seen = ?, source_url = COALESCE(?, source_url) WHERE path = ?",
+                            (now, source_url, str(path)))
+        else:
+            digest = FileManifest.hash_file(str(path))
+            if row and row["sha256"] == digest:
+                self.db.execute("UPDATE files SET size = ?, mtime_ns = ?, last_seen = ?, source_url = COALESCE(?, source_url) WHERE path = ?",
+                                (stat.st_size, stat.st_mtime_ns, now, source_url, str(path)))
+            else:
+                fields = {"kind": kind,
+                          "category": category,
+                          "size": stat.st_size,
+                          "mtime_ns": stat.st_mtime_ns,
+                          "sha256": digest,
+                          "subject": None, "issuer": None, "ski": None, "aki": None, "serial": None,
+                          "not_before": None, "not_after": None, "this_update": None, "next_update": None,
+                          "crl_entries": None,
+                          "last_changed": now,
+                          "last_changed_run": self.run_id,
+                          "last_seen": now}
+                try:
+                    fields.update(Catalog.parse_file(str(path), kind))
+                except BaseException as e:
+                    logging.debug(
+                        f"Catalog could not parse '{str(path)}': {str(e)}")
+                if row:
+                    self.db.execute(f"UPDATE files SET {', '.join(name + ' = ?' for name in fields.keys())}, source_url = COALESCE(?, source_url) WHERE path = ?",
+                                    (*fields.values(), source_url, str(path)))
+                else:
+                    fields["path"] = str(path)
+                    fields["source_url"] = source_url
+                    fields["first_seen"] = now
+                    self.db.execute(f"INSERT INTO files ({', '.join(fields.keys())}) VALUES ({', '.join('?' * len(fields))})",
+                                    tuple(fields.values()))
+                bool_return = True
+        if commit:
+            self.db.commit()
+        return bool_return
+
+    def remove_file(self, fn: str, commit: bool = True):
+        self.db.execute("DELETE FROM files WHERE path = ?",
+                        (str(Path(fn).resolve()),))
+        if commit:
+            self.db.commit()
+
+    # Bring a whole directory tree up to date, e.g. to pick up root certs that
+    # were copied in by hand.  Files under the dir that no longer exist are
+    # dropped.  Returns the number of new or changed files.
+    def scan_dir(self, dn: str, patterns: list = None) -> int:
+        int_return = 0
+        path_dir = Path(dn).resolve()
+        if path_dir.is_dir():
+            if not patterns:
+                patterns = [f"*{ext}" for ext in Catalog.CERT_EXTS + Catalog.CRL_EXTS]
+            seen = set()
+            for pattern in patterns:
+                for path in path_dir.rglob(pattern):
+                    if path.is_file() and str(path) not in seen:
+                        seen.add(str(path))
+                        if self.update_file(str(path), commit=False):
+                            int_return += 1
+            prefix = Catalog.escape_like(
+                str(path_dir).rstrip("/\\") + os.sep) + "%"
+            for row in self.db.execute("SELECT path FROM files WHERE path LIKE ? ESCAPE '\\'", (prefix,)).fetchall():
+                if row["path"] not in seen and not Path(row["path"]).exists():
+                    self.remove_file(row["path"], commit=False)
+            self.db.commit()
+        return int_return
+
+    ###
+    # Queries.  Each returns a list of sqlite3.Row
+    ###
+
+    def query_expiring(self, days: float) -> list:
+        limit = Catalog.format_time(datetime.utcnow() + timedelta(days=days))
+        return self.db.execute("SELECT * FROM files WHERE kind = ? AND not_after <= ? ORDER BY not_after",
+                               (Catalog.KIND_CERT, limit)).fetchall()
+
+    def query_stale_crls(self, days: float = 0) -> list:
+        limit = Catalog.format_time(datetime.utcnow() + timedelta(days=days))
+        return self.db.execute("SELECT * FROM files WHERE kind = ? AND (next_update IS NULL OR next_update <= ?) ORDER BY next_update",
+                               (Catalog.KIND_CRL, limit)).fetchall()
+
+    def query_ca(self, name: str) -> list:
+        like = f"%{name}%"
+        return self.db.execute("SELECT * FROM files WHERE subject LIKE ? OR (kind = ? AND issuer LIKE ?) ORDER BY kind, path",
+                               (like, Catalog.KIND_CRL, like)).fetchall()
+
+    # files that changed in the last completed run
+    def query_changed(self) -> list:
+        rows = []
+        run = self.db.execute(
+            "SELECT id FROM runs WHERE finished IS NOT NULL ORDER BY id DESC LIMIT 1").fetchone()
+        if run:
+            rows = self.db.execute("SELECT * FROM files WHERE last_changed_run = ? ORDER BY kind, path",
+                                   (run["id"],)).fetchall()
+        return rows
+
+    def query_sql(self, sql: str) -> list:
+        return self.db.execute(sql).fetchall()
@@ -20,12 +20,29 @@
 from pathlib import Path
 from pkiccu.file_utils import FileUtils
 from pkiccu.x509_utils import X509Utils
+from pkiccu.cert_cache import CertCache
+from pkiccu.file_manifest import FileManifest
+from pkiccu.dir_index import DirIndex
+from pkiccu.metrics import Metrics
+from datetime import datetime, timedelta
 import sys
+import os
+import re
+import logging
 
 
 class CertBundler:
+    TYPE_CERT = "cert"
+    TYPE_CRL = "crl"
 
-    def create_bundle_list(src_list: list, match: str = r"*.cer", recursive: bool = False, sort_within_dirs: bool = True, sort_all: bool = False) -> list:
+    FORMAT_FILE = "file"
+    FORMAT_HASHED_DIR = "hashed_dir"
+
+    # c_rehash style names: <hash>.N for certs and <hash>.rN for CRLs
+    HASHED_NAME_RE = {TYPE_CERT: re.compile(r"^[0-9a-f]{8}\.[0-9]+$"),
+                      TYPE_CRL: re.compile(r"^[0-9a-f]{8}\.r[0-9]+$")}
+
+    def create_bundle_list(src_list: list, match: str = r"*.cer", recursive: bool = False, sort_within_dirs: bool = True, sort_all: bool = False, dir_index: DirIndex = None) -> list:
         list_return = []
         if src_list:
             for src in src_list:
@@ -35,7 +52,7 @@ class CertBundler:
                         if path_src.exists():
                             if path_src.is_dir():
                                 list_dir = FileUtils.get_matching_files(
-                                    path_src, match, recursive=recursive)
+                                    path_src, match, recursive=recursive, dir_index=dir_index)
                                 if sort_within_dirs:
                                     list_dir = sorted(list_dir)
                                 list_return = list_return + list_dir
@@ -45,20 +62,317 @@ class CertBundler:
                     print(str(e), file=sys.stderr)
         return list_return if not sort_all else sorted(list_return)
 
-    def write_bundle_from_list(fn_bundle: str, fn_list: list):
+    # Remove duplicate certs (same fingerprint from different files or
+    # sources) and/or expired certs from a bundle list.  dedupe can be
+    # "sha256" (or true).  drop_expired can be true (or 0) to drop every
+    # expired cert or a number of days of grace past the cert's expiration
+    # date.
+    def filter_bundle_list(fn_list: list, cert_cache: CertCache, dedupe: any = None, drop_expired: any = False, bundle_name: str = None) -> list:
+        list_return = []
+        if dedupe not in (None, False, True, "sha256"):
+            raise RuntimeError(
+                f"Unsupported bundle dedupe option '{dedupe}'")
+        expire_before = None
+        if drop_expired is True:
+            expire_before = datetime.utcnow()
+        elif drop_expired is not None and drop_expired is not False:
+            expire_before = datetime.utcnow() - timedelta(days=float(drop_expired))
+        label = bundle_name if bundle_name else "bundle"
+        seen = {}
+        dropped_dupes = 0
+        dropped_expired = 0
+        for fn in (fn_list or []):
+            try:
+                entry = cert_cache.get(fn)
+            except BaseException:
+                # leave it for write_bundle_from_list() to report
+                entry = None
+            if entry:
+                if expire_before and entry.get("valid_to") < expire_before:
+                    logging.debug(
+                        f"Dropping expired cert from {label} (expired {entry.get('valid_to')}): {fn}")
+                    dropped_expired += 1
+                    continue
+                if dedupe:
+                    fingerprint = entry.get("sha256")
+                    if fingerprint in seen:
+                        logging.debug(
+                            f"Dropping duplicate cert from {label}: {fn} (same as {seen.get(fingerprint)})")
+                        dropped_dupes += 1
+                        continue
+                    seen[fingerprint] = fn
+            list_return.append(fn)
+        if dropped_dupes or dropped_expired:
+            logging.info(
+                f"Dropped {dropped_dupes} duplicate and {dropped_expired} expired cert(s) from {label}, {len(list_return)} remaining")
+        return list_return
+
+    def write_bundle_from_list(fn_bundle: str, fn_list: list, cert_cache: CertCache = None):
         if fn_bundle and fn_list:
-            with open(fn_bundle, "w") as file_bundle:
+            # a cache shared between bundles is better, but make a private one
+            # if the caller didn't supply it.
+            if cert_cache is None:
+                cert_cache = CertCache()
+            with FileUtils.open_atomic(fn_bundle, "w") as file_bundle:
                 for fn in fn_list:
                     try:
-                        pem_str = X509Utils.read_der_cert_pem(fn)
+                        pem_str = cert_cache.get_pem(fn)
                         if pem_str:
                             file_bundle.write(pem_str)
                     except BaseException as e:
                         print(str(e), file=sys.stderr)
 
-    def write_bundle(fn_bundle: str, src_list: list, match: str = r"*.cer", recursive: bool = False, sort_within_dirs: bool = True, sort_all: bool = False):
+    # Writes a PEM CRL bundle (e.g. for Apache's SSLCARevocationFile).  CRLs
+    # are streamed from DER to PEM without being parsed.  CRLs whose digest
+    # is in reuse_segments, a dict of digest => (offset, length) of their PEM
+    # in the file reuse_fn, are copied from that file instead of being
+    # encoded again.  Returns a list of (offset, length) of each CRL's PEM in
+    # the new bundle.
+    def write_crl_bundle_from_list(fn_bundle: str, fn_list: list, digests: list, reuse_fn: str = None, reuse_segments: dict = None) -> list:
+        list_return = []
+        if fn_bundle and fn_list:
+            reuse_segments = reuse_segments if reuse_fn and reuse_segments else {}
+            file_reuse = open(reuse_fn, "rb") if reuse_segments else None
+            try:
+                with FileUtils.open_atomic(fn_bundle, "wb") as file_bundle:
+                    for fn, digest in zip(fn_list, digests):
+                        start = file_bundle.tell()
+                        try:
+                            segment = reuse_segments.get(digest)
+                            if segment:
+                                file_reuse.seek(segment[0])
+                                remaining = segment[1]
+                                while remaining > 0:
+                                    chunk = file_reuse.read(
+                                        min(remaining, FileManifest.HASH_BLOCK_SIZE))
+                                    if not chunk:
+                                        raise RuntimeError(
+                                            f"Previous bundle '{reuse_fn}' is shorter than its manifest says")
+                                    file_bundle.write(chunk)
+                                    remaining -= len(chunk)
+                            else:
+                                with open(fn, "rb") as file_crl:
+                                    X509Utils.write_der_pem_stream(
+                                        file_crl, file_bundle, "X509 CRL")
+                        except BaseException as e:
+                            # don't leave half a CRL in the bundle
+                            file_bundle.seek(start)
+                            file_bundle.truncate()
+                            print(str(e), file=sys.stderr)
+                        list_return.append(
+                            [start, file_bundle.tell() - start])
+            finally:
+                if file_reuse:
+                    file_reuse.close()
+        return list_return
+
+    # The manifest of a bundle's inputs lives in a hidden file next to it
+    def get_manifest_filename(fn_bundle: str) -> str:
+        path_bundle = Path(fn_bundle)
+        return str(path_bundle.parent / f".{path_bundle.name}.manifest")
+
+    # Writes the bundle file unless its inputs are the same as the last time it
+    # was written.  Returns True if the bundle file was (re)written.
+    def write_bundle_file(fn_bundle: str, bundle_list: list, cert_cache: CertCache = None, force: bool = False, bundle_type: str = TYPE_CERT) -> bool:
+        bool_return = False
+        if fn_bundle and bundle_list:
+            manifest = FileManifest(
+                CertBundler.get_manifest_filename(fn_bundle))
+            manifest.load()
+            inputs = [[fn, manifest.get_digest(fn)] for fn in bundle_list]
+            manifest.prune(bundle_list)
+            path_bundle = Path(fn_bundle)
+            unchanged = (not force
+                         and path_bundle.exists()
+                         and manifest.data.get("inputs") == inputs
+                         and manifest.data.get("bundle") == CertBundler.__stat_file(path_bundle))
+            if unchanged:
+                logging.info(
+                    f"Bundle '{path_bundle.name}' is up to date ({len(inputs)} {bundle_type}s)")
+            elif bundle_type == CertBundler.TYPE_CRL:
+                # PEM of CRLs that didn't change can be copied from the old
+                # bundle if it is still the one the manifest describes
+                reuse_segments = {}
+                if (not force and path_bundle.exists()
+                        and manifest.data.get("bundle") == CertBundler.__stat_file(path_bundle)):
+                    for prev_input, segment in zip(manifest.data.get("inputs", []), manifest.data.get("segments", [])):
+                        if segment[1] > 0:
+                            reuse_segments[prev_input[1]] = segment
+                segments = CertBundler.write_crl_bundle_from_list(
+                    fn_bundle, bundle_list, [digest for fn, digest in inputs],
+                    reuse_fn=fn_bundle, reuse_segments=reuse_segments)
+                num_reused = sum(
+                    1 for fn, digest in inputs if digest in reuse_segments)
+                logging.info(
+                    f"Bundle '{path_bundle.name}': {len(inputs)} CRLs, {num_reused} reused from previous bundle")
+                manifest.data = {"inputs": inputs,
+                                 "segments": segments,
+                                 "bundle": CertBundler.__stat_file(path_bundle)}
+                manifest.save()
+                bool_return = True
+            else:
+                CertBundler.write_bundle_from_list(
+                    fn_bundle, bundle_list, cert_cache=cert_cache)
+                manifest.data = {"inputs": inputs,
+                                 "bundle": CertBundler.__stat_file(path_bundle)}
+                manifest.save()
+                bool_return = True
+        return bool_return
+
+    # Maintains an OpenSSL hashed directory (as made by c_rehash) for use with
+    # e.g. Apache's SSLCACertificatePath or SSLCARevocationPath.  Certs are
+    # written as <subject hash>.N and CRLs as <issuer hash>.rN.  Only entries
+    # whose content changed are rewritten and entries of the same type that
+    # are no longer wanted are removed.  A cert and a CRL hashed dir bundle can
+    # share a directory.  Returns whether anything in the directory changed
+    # and the number of entries (files with the same content are one entry).
+    def write_hashed_dir(dn_bundle: str, fn_list: list, bundle_type: str = TYPE_CERT, cert_cache: CertCache = None, force: bool = False) -> tuple:
+        bool_return = False
+        num_entries = 0
+        if dn_bundle:
+            if cert_cache is None:
+                cert_cache = CertCache()
+            path_dir = Path(dn_bundle)
+            path_dir.mkdir(parents=True, exist_ok=True)
+            is_crl = bundle_type == CertBundler.TYPE_CRL
+            manifest = FileManifest(
+                str(path_dir / f".pkiccu_{bundle_type}.manifest"))
+            manifest.load()
+            # digest => name hash, so unchanged files needn't be parsed
+            name_hashes = manifest.data.get("name_hashes", {})
+            new_name_hashes = {}
+            groups = {}
+            for fn in (fn_list or []):
+                try:
+                    digest = manifest.get_digest(fn)
+                    name_hash = name_hashes.get(digest)
+                    if not name_hash:
+                        if is_crl:
+                            name_hash = X509Utils.read_crl_issuer_hash(fn)
+                        else:
+                            entry = cert_cache.get(fn)
+                            if not entry:
+                                raise RuntimeError(
+                                    f"Could not parse cert file '{fn}'")
+                            name_hash = entry.get("subject_hash")
+                    new_name_hashes[digest] = name_hash
+                    # files with identical content collapse into one entry
+                    groups.setdefault(name_hash, {})[digest] = fn
+                except BaseException as e:
+                    print(str(e), file=sys.stderr)
+            written = manifest.data.get("entries", {})
+            # Members that were written before keep their suffixes and new ones
+            # get the free ones, so adding or removing a cert whose hash
+            # collides with others doesn't rename (and rewrite) them.  OpenSSL
+            # stops looking at the first missing suffix, so when a member is
+            # removed the highest numbered one moves into its place.
+            entries = {}
+            for name_hash, members in groups.items():
+                prefix = f"{name_hash}.{'r' if is_crl else ''}"
+                kept = {}
+                for out_name, prev in written.items():
+                    suffix = out_name[len(prefix):]
+                    if out_name.startswith(prefix) and suffix.isdigit() and prev.get("sha256") in members:
+                        kept.setdefault(prev.get("sha256"), int(suffix))
+                slots = [None] * len(members)
+                moved = []
+                for digest in sorted(members.keys()):
+                    i = kept.get(digest)
+                    if i is not None and i < len(slots) and slots[i] is None:
+                        slots[i] = digest
+                    else:
+                        moved.append(digest)
+                # kept members past the end first, then new ones
+                moved.sort(key=lambda digest: (
+                    kept.get(digest) is None, kept.get(digest) or 0, digest))
+                for i, digest in enumerate(slots):
+                    if digest is None:
+                        slots[i] = moved.pop(0)
+                for i, digest in enumerate(slots):
+                    entries[f"{prefix}{i}"] = (digest, members.get(digest))
+            new_written = {}
+            num_written = 0
+            num_removed = 0
+            for out_name in sorted(entries.keys()):
+                digest, fn = entries.get(out_name)
+                path_out = path_dir / out_name
+                prev = written.get(out_name)
+                if (not force and prev and prev.get("sha256") == digest and path_out.exists()
+                        and {"size": prev.get("size"), "mtime_ns": prev.get("mtime_ns")} == CertBundler.__stat_file(path_out)):
+                    new_written[out_name] = prev
+                    continue
+                try:
+                    if is_crl:
+                        with FileUtils.open_atomic(str(path_out), "wb") as file_out, open(fn, "rb") as file_in:
+                            X509Utils.write_der_pem_stream(
+                                file_in, file_out, "X509 CRL")
+                    else:
+                        with FileUtils.open_atomic(str(path_out), "w") as file_out:
+                            file_out.write(cert_cache.get_pem(fn))
+                    new_written[out_name] = {"sha256": digest,
+                                             **CertBundler.__stat_file(path_out)}
+                    num_written += 1
+                except BaseException as e:
+                    print(str(e), file=sys.stderr)
+            for path in path_dir.iterdir():
+                if CertBundler.HASHED_NAME_RE.get(bundle_type).match(path.name) and path.name not in entries:
+                    logging.debug(f"Removing hashed dir entry {str(path)}")
+                    os.remove(path)
+                    num_removed += 1
+            manifest.prune(fn_list or [])
+            manifest.data = {"name_hashes": new_name_hashes,
+                             "entries": new_written}
+            manifest.save()
+            bool_return = num_written > 0 or num_removed > 0
+            num_entries = len(entries)
+            logging.info(
+                f"Hashed dir '{path_dir.name}': {num_entries} {bundle_type} entries, {num_written} written, {num_removed} removed")
+        return (bool_return, num_entries)
+
+    # Writes the bundle unless its inputs are the same as the last time it was
+    # written.  Returns True if the bundle was (re)written.
+    def write_bundle(fn_bundle: str, src_list: list, match: str = r"*.cer", recursive: bool = False, sort_within_dirs: bool = True, sort_all: bool = False, cert_cache: CertCache = None, dedupe: any = None, drop_expired: any = False, force: bool = False, bundle_type: str = TYPE_CERT, bundle_format: str = FORMAT_FILE, dir_index: DirIndex = None) -> bool:
+        bool_return = False
+        if bundle_type not in (CertBundler.TYPE_CERT, CertBundler.TYPE_CRL):
+            raise RuntimeError(f"Unknown bundle type '{bundle_type}'")
+        if bundle_format not in (CertBundler.FORMAT_FILE, CertBundler.FORMAT_HASHED_DIR):
+            raise RuntimeError(f"Unknown bundle format '{bundle_format}'")
         if fn_bundle and src_list:
+            if cert_cache is None:
+                cert_cache = CertCache()
             bundle_list = CertBundler.create_bundle_list(
-                src_list=src_list, match=match, recursive=recursive, sort_within_dirs=sort_within_dirs, sort_all=sort_all)
-            if bundle_list:
-                CertBundler.write_bundle_from_list(fn_bundle, bundle_list)
+                src_list=src_list, match=match, recursive=recursive, sort_within_dirs=sort_within_dirs, sort_all=sort_all, dir_index=dir_index)
+            # a hashed dir collapses files with the same content, so it
+            # reports its own count, None if it wasn't written
+            num_entries = len(bundle_list) if bundle_format == CertBundler.FORMAT_FILE else None
+            # drop_expired can be 0 (no grace), which is falsy
+            if bundle_type == CertBundler.TYPE_CERT and (dedupe or (drop_expired is not None and drop_expired is not False)):
+                bundle_list = CertBundler.filter_bundle_list(
+                    bundle_list, cert_cache, dedupe=dedupe, drop_expired=drop_expired, bundle_name=Path(fn_bundle).name)
+            if bundle_format == CertBundler.FORMAT_HASHED_DIR:
+                # like a bundle file, keep what's there if the sources came
+                # up empty (a missing dir, everything quarantined, ...)
+                # unless forced, so a transient failure doesn't empty it
+                if bundle_list or force:
+                    bool_return, num_entries = CertBundler.write_hashed_dir(
+                        fn_bundle, bundle_list, bundle_type=bundle_type, cert_cache=cert_cache, force=force)
+                else:
+                    logging.warning(
+                        f"No {bundle_type} files for hashed dir '{fn_bundle}', keeping its entries")
+            elif bundle_list:
+                bool_return = CertBundler.write_bundle_file(
+                    fn_bundle, bundle_list, cert_cache=cert_cache, force=force, bundle_type=bundle_type)
+            bundle_name = Path(fn_bundle).name
+            if num_entries is not None:
+                Metrics.set("pkiccu_bundle_entries",
+                            num_entries, bundle=bundle_name, type=bundle_type)
+            Metrics.set("pkiccu_bundle_changed",
+                        1 if bool_return else 0, bundle=bundle_name, type=bundle_type)
+            if bundle_format == CertBundler.FORMAT_FILE and Path(fn_bundle).is_file():
+                Metrics.set("pkiccu_bundle_bytes", Path(fn_bundle).stat().st_size,
+                            bundle=bundle_name, type=bundle_type)
+        return bool_return
+
+    def __stat_file(path: Path) -> dict:
+        stat = path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
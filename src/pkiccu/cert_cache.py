@@ -0,0 +1,144 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from pkiccu.x509_utils import X509Utils
+from pkiccu.file_manifest import FileManifest
+from pkiccu.file_utils import FileUtils
+from datetime import datetime
+import hashlib
+import logging
+import os
+
+
+class CertCache:
+    """
+    A per-run cache of certificates for making bundles.  Entries are keyed by
+    (path, size, mtime_ns) so a file that is rewritten during the run is read
+    again.  One CertCache is shared by all the bundles made in a run so that a
+    cert that appears in several bundles is only read once.
+
+    The PEM text is made straight from the DER bytes (see
+    X509Utils.convert_der_pem()) so certs are never parsed just to be
+    re-encoded.  Certs are only parsed for their header info (subject, issuer,
+    validity, subject hash).  If a cache file is given, the header info is
+    saved in it by SHA-256 digest, so a cert is only parsed the first time it
+    is seen, not on every run.  A new cert is read once, and its digest,
+    header info and PEM all come from those bytes.
+    """
+
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, fn: str = None):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.parsed = 0
+        self.manifest = FileManifest(fn)
+        self.manifest.load()
+        self.infos = self.manifest.data.get("infos", {})
+
+    def get_key(self, fn: str) -> tuple:
+        path = Path(fn).resolve()
+        stat = path.stat()
+        return (str(path), stat.st_size, stat.st_mtime_ns)
+
+    # header info of a cert from its DER bytes
+    def parse_info(self, data: bytes) -> dict:
+        info_return = None
+        cert = X509Utils.load_cert_der_data(data)
+        if cert:
+            self.parsed += 1
+            info_return = {
+                "info": X509Utils.convert_cert_info(cert),
+                "subject": X509Utils.cert_get_subject(cert),
+                "issuer": X509Utils.cert_get_issuer(cert),
+                "valid_from": str(X509Utils.cert_get_valid_from(cert)),
+                "valid_to": str(X509Utils.cert_get_valid_to(cert)),
+                "subject_hash": X509Utils.cert_get_subject_hash(cert)
+            }
+        return info_return
+
+    # Make the entry for a cert file.  If the file's digest and header info
+    # are cached it isn't read until its PEM is needed.  Otherwise it's read
+    # once and the digest, header info and PEM all come from those bytes.
+    def load_entry(self, fn: str) -> dict:
+        entry_return = None
+        path = str(Path(fn).resolve())
+        stat = os.stat(path)
+        cached = self.manifest.get_cached_entry(path, stat)
+        # the digest of a DER cert file is the cert's SHA-256 fingerprint
+        digest = cached.get("sha256") if cached else None
+        info = self.infos.get(digest) if digest else None
+        data = None
+        if not info:
+            data = FileUtils.read_file(path)
+            digest = hashlib.sha256(data).hexdigest()
+            self.manifest.set_entry(path, stat, digest)
+            info = self.infos.get(digest)
+            if not info:
+                info = self.parse_info(data)
+                if info:
+                    self.infos[digest] = info
+        if info:
+            entry_return = {**info,
+                            "path": fn,
+                            "sha256": digest,
+                            "valid_from": datetime.strptime(info.get("valid_from"), CertCache.DATE_FORMAT),
+                            "valid_to": datetime.strptime(info.get("valid_to"), CertCache.DATE_FORMAT),
+                            "der": data,
+                            "pem": X509Utils.convert_der_pem(data) if data else None}
+        return entry_return
+
+    # get the cache entry for a DER cert file, reading its header info if not
+    # cached yet.  Returns None if the file could not be parsed.
+    def get(self, fn: str) -> dict:
+        key = self.get_key(fn)
+        if key in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.entries[key] = self.load_entry(fn)
+        return self.entries.get(key)
+
+    def get_pem(self, fn: str, include_info: bool = True) -> str:
+        pem_return = None
+        entry = self.get(fn)
+        if entry:
+            if entry.get("pem") is None:
+                entry["der"] = FileUtils.read_file(entry.get("path"))
+                entry["pem"] = X509Utils.convert_der_pem(entry.get("der"))
+            pem_return = entry.get("pem")
+            if include_info:
+                pem_return = entry.get("info") + pem_return
+        return pem_return
+
+    # save header info of the certs seen this run to the cache file (if any)
+    def save(self):
+        if self.manifest.fn:
+            self.manifest.prune([key[0] for key in self.entries.keys()])
+            digests = set(entry.get("sha256")
+                          for entry in self.manifest.files.values())
+            self.manifest.data = {"infos": {digest: info for digest, info in self.infos.items()
+                                            if digest in digests}}
+            self.manifest.save()
+
+    def log_stats(self):
+        logging.debug(
+            f"Cert cache: {len(self.entries)} certs, {self.parsed} parsed, {self.hits} hits, {self.misses} misses")
@@ -0,0 +1,118 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from pkiccu.x509_utils import X509Utils
+from pkiccu.file_utils import FileUtils
+from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+
+# Runs in a worker process, so it has to be a plain module level function.
+# Returns None if the cert or CRL in fn was signed by the cert in fn_issuer,
+# otherwise an error message.
+def verify_signature_file(fn: str, fn_issuer: str, is_crl: bool = False) -> str:
+    str_return = None
+    try:
+        signed = X509Utils.load_crl_der(
+            fn) if is_crl else X509Utils.load_cert_der(fn)
+        issuer = X509Utils.load_cert_der(fn_issuer)
+        if not signed or not issuer:
+            raise RuntimeError("could not be loaded")
+        X509Utils.verify_signed_by(signed, issuer)
+    except BaseException as e:
+        str_return = f"{type(e).__name__}: {str(e)}" if str(
+            e) else type(e).__name__
+    return str_return
+
+
+class CertIndex:
+    """
+    An index of CA certs by subject key identifier and by subject name, used
+    to find the possible issuers of a cert or CRL without comparing it to
+    every other cert.  Signatures of many (signed, issuer) pairs can be
+    checked across a process pool with verify_pairs().
+    """
+
+    def __init__(self):
+        self.certs = {}
+        self.by_ski = {}
+        self.by_subject = {}
+        self.by_subject_der = {}
+
+    def add_file(self, fn: str):
+        cert = X509Utils.load_cert_der(fn)
+        if cert:
+            fn = str(fn)
+            self.certs[fn] = cert
+            ski = X509Utils.cert_get_ski(cert)
+            if ski:
+                self.by_ski.setdefault(ski, []).append(fn)
+            self.by_subject.setdefault(cert.subject, []).append(fn)
+            self.by_subject_der.setdefault(
+                cert.subject.public_bytes(default_backend()), []).append(fn)
+        return cert
+
+    def add_dir(self, dn: str, match: str = r"*.cer", recursive: bool = False) -> int:
+        int_return = 0
+        if Path(dn).is_dir():
+            for fn in sorted(FileUtils.get_matching_files(dn, match, recursive=recursive)):
+                try:
+                    if self.add_file(fn):
+                        int_return += 1
+                except BaseException as e:
+                    logging.debug(f"Could not index cert '{fn}': {str(e)}")
+        return int_return
+
+    # Files of the certs that could have issued a cert or CRL: those whose
+    # subject is its issuer name, narrowed by key identifier if it has an AKI.
+    def find_issuers(self, cert_or_crl) -> list:
+        list_return = list(self.by_subject.get(cert_or_crl.issuer, []))
+        aki = X509Utils.get_aki(cert_or_crl)
+        if aki:
+            by_key = set(self.by_ski.get(aki, []))
+            list_return = [fn for fn in list_return if fn in by_key]
+        return list_return
+
+    # Files of the certs whose subject is the given DER encoded name, e.g. the
+    # issuer of a CRL from X509Utils.der_crl_get_issuer().
+    def find_by_name_der(self, name_der: bytes) -> list:
+        return list(self.by_subject_der.get(name_der, []))
+
+    # Check the signatures of a list of (signed file, issuer cert file)
+    # pairs.  Returns a dict of pair => None if the signature is good, or an
+    # error message.  With more than one worker the checks run in a process
+    # pool.
+    def verify_pairs(pairs: list, is_crl: bool = False, max_workers: int = None) -> dict:
+        dict_return = {}
+        if pairs:
+            args = ([fn for fn, fn_issuer in pairs],
+                    [fn_issuer for fn, fn_issuer in pairs],
+                    [is_crl] * len(pairs))
+            if max_workers == 1 or len(pairs) == 1:
+                results = map(verify_signature_file, *args)
+                dict_return = dict(zip(pairs, results))
+            else:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    chunksize = max(1, len(pairs) // (4 * (max_workers or 4)))
+                    results = executor.map(
+                        verify_signature_file, *args, chunksize=chunksize)
+                    dict_return = dict(zip(pairs, results))
+        return dict_return
@@ -0,0 +1,104 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from pkiccu.cert_index import CertIndex
+from pkiccu.file_utils import FileUtils
+import logging
+
+
+class ChainValidator:
+    """
+    Checks that CA certs chain up to trusted root certs.  A cert is good if
+    one of its possible issuers (found through a CertIndex) verifiably signed
+    it and that issuer is a trusted root or is itself good.  All signature
+    checks are done up front in a single batch across a process pool, then
+    the chains are resolved from the results.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.index = CertIndex()
+        self.roots = set()
+
+    # Root certs are trusted as they are.  They should only come from a
+    # trusted source (see README.md).
+    def add_roots(self, dn: str, match: str = r"*.cer") -> int:
+        int_return = 0
+        if Path(dn).is_dir():
+            for fn in sorted(FileUtils.get_matching_files(dn, match)):
+                try:
+                    if self.index.add_file(fn):
+                        self.roots.add(str(fn))
+                        int_return += 1
+                except BaseException as e:
+                    logging.debug(f"Could not index root cert '{fn}': {str(e)}")
+        return int_return
+
+    def add_certs(self, dn: str, match: str = r"*.cer", recursive: bool = False) -> int:
+        return self.index.add_dir(dn, match, recursive=recursive)
+
+    # Validate the chains of all the indexed non-root certs.  Returns a dict
+    # of cert file => None if it chains to a root, or the reason it doesn't.
+    def validate(self) -> dict:
+        dict_return = {}
+        candidates = [fn for fn in self.index.certs.keys()
+                      if fn not in self.roots]
+        pairs = []
+        for fn in candidates:
+            for fn_issuer in self.index.find_issuers(self.index.certs.get(fn)):
+                if fn_issuer != fn:
+                    pairs.append((fn, fn_issuer))
+        logging.debug(
+            f"Checking {len(pairs)} signatures for {len(candidates)} certs")
+        results = CertIndex.verify_pairs(
+            pairs, max_workers=self.max_workers)
+        signed_by = {}
+        for (fn, fn_issuer), error in results.items():
+            if error:
+                logging.debug(
+                    f"Signature of '{fn}' does not verify with '{fn_issuer}': {error}")
+            else:
+                signed_by.setdefault(fn, []).append(fn_issuer)
+        # resolve chains from the top down until nothing more is trusted
+        trusted = set(self.roots)
+        pending = [fn for fn in candidates if fn in signed_by]
+        progress = True
+        while pending and progress:
+            progress = False
+            still_pending = []
+            for fn in pending:
+                if any(fn_issuer in trusted for fn_issuer in signed_by.get(fn)):
+                    trusted.add(fn)
+                    progress = True
+                else:
+                    still_pending.append(fn)
+            pending = still_pending
+        have_issuer = set(fn for fn, fn_issuer in pairs)
+        for fn in candidates:
+            if fn in trusted:
+                dict_return[fn] = None
+            elif fn not in signed_by:
+                if fn in have_issuer:
+                    dict_return[fn] = "signature does not verify with any possible issuer"
+                else:
+                    dict_return[fn] = "issuer cert not found"
+            else:
+                dict_return[fn] = "issuer does not chain to a trusted root"
+        return dict_return
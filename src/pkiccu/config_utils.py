@@ -17,20 +17,24 @@
 # this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import yaml
 from datetime import datetime
 
 
 class ConfigUtils:
 
     def load(fn: str) -> dict:
+        import yaml
         config_return = {}
         if fn:
             with open(fn, 'r') as f:
                 config_return = yaml.safe_load(f)
-            config_return = ConfigUtils.__do_config_replacements(config_return)
+            config_return = ConfigUtils.prepare(config_return)
         return config_return
 
+    # replace the variables in a config that wasn't read by load()
+    def prepare(config: dict) -> dict:
+        return ConfigUtils.__do_config_replacements(config)
+
     def get(config: dict, param: str, default: any = None) -> any:
         val_return = default
 
@@ -0,0 +1,129 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from pkiccu.file_utils import FileUtils
+import fnmatch
+import json
+import time
+import os
+
+
+class DirIndex:
+    """
+    Directory listings built with os.scandir(), so the file/dir type of each
+    entry comes from the directory read instead of a stat() per path.  A
+    listing is reused, within a run or from the saved index of an earlier run,
+    as long as the directory's mtime hasn't changed (adding, removing or
+    renaming an entry always changes it), so an unchanged directory costs one
+    stat() instead of a re-walk.
+    """
+
+    # Listings of directories modified this close to the time they were read
+    # aren't trusted, file systems with coarse mtimes could hide a change.
+    RACY_NS = 2 * 1000 * 1000 * 1000
+
+    def __init__(self, fn: str = None):
+        self.fn = fn
+        self.listings = {}
+        self.scanned = 0
+        self.reused = 0
+
+    def load(self) -> bool:
+        bool_return = False
+        self.listings = {}
+        if self.fn and Path(self.fn).exists():
+            try:
+                with open(self.fn, "r") as file:
+                    self.listings = json.load(file).get("listings", {})
+                bool_return = True
+            except (OSError, ValueError):
+                self.listings = {}
+        return bool_return
+
+    def save(self):
+        if self.fn:
+            with FileUtils.open_atomic(self.fn, "w") as file:
+                json.dump({"listings": self.listings}, file, sort_keys=True)
+
+    # Returns (file names, sub directory names) in a directory.  Symlinks to
+    # files count as files, symlinks to directories are not followed (the same
+    # as Path.glob()).
+    def list_dir(self, dn: str) -> tuple:
+        key = os.path.abspath(str(dn))
+        mtime_ns = os.stat(key).st_mtime_ns
+        listing = self.listings.get(key)
+        if listing and listing.get("mtime_ns") == mtime_ns and mtime_ns < listing.get("scanned_ns", 0) - DirIndex.RACY_NS:
+            self.reused += 1
+        else:
+            listing = {"mtime_ns": mtime_ns,
+                       "scanned_ns": int(time.time() * 1000 * 1000 * 1000),
+                       "files": [],
+                       "dirs": []}
+            with os.scandir(key) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            listing["dirs"].append(entry.name)
+                        elif entry.is_file():
+                            listing["files"].append(entry.name)
+                    except OSError:
+                        # vanished or dangling, same as Path.glob()
+                        pass
+            self.listings[key] = listing
+            self.scanned += 1
+        return listing.get("files"), listing.get("dirs")
+
+    # Yields (dir, file names) for a directory and, if recursive, all of the
+    # directories below it.
+    def walk(self, dn: str, recursive: bool = False):
+        stack = [str(dn)]
+        while stack:
+            dn_cur = stack.pop()
+            try:
+                files, dirs = self.list_dir(dn_cur)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            yield dn_cur, files
+            if recursive:
+                stack += [os.path.join(dn_cur, name)
+                          for name in reversed(dirs)]
+
+    # Same results as FileUtils.get_matching_files(), but the pattern is
+    # matched against all of the names of a directory at once.  Patterns with
+    # a path in them are left to Path.glob().
+    def get_matching_files(self, dn: str, pattern: str = r"*", recursive: bool = False) -> list:
+        list_return = []
+        if dn and Path(dn).is_dir():
+            if recursive and pattern.startswith("**/"):
+                pattern = pattern[3:]
+            if "/" in pattern or os.sep in pattern or "**" in pattern:
+                if recursive:
+                    pattern = "**/" + pattern
+                list_return = [str(path) for path in Path(
+                    dn).glob(pattern) if path.is_file()]
+            else:
+                for dn_cur, files in self.walk(dn, recursive=recursive):
+                    list_return += [os.path.join(dn_cur, name)
+                                    for name in fnmatch.filter(files, pattern)]
+        return list_return
+
+    # Remove saved listings of directories that don't exist anymore
+    def prune(self):
+        self.listings = {key: listing for key, listing in self.listings.items()
+                         if Path(key).is_dir()}
@@ -25,6 +25,7 @@ for listing and downloading certs and CRLs from DISA
 #from typing import Callable
 from bs4 import BeautifulSoup
 from pkiccu.http_utils import HttpUtils
+from pkiccu.file_utils import FileUtils
 from pathlib import Path
 import gzip
 import shutil
@@ -169,13 +170,17 @@ class DisaCrlScraper:
                     if digest_sha1:
                         dict_return["sha1"] = digest_sha1
 
-                self.ca_details[ca] = dict_return
+                self.ca_details[dn] = dict_return
             except BaseException as e:
                 dict_return = None
                 raise e
 
         return dict_return
 
+    # have the details of a CA already been scraped?
+    def has_ca_details(self, ca: str) -> bool:
+        return self.ca_info.get(ca) in self.ca_details
+
     def get_all_ca_details(self):
         """
         """
@@ -229,7 +234,7 @@ class DisaCrlScraper:
 
             path_return = dl_path.with_suffix("")
 
-            with open(path_return, 'wb') as f_out, gzip.open(dl_path, 'rb') as f_in:
+            with FileUtils.open_atomic(str(path_return), 'wb') as f_out, gzip.open(dl_path, 'rb') as f_in:
                 shutil.copyfileobj(f_in, f_out)
 
             os.remove(dl_path)
@@ -22,11 +22,20 @@ from pkiccu.cert_bundler import CertBundler
 from pkiccu.x509_utils import X509Utils
 from pathlib import Path
 from pkiccu.disa_crl_scraper import DisaCrlScraper
+from pkiccu.catalog import Catalog
+from pkiccu.chain_validator import ChainValidator
+from pkiccu.cert_index import CertIndex
+from pkiccu.file_manifest import FileManifest
+from pkiccu.file_utils import FileUtils
+from pkiccu.metrics import Metrics
 import tempfile
 from zipfile import ZipFile, is_zipfile
 import shutil
-from datetime import datetime
+import heapq
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
 from tqdm import tqdm
+import time
 import sys
 import os
 import logging
@@ -55,14 +64,66 @@ class DisaDownloader:
                   CAT_INTEROP,
                   CAT_OTHER]
 
-    def __init__(self, base_dir: str = ".", url_disa: str = URL_DISA, http_utils: HttpUtils = None):
+    # categories whose certs must chain to the DoD roots in root/certs
+    VALIDATE_CATEGORIES = [CAT_ID,
+                           CAT_ID_SW,
+                           CAT_SW,
+                           CAT_EMAIL]
+
+    # catalog category of certs and CRLs that failed validation
+    REJECTED_DIR = "rejected"
+
+    # CRL download strategies that use_all_crl_zip: "auto" chooses between
+    CRL_STRATEGY_ZIP = "zip"
+    CRL_STRATEGY_PER_CA = "per_ca"
+    # measured sizes, compression and network speed for the choice
+    CRL_STATS_FILE = ".pkiccu_crl_stats"
+    # assumed until runs have measured them
+    DEFAULT_RTT = 0.5  # seconds per HTTP request
+    DEFAULT_THROUGHPUT = 1024 * 1024  # bytes per second
+    DEFAULT_COMPRESSION = 0.5  # compressed size / CRL size
+    # weight of a new measurement in the running averages
+    STATS_WEIGHT = 0.3
+    # downloads smaller than this say more about latency than throughput
+    MIN_THROUGHPUT_BYTES = 256 * 1024
+
+    # Downloads of higher weight categories go first, so they're done if the
+    # run's deadline cuts the rest off.  Within a category the CRLs that
+    # expire soonest go first.
+    DEFAULT_CATEGORY_WEIGHTS = {CAT_ID: 100,
+                                CAT_ROOT: 90,
+                                CAT_ID_SW: 80,
+                                CAT_SW: 70,
+                                CAT_EMAIL: 60,
+                                CAT_ECA: 40,
+                                CAT_INTEROP: 30,
+                                CAT_WCF: 20,
+                                CAT_OTHER: 10}
+
+    # deadline is a time.monotonic() time after which no more downloads are
+    # started, category_weights override DEFAULT_CATEGORY_WEIGHTS.  Certs and
+    # CRLs that fail validation are moved to quarantine_dir, which must be
+    # outside of everything that's published or imported, or deleted if it's
+    # None.
+    def __init__(self, base_dir: str = ".", url_disa: str = URL_DISA, http_utils: HttpUtils = None, catalog: Catalog = None,
+                 deadline: float = None, category_weights: dict = None, quarantine_dir: str = None):
         self.base_path = Path(base_dir)
+        self.quarantine_path = Path(quarantine_dir) if quarantine_dir else None
+        self.deadline = deadline
+        self.category_weights = dict(DisaDownloader.DEFAULT_CATEGORY_WEIGHTS)
+        self.category_weights.update(category_weights or {})
+        # "<kind>: <CA>" of the downloads skipped because of the deadline
+        self.skipped = []
         self.url_disa = url_disa
+        self.catalog = catalog
         self.http_utils = http_utils
         if not self.http_utils:
             self.http_utils = HttpUtils()
         self.disa_crl_scraper = DisaCrlScraper(
             url_disa=self.url_disa, http_utils=self.http_utils)
+        self.crl_stats = FileManifest(
+            str(self.base_path / DisaDownloader.CRL_STATS_FILE))
+        self.crl_stats.load()
         self.__init_dirs()
 
     def __init_dirs(self):
@@ -95,6 +156,54 @@ class DisaDownloader:
 
         return dir_return
 
+    # record a downloaded or extracted file in the catalog, if there is one
+    def catalog_file(self, path: Path, category: str, source_url: str = None):
+        if self.catalog and path and path.exists():
+            try:
+                self.catalog.update_file(
+                    str(path), category=category, source_url=source_url)
+            except BaseException as e:
+                logging.exception(
+                    f"Error adding '{str(path)}' to catalog: {str(e)}")
+
+    # is it past the run's deadline?
+    def past_deadline(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    # The CAs as a heap, most important first: by category weight, then for
+    # CRLs by the nextUpdate of the local CRL (missing ones first), then in
+    # DISA's order.
+    def get_queue(self, ca_names: list, crls: bool = False) -> list:
+        list_return = []
+        for index, ca in enumerate(ca_names):
+            if not ca or ca == "ALL CRL ZIP":
+                continue
+            urgency = 0
+            if crls:
+                try:
+                    _, next_update = X509Utils.read_crl_update_times(
+                        str(self.get_crl_path(ca)))
+                    urgency = next_update.timestamp() if next_update else float("inf")
+                except (OSError, ValueError):
+                    urgency = float("-inf")
+            list_return.append((-self.category_weights.get(self.name_to_category(ca), 0),
+                                urgency, index, ca))
+        heapq.heapify(list_return)
+        return list_return
+
+    # give up on what's left in the queue because the deadline has passed
+    def skip_queue(self, queue: list, kind: str):
+        names = [item[-1] for item in sorted(queue)]
+        queue.clear()
+        if names:
+            self.skipped.extend(f"{kind}: {ca}" for ca in names)
+            Metrics.inc("pkiccu_files_total", len(names),
+                        stage="disa_download", kind=kind, result="skipped")
+            logging.warning(
+                f"Deadline reached, skipped {len(names)} {kind} downloads: {names}")
+            print(f"Deadline reached, skipped {len(names)} {kind} downloads",
+                  file=sys.stderr)
+
     def download_certs(self, noprogress: bool = None, check_hash: bool = True, check_parse: bool = True):
         ca_names = self.disa_crl_scraper.get_ca_names()
         # doing it this way makes lots of requests. the other way is to use
@@ -102,8 +211,13 @@ class DisaDownloader:
         if not ca_names:
             raise RuntimeError("Could not get CA names list from DISA")
         else:
-            with tqdm(total=len(ca_names), desc="Downloading...", unit="Certs", disable=noprogress, smoothing=0.1) as pbar:
-                for ca in ca_names:
+            queue = self.get_queue(ca_names)
+            with tqdm(total=len(queue), desc="Downloading...", unit="Certs", disable=noprogress, smoothing=0.1) as pbar:
+                while queue:
+                    if self.past_deadline():
+                        self.skip_queue(queue, "cert")
+                        break
+                    ca = heapq.heappop(queue)[-1]
                     try:
                         if ca and ca != "ALL CRL ZIP":
                             logging.debug(f"Downloading cert for '{ca}'...")
@@ -116,14 +230,22 @@ class DisaDownloader:
                             if fn.exists():
                                 logging.debug(
                                     f"Skipping CA cert '{ca}' because file '{fn.name}' already exists.")
+                                Metrics.inc("pkiccu_files_total",
+                                            stage="disa_download", kind="cert", result="unchanged")
+                            elif self.is_quarantined(ca, fn):
+                                logging.debug(
+                                    f"Skipping CA cert '{ca}' because DISA still has the cert that was rejected.")
+                                Metrics.inc("pkiccu_files_total",
+                                            stage="disa_download", kind="cert", result="quarantined")
                             else:
                                 if not self.disa_crl_scraper.is_root_ca(ca):
                                     path_cert_file = self.disa_crl_scraper.download_cert(
                                         ca=ca, filename=dl_file, progress_label=ca, noprogress=True, check_hash=check_hash)
                                     if check_parse and path_cert_file and path_cert_file.exists():
                                         try:
-                                            cert = X509Utils.load_cert_der(
-                                                path_cert_file)
+                                            with Metrics.timer("pkiccu_parse_seconds", kind="cert"):
+                                                cert = X509Utils.load_cert_der(
+                                                    path_cert_file)
                                             if cert == None:
                                                 raise RuntimeError()
                                         except:
@@ -135,19 +257,33 @@ class DisaDownloader:
                                                 pass
                                             raise RuntimeError(
                                                 f"Could not parse cert file '{path_cert_file.name}'")
+                                    if self.catalog:
+                                        self.catalog_file(path_cert_file, self.name_to_category(ca),
+                                                          self.disa_crl_scraper.get_ca_details(ca).get("cert"))
+                                    Metrics.inc("pkiccu_files_total",
+                                                stage="disa_download", kind="cert", result="downloaded")
                     except BaseException as ex:
+                        Metrics.inc("pkiccu_files_total",
+                                    stage="disa_download", kind="cert", result="failed")
                         logging.exception(
-                            f"Error downloading cert for CA '{ca}'")
+                            f"Error downloading cert for CA '{ca}'", extra={"ca": ca})
                         print(str(ex), file=sys.stderr)
                     pbar.update(1)
                 pbar.set_description("Cert Downloads Complete")
 
-    def download_crls(self, noprogress: bool = None, check_parse: bool = True):
-        ca_names = self.disa_crl_scraper.get_ca_names()
+    # download the CRLs of ca_names (all CAs if None) one by one
+    def download_crls(self, noprogress: bool = None, check_parse: bool = True, ca_names: list = None):
+        if ca_names is None:
+            ca_names = self.disa_crl_scraper.get_ca_names()
         # doing it this way makes lots of requests. the other way is to use
         # their naming convention for cert files
-        with tqdm(total=len(ca_names), desc="Downloading...", unit="CRLs", disable=noprogress, smoothing=0.1) as pbar:
-            for ca in ca_names:
+        queue = self.get_queue(ca_names, crls=True)
+        with tqdm(total=len(queue), desc="Downloading...", unit="CRLs", disable=noprogress, smoothing=0.1) as pbar:
+            while queue:
+                if self.past_deadline():
+                    self.skip_queue(queue, "crl")
+                    break
+                ca = heapq.heappop(queue)[-1]
                 try:
                     if ca != "ALL CRL ZIP":
                         logging.debug(f"Downloading CRL for '{ca}'...")
@@ -160,8 +296,9 @@ class DisaDownloader:
                             try:
                                 pbar.set_description(
                                     f"Parsing {path_crl_file.name}")
-                                crl = X509Utils.load_crl_der(
-                                    path_crl_file)
+                                with Metrics.timer("pkiccu_parse_seconds", kind="crl"):
+                                    crl = X509Utils.load_crl_der(
+                                        path_crl_file)
                                 if crl == None:
                                     raise RuntimeError()
                             except:
@@ -173,14 +310,26 @@ class DisaDownloader:
                                     pass
                                 raise RuntimeError(
                                     f"Could not parse CRL file '{path_crl_file.name}'")
+                        if self.catalog:
+                            self.catalog_file(path_crl_file, self.name_to_category(ca),
+                                              self.disa_crl_scraper.get_ca_details(ca).get("crl_gzip"))
+                        Metrics.inc("pkiccu_files_total",
+                                    stage="disa_download", kind="crl", result="downloaded")
 
                 except BaseException as ex:
-                    logging.exception(f"Error downloading CRL for CA '{ca}'")
+                    Metrics.inc("pkiccu_files_total",
+                                stage="disa_download", kind="crl", result="failed")
+                    logging.exception(
+                        f"Error downloading CRL for CA '{ca}'", extra={"ca": ca})
                     print(str(ex), file=sys.stderr)
                 pbar.update(1)
             pbar.set_description("CRL Downloads Complete")
+        self.update_crl_stats()
 
     def download_crls_zip(self, crl_zip_archive_dir: str = None, noprogress: bool = None, check_parse: bool = True):
+        if self.past_deadline():
+            self.skip_queue([(0, 0, 0, "ALL CRL ZIP")], "crl")
+            return
         dl_dir = crl_zip_archive_dir
         prefer_cd_filename = False
         tmp_dir = None
@@ -199,14 +348,22 @@ class DisaDownloader:
             Path(dl_dir).parent.mkdir(parents=True, exist_ok=True)
 
         logging.debug(f"Downloading ALL CRL ZIP to '{str(dl_dir)}'...")
+        time_start = time.monotonic()
         path_zip = self.disa_crl_scraper.download_all_crl_zip(
             filename=dl_dir, prefer_cd_filename=prefer_cd_filename, progress_label="ALL CRL ZIP", noprogress=noprogress)
+        seconds = time.monotonic() - time_start
 
         if not is_zipfile(path_zip):
             raise RuntimeError(f"Invalid zip file: {str(path_zip)}")
 
         zip = ZipFile(path_zip, mode="r", allowZip64=True)
+        zip_bytes = path_zip.stat().st_size
+        self.update_crl_stats(zip_bytes=zip_bytes,
+                              crl_bytes=sum(info.file_size for info in zip.infolist()),
+                              seconds=seconds)
 
+        url_zip = self.disa_crl_scraper.get_ca_details(
+            "ALL CRL ZIP").get("crl_zip")
         members = zip.namelist()
         logging.debug(f"Extracting ALL CRL ZIP...")
         with tqdm(total=len(members), desc="Extracting", unit="F", disable=noprogress, smoothing=0.1) as pbar:
@@ -214,17 +371,18 @@ class DisaDownloader:
                 try:
                     pbar.set_description(
                         desc=f"Extracting {Path(str(member)).name}")
-                    dir = self.base_path / \
-                        Path(self.name_to_category(
-                            self.disa_crl_scraper.filename_to_name(member))) / "crls"
-                    crl_fn = zip.extract(member, dir)
+                    category = self.name_to_category(
+                        self.disa_crl_scraper.filename_to_name(member))
+                    dir = self.base_path / Path(category) / "crls"
+                    crl_fn = FileUtils.extract_zip_member(zip, member, dir)
                     path_crl_file = Path(crl_fn)
                     if check_parse and path_crl_file and path_crl_file.exists():
                         try:
                             pbar.set_description(
                                 f"Parsing {path_crl_file.name}")
-                            crl = X509Utils.load_crl_der(
-                                path_crl_file)
+                            with Metrics.timer("pkiccu_parse_seconds", kind="crl"):
+                                crl = X509Utils.load_crl_der(
+                                    path_crl_file)
                             if crl == None:
                                 raise RuntimeError()
                         except:
@@ -236,12 +394,273 @@ class DisaDownloader:
                                 pass
                             raise RuntimeError(
                                 f"Could not parse CRL file '{path_crl_file.name}'")
+                    self.catalog_file(path_crl_file, category, url_zip)
+                    Metrics.inc("pkiccu_files_total",
+                                stage="disa_download", kind="crl", result="extracted")
                 except BaseException as ex:
+                    Metrics.inc("pkiccu_files_total",
+                                stage="disa_download", kind="crl", result="failed")
                     logging.exception(
-                        f"Error exctracting or processing {member}")
+                        f"Error exctracting or processing {member}", extra={"ca": Path(str(member)).stem})
                     print(str(ex), file=sys.stderr)
                 pbar.update(1)
             pbar.set_description(desc="Extraction Complete")
 
         if not crl_zip_archive_dir and tmp_dir:
             shutil.rmtree(tmp_dir)
+
+    # where a CA's CRL is kept
+    def get_crl_path(self, ca: str) -> Path:
+        return self.base_path / Path(self.name_to_category(ca)) / "crls" / \
+            Path(self.disa_crl_scraper.name_to_filename(ca) + ".crl")
+
+    # The CAs whose CRL is missing, unreadable, older than max_age hours or
+    # expires within max_age hours (i.e. before the next daily run), and the
+    # sizes of the CRLs that are there.  Only the start of each CRL is read.
+    def get_stale_crls(self, ca_names: list, max_age: float = 24) -> tuple:
+        list_stale = []
+        dict_sizes = {}
+        now = datetime.utcnow()
+        for ca in ca_names:
+            path_crl = self.get_crl_path(ca)
+            try:
+                dict_sizes[ca] = path_crl.stat().st_size
+                this_update, next_update = X509Utils.read_crl_update_times(
+                    str(path_crl))
+                if this_update < now - timedelta(hours=max_age) or \
+                        (next_update is not None and next_update < now + timedelta(hours=max_age)):
+                    list_stale.append(ca)
+            except (OSError, ValueError):
+                list_stale.append(ca)
+        return (list_stale, dict_sizes)
+
+    # Estimate the bytes, HTTP requests and seconds of getting the CRLs with
+    # the ALL CRL ZIP versus downloading only the stale ones, from the sizes
+    # of the local CRLs and what earlier runs measured.
+    def estimate_crl_costs(self, ca_names: list, stale: list, sizes: dict) -> dict:
+        stats = self.crl_stats.data
+        rtt = stats.get("rtt", DisaDownloader.DEFAULT_RTT)
+        throughput = stats.get(
+            "throughput", DisaDownloader.DEFAULT_THROUGHPUT)
+        compression = stats.get(
+            "compression", DisaDownloader.DEFAULT_COMPRESSION)
+        avg_size = sum(sizes.values()) / len(sizes) if sizes else None
+        zip_bytes = stats.get("zip_bytes")
+        if zip_bytes is None and avg_size is not None:
+            zip_bytes = avg_size * len(ca_names) * compression
+        if avg_size is not None:
+            per_ca_bytes = sum(sizes.get(ca, avg_size)
+                               for ca in stale) * compression
+        elif zip_bytes is not None:
+            per_ca_bytes = zip_bytes * len(stale) / max(1, len(ca_names))
+        else:
+            # a cold start with nothing measured, only requests count
+            zip_bytes = per_ca_bytes = 0
+        # scraping a CA's details takes a details and a view request
+        zip_requests = 1 + \
+            (0 if self.disa_crl_scraper.has_ca_details("ALL CRL ZIP") else 2)
+        per_ca_requests = sum(1 + (0 if self.disa_crl_scraper.has_ca_details(ca) else 2)
+                              for ca in stale)
+        return {DisaDownloader.CRL_STRATEGY_ZIP: {"bytes": int(zip_bytes),
+                                                  "requests": zip_requests,
+                                                  "seconds": zip_requests * rtt + zip_bytes / throughput},
+                DisaDownloader.CRL_STRATEGY_PER_CA: {"bytes": int(per_ca_bytes),
+                                                     "requests": per_ca_requests,
+                                                     "seconds": per_ca_requests * rtt + per_ca_bytes / throughput},
+                "stale": len(stale),
+                "total": len(ca_names),
+                "rtt": rtt,
+                "throughput": throughput}
+
+    # Get the CRLs whichever way is estimated to be cheaper this run: the ALL
+    # CRL ZIP, or only the stale CRLs one by one.  Returns the strategy used.
+    def download_crls_auto(self, crl_zip_archive_dir: str = None, noprogress: bool = None, check_parse: bool = True, max_age: float = 24) -> str:
+        ca_names = [ca for ca in self.disa_crl_scraper.get_ca_names() or []
+                    if ca != "ALL CRL ZIP"]
+        stale, sizes = self.get_stale_crls(ca_names, max_age=max_age)
+        estimate = self.estimate_crl_costs(ca_names, stale, sizes)
+        str_return = min((DisaDownloader.CRL_STRATEGY_ZIP, DisaDownloader.CRL_STRATEGY_PER_CA),
+                         key=lambda strategy: estimate.get(strategy).get("seconds"))
+        logging.info(
+            f"CRL strategy '{str_return}': {len(stale)} of {len(ca_names)} CRLs are stale, estimate {estimate}")
+        for strategy in (DisaDownloader.CRL_STRATEGY_ZIP, DisaDownloader.CRL_STRATEGY_PER_CA):
+            Metrics.set("pkiccu_crl_strategy_estimate_seconds",
+                        estimate.get(strategy).get("seconds"), strategy=strategy)
+        Metrics.set("pkiccu_crls_stale", len(stale))
+        if str_return == DisaDownloader.CRL_STRATEGY_ZIP:
+            self.download_crls_zip(crl_zip_archive_dir=crl_zip_archive_dir,
+                                   noprogress=noprogress, check_parse=check_parse)
+        else:
+            self.download_crls(noprogress=noprogress,
+                               check_parse=check_parse, ca_names=stale)
+        return str_return
+
+    # Fold what this run measured into the CRL stats: the average request
+    # time to DISA, and for the ALL CRL ZIP its size, how well it compresses
+    # and how fast it came.
+    def update_crl_stats(self, zip_bytes: int = None, crl_bytes: int = None, seconds: float = None):
+        stats = self.crl_stats.data
+
+        def average(key: str, value: float):
+            old = stats.get(key)
+            stats[key] = value if old is None else \
+                old + DisaDownloader.STATS_WEIGHT * (value - old)
+
+        histogram = Metrics.get_histogram("pkiccu_http_request_seconds",
+                                          host=urlparse(self.url_disa).hostname)
+        if histogram and histogram.get("count"):
+            average("rtt", histogram.get("sum") / histogram.get("count"))
+        if zip_bytes:
+            stats["zip_bytes"] = zip_bytes
+            if crl_bytes:
+                average("compression", zip_bytes / crl_bytes)
+            if seconds and zip_bytes >= DisaDownloader.MIN_THROUGHPUT_BYTES:
+                average("throughput", zip_bytes / seconds)
+        try:
+            self.crl_stats.save()
+        except OSError as e:
+            logging.warning(f"Could not save CRL stats: {str(e)}")
+
+    # Move a cert or CRL that failed validation (kind "certs" or "crls") to
+    # the quarantine dir, or delete it if there isn't one.  Returns where it
+    # was moved to, or None.
+    def quarantine(self, path: Path, kind: str) -> Path:
+        path_return = None
+        if self.quarantine_path:
+            dir_quarantine = self.quarantine_path / kind
+            dir_quarantine.mkdir(parents=True, exist_ok=True)
+            path_return = dir_quarantine / path.name
+            os.replace(str(path), str(path_return))
+        else:
+            os.remove(str(path))
+        if self.catalog:
+            self.catalog.remove_file(str(path))
+            if path_return:
+                self.catalog.update_file(
+                    str(path_return), category=DisaDownloader.REJECTED_DIR)
+        return path_return
+
+    # Was fn, the cert of ca, rejected before and is DISA still publishing the
+    # same cert?  Then there's no point downloading and rejecting it again.
+    def is_quarantined(self, ca: str, fn: Path) -> bool:
+        bool_return = False
+        if self.quarantine_path:
+            path_quarantined = self.quarantine_path / "certs" / fn.name
+            if path_quarantined.exists():
+                sha1 = self.disa_crl_scraper.get_ca_details(ca).get("sha1")
+                bool_return = self.disa_crl_scraper.check_file_hash_sha1(
+                    str(path_quarantined), sha1)
+        return bool_return
+
+    # Check that the CA certs in the given categories chain to the root certs
+    # in root/certs with valid signatures.  Certs in any category can be
+    # intermediate issuers.  Certs that don't chain are quarantined so they
+    # don't end up in cert bundles.  Returns a dict of rejected cert file =>
+    # reason.
+    def validate_chains(self, categories: list = None, max_workers: int = None) -> dict:
+        dict_return = {}
+        if categories is None:
+            categories = DisaDownloader.VALIDATE_CATEGORIES
+        validator = ChainValidator(max_workers=max_workers)
+        dir_roots = self.base_path / DisaDownloader.CAT_ROOT / "certs"
+        if validator.add_roots(str(dir_roots)) == 0:
+            logging.warning(
+                f"No root certs in '{str(dir_roots)}' to validate cert chains against, skipping validation")
+            print(f"No root certs in '{str(dir_roots)}', cert chains not validated",
+                  file=sys.stderr)
+            return dict_return
+        for category in DisaDownloader.CATEGORIES:
+            if category != DisaDownloader.CAT_ROOT:
+                validator.add_certs(
+                    str(self.base_path / Path(category) / "certs"))
+        results = validator.validate()
+        num_checked = 0
+        for fn, error in results.items():
+            path_cert = Path(fn)
+            if path_cert.parent.parent.name in categories:
+                num_checked += 1
+                if error:
+                    try:
+                        path_rejected = self.quarantine(path_cert, "certs")
+                        dict_return[fn] = error
+                        logging.warning(
+                            f"Rejected cert '{fn}' ({error}), " +
+                            (f"moved to '{str(path_rejected)}'" if path_rejected else "deleted"))
+                        print(f"Rejected cert '{path_cert.name}': {error}",
+                              file=sys.stderr)
+                    except BaseException as ex:
+                        logging.exception(
+                            f"Error rejecting cert '{fn}': {str(ex)}")
+        logging.info(
+            f"Validated cert chains of {num_checked} certs, {len(dict_return)} rejected")
+        return dict_return
+
+    # Verify the signature of every CRL against its issuer's cert (matched by
+    # name, any of the categories' certs can be the issuer).  CRLs whose
+    # signature doesn't verify are quarantined.  The checks run
+    # across a process pool, and the digests of CRLs that verified are
+    # remembered so unchanged CRLs aren't checked again on the next run.
+    # Returns a dict of rejected CRL file => reason.
+    def check_crl_signatures(self, max_workers: int = None) -> dict:
+        dict_return = {}
+        index = CertIndex()
+        for category in DisaDownloader.CATEGORIES:
+            index.add_dir(str(self.base_path / Path(category) / "certs"))
+        manifest = FileManifest(
+            str(self.base_path / ".pkiccu_crl_signatures"))
+        manifest.load()
+        verified = set(manifest.data.get("verified", []))
+        fn_crls = []
+        for category in DisaDownloader.CATEGORIES:
+            dir_crls = self.base_path / Path(category) / "crls"
+            if dir_crls.is_dir():
+                fn_crls += FileUtils.get_matching_files(str(dir_crls), "*.crl")
+        pairs = []
+        digests = {}
+        num_no_issuer = 0
+        for fn in fn_crls:
+            try:
+                digests[fn] = manifest.get_digest(fn)
+                if digests.get(fn) not in verified:
+                    with open(fn, "rb") as file:
+                        issuer_der = X509Utils.der_crl_get_issuer(
+                            file.read(64 * 1024))
+                    issuers = index.find_by_name_der(issuer_der)
+                    if not issuers:
+                        num_no_issuer += 1
+                        logging.warning(
+                            f"No issuer cert found to check the signature of CRL '{fn}'")
+                    pairs += [(fn, fn_issuer) for fn_issuer in issuers]
+            except BaseException as ex:
+                logging.exception(
+                    f"Error reading CRL '{fn}': {str(ex)}")
+        results = CertIndex.verify_pairs(
+            pairs, is_crl=True, max_workers=max_workers)
+        errors = {}
+        for (fn, fn_issuer), error in results.items():
+            if error:
+                errors.setdefault(fn, []).append(error)
+            else:
+                verified.add(digests.get(fn))
+        for fn, error_list in errors.items():
+            if digests.get(fn) not in verified:
+                try:
+                    path_crl = Path(fn)
+                    path_rejected = self.quarantine(path_crl, "crls")
+                    dict_return[fn] = "; ".join(error_list)
+                    logging.warning(
+                        f"Rejected CRL '{fn}' (signature does not verify: {dict_return.get(fn)}), " +
+                        (f"moved to '{str(path_rejected)}'" if path_rejected else "deleted"))
+                    print(f"Rejected CRL '{path_crl.name}': signature does not verify",
+                          file=sys.stderr)
+                except BaseException as ex:
+                    logging.exception(
+                        f"Error rejecting CRL '{fn}': {str(ex)}")
+        manifest.prune(fn_crls)
+        manifest.data = {"verified": sorted(digest for digest in verified
+                                            if digest in set(digests.values()))}
+        manifest.save()
+        logging.info(
+            f"Checked CRL signatures: {len(fn_crls)} CRLs, {len(set(fn for fn, fn_issuer in pairs))} checked, "
+            f"{len(dict_return)} rejected, {num_no_issuer} without an issuer cert")
+        return dict_return
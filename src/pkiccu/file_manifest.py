@@ -0,0 +1,106 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from pathlib import Path
+from pkiccu.file_utils import FileUtils
+import hashlib
+import json
+import os
+
+
+class FileManifest:
+    """
+    A record of (size, mtime_ns, sha256) for a set of files, saved as JSON.
+    When a manifest is refreshed the SHA-256 digest of a file is only
+    recomputed if its size or mtime changed since the last time, so checking a
+    large set of unchanged files costs one stat() per file.
+    """
+
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, fn: str = None):
+        self.fn = fn
+        self.files = {}
+        self.data = {}
+
+    def hash_file(fn: str) -> str:
+        digest = hashlib.sha256()
+        with open(fn, "rb") as file:
+            for block in iter(lambda: file.read(FileManifest.HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load(self) -> bool:
+        bool_return = False
+        self.files = {}
+        self.data = {}
+        if self.fn and Path(self.fn).exists():
+            try:
+                with open(self.fn, "r") as file:
+                    manifest = json.load(file)
+                self.files = manifest.get("files", {})
+                self.data = manifest.get("data", {})
+                bool_return = True
+            except (OSError, ValueError):
+                # a damaged manifest just means everything is rehashed
+                self.files = {}
+                self.data = {}
+        return bool_return
+
+    def save(self):
+        if self.fn:
+            with FileUtils.open_atomic(self.fn, "w") as file:
+                json.dump({"files": self.files, "data": self.data},
+                          file, indent=1, sort_keys=True)
+
+    # get the manifest entry for a file, reusing the recorded digest if the
+    # file's size and mtime haven't changed.  The entry is recorded too.
+    def get_entry(self, fn: str) -> dict:
+        path = str(fn)
+        stat = Path(path).stat()
+        entry = self.get_cached_entry(path, stat)
+        if not entry:
+            entry = self.set_entry(path, stat, FileManifest.hash_file(path))
+        return entry
+
+    # the recorded entry for a file if its size and mtime (from stat) haven't
+    # changed, otherwise None
+    def get_cached_entry(self, fn: str, stat: os.stat_result) -> dict:
+        entry = self.files.get(str(fn))
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return entry
+        return None
+
+    # record the digest of a file the caller has read itself.  stat must be
+    # from before it was read.
+    def set_entry(self, fn: str, stat: os.stat_result, digest: str) -> dict:
+        entry = {"size": stat.st_size,
+                 "mtime_ns": stat.st_mtime_ns,
+                 "sha256": digest}
+        self.files[str(fn)] = entry
+        return entry
+
+    def get_digest(self, fn: str) -> str:
+        return self.get_entry(fn).get("sha256")
+
+    # drop entries for files not in keep_list
+    def prune(self, keep_list: list):
+        keep = set(str(fn) for fn in keep_list)
+        self.files = {fn: entry for fn,
+                      entry in self.files.items() if fn in keep}
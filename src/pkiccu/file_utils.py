@@ -19,9 +19,16 @@
 
 from typing import Dict, List
 from pathlib import Path
+from contextlib import contextmanager
+from zipfile import ZipFile
+import tempfile
+import shutil
+import os
 
 
 class FileUtils:
+    # block size for streaming files to and from the network
+    CHUNK_SIZE = 64 * 1024
 
     def read_file(fn: str, binary: bool = True):
         data_return = None
@@ -34,13 +41,67 @@ class FileUtils:
     def read_text_file(fn: str) -> str:
         return FileUtils.read_file(fn, binary=False)
 
-    def get_matching_files(dir: str, pattern: str = r".*", recursive: bool = False) -> List:
-        list_return: []
-        if dir:
-            path_dir = Path(dir)
-            if path_dir.exists():
-                if recursive and not pattern.startswith("**/"):
-                    pattern = "**/" + pattern
-                list_return = [str(path) for path in path_dir.glob(
-                    pattern) if path.is_file()]
-        return list_return
+    # dir_index can be a DirIndex shared by the calls of a run so that
+    # directories are only read once.
+    def get_matching_files(dir: str, pattern: str = r".*", recursive: bool = False, dir_index=None) -> List:
+        from pkiccu.dir_index import DirIndex
+        if dir_index is None:
+            dir_index = DirIndex()
+        return dir_index.get_matching_files(dir, pattern, recursive=recursive)
+
+    # Open a file for writing such that readers never see a partly written
+    # file.  Data goes to a temp file in the same directory which replaces the
+    # real file only when the "with" block completes without an exception.
+    @contextmanager
+    def open_atomic(fn: str, mode: str = "w"):
+        path = Path(fn)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, fn_tmp = tempfile.mkstemp(
+            prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+        try:
+            with os.fdopen(fd, mode) as file:
+                yield file
+                file.flush()
+                os.fsync(file.fileno())
+            # mkstemp() makes the file private, keep the old file's mode
+            os.chmod(fn_tmp, path.stat().st_mode if path.exists() else 0o644)
+            os.replace(fn_tmp, str(path))
+        except BaseException as e:
+            try:
+                os.remove(fn_tmp)
+            except:
+                pass
+            raise e
+
+    # Copy a directory tree as hard links to its files (copies where hard
+    # links aren't possible).  Only safe for files that are replaced rather
+    # than written into, see open_atomic().
+    def link_tree(dn_src: str, dn_dst: str):
+        os.makedirs(dn_dst, exist_ok=True)
+        if Path(dn_src).is_dir():
+            for dn_walk, dirs, files in os.walk(dn_src):
+                dn_rel = os.path.relpath(dn_walk, dn_src)
+                for name in dirs + files:
+                    fn_src = os.path.join(dn_walk, name)
+                    fn_dst = os.path.normpath(
+                        os.path.join(dn_dst, dn_rel, name))
+                    if os.path.islink(fn_src):
+                        os.symlink(os.readlink(fn_src), fn_dst)
+                    elif os.path.isdir(fn_src):
+                        os.makedirs(fn_dst, exist_ok=True)
+                    else:
+                        try:
+                            os.link(fn_src, fn_dst)
+                        except OSError:
+                            shutil.copy2(fn_src, fn_dst)
+
+    # Extract a zip member under dn like ZipFile.extract(), but replace the
+    # file instead of writing into it, which would change every hard link to
+    # it.  Returns the file name.
+    def extract_zip_member(zip: ZipFile, member: str, dn: str) -> str:
+        parts = [part for part in member.replace("\\", "/").split("/")
+                 if part not in ("", ".", "..")]
+        fn_return = os.path.join(str(dn), *parts)
+        with zip.open(member) as file_in, FileUtils.open_atomic(fn_return, "wb") as file_out:
+            shutil.copyfileobj(file_in, file_out)
+        return fn_return
@@ -0,0 +1,123 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from datetime import datetime
+from pkiccu.file_utils import FileUtils
+import logging
+import shutil
+import os
+
+
+class Generations:
+    """
+    Publishes the results of a run as an immutable generation so readers
+    (Apache, DBsign, ...) never see a half updated mix of files:
+
+      <dir>/<generation>/<name>   a copy of each of dirs ({name: directory})
+      <current>                   symlink to the newest complete generation
+
+    The copy is made of hard links, so it's cheap and files that didn't
+    change are shared by all generations.  That only works because PKICCU
+    replaces files (see FileUtils.open_atomic) instead of writing into them,
+    which would change the file in every generation.  The current symlink is
+    switched with one rename, and generations past the newest keep ones are
+    removed.  Readers use paths under <current>.
+    """
+
+    TMP_PREFIX = ".tmp_"
+
+    def __init__(self, dirs: dict, dn: str, current: str, keep: int = 3):
+        self.dirs = dirs
+        self.path_dir = Path(dn)
+        self.path_current = Path(current)
+        self.keep = max(1, keep)
+
+    # name of the generation current points to, or None
+    def get_current(self) -> str:
+        str_return = None
+        if self.path_current.is_symlink():
+            str_return = Path(os.readlink(str(self.path_current))).name
+        elif self.path_current.exists():
+            raise RuntimeError(
+                f"'{self.path_current}' has to be a symlink to publish generations")
+        return str_return
+
+    # names of the complete generations, oldest first
+    def list_generations(self) -> list:
+        list_return = []
+        if self.path_dir.is_dir():
+            list_return = sorted(entry.name for entry in os.scandir(str(self.path_dir))
+                                 if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."))
+        return list_return
+
+    # Make a new generation out of dirs and point current at it.  Returns
+    # the generation's name.
+    def publish(self) -> str:
+        self.path_dir.mkdir(parents=True, exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d-%H%M%S")
+        count = 1
+        while (self.path_dir / name).exists():
+            count += 1
+            name = datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{count}"
+        # build it under a hidden name so an interrupted copy is never taken
+        # for a generation
+        path_tmp = self.path_dir / (Generations.TMP_PREFIX + name)
+        try:
+            for dir_name, dn in self.dirs.items():
+                FileUtils.link_tree(str(dn), str(path_tmp / dir_name))
+            os.rename(str(path_tmp), str(self.path_dir / name))
+        except BaseException as e:
+            shutil.rmtree(str(path_tmp), ignore_errors=True)
+            raise e
+        self.switch(name)
+        return name
+
+    # point current at a generation with one atomic rename
+    def switch(self, name: str):
+        self.get_current()
+        self.path_current.parent.mkdir(parents=True, exist_ok=True)
+        target = os.path.relpath(str(self.path_dir / name),
+                                 str(self.path_current.parent))
+        path_link = self.path_current.parent / \
+            f"{Generations.TMP_PREFIX}{self.path_current.name}"
+        if path_link.is_symlink() or path_link.exists():
+            os.remove(str(path_link))
+        os.symlink(target, str(path_link), target_is_directory=True)
+        os.replace(str(path_link), str(self.path_current))
+        logging.info(f"'{self.path_current}' now points to '{target}'")
+
+    # remove all but the newest keep generations (and the current one), and
+    # copies left by interrupted runs.  Returns the names removed.
+    def collect_garbage(self) -> list:
+        list_return = []
+        current = self.get_current()
+        generations = self.list_generations()
+        keep = set(generations[-self.keep:])
+        keep.add(current)
+        for name in generations:
+            if name not in keep:
+                shutil.rmtree(str(self.path_dir / name), ignore_errors=True)
+                list_return.append(name)
+        if self.path_dir.is_dir():
+            for entry in os.scandir(str(self.path_dir)):
+                if entry.name.startswith(Generations.TMP_PREFIX):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        if list_return:
+            logging.info(f"Removed old generations {list_return}")
+        return list_return
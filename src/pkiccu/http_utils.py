@@ -22,6 +22,8 @@ This module includes a class containing some utility functions for HTTP
 """
 
 from typing import Dict
+from pkiccu.metrics import Metrics
+from urllib.parse import urlparse
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
@@ -71,7 +73,8 @@ class HttpUtils:
                       url: str,
                       method: str = "GET",
                       data: Dict = {},
-                      stream: bool = False):
+                      stream: bool = False,
+                      headers: Dict = None):
         """
         Makes a GET or POST request to URL returning response object
 
@@ -82,14 +85,30 @@ class HttpUtils:
         """
         response_return = None
 
+        host = urlparse(url).hostname
+        time_start = time.monotonic()
         try:
             response_return = self.session.request(method=method,
                                                    url=url,
                                                    data=data,
                                                    stream=stream,
+                                                   headers=headers,
                                                    timeout=self.timeout)
+            Metrics.observe("pkiccu_http_request_seconds",
+                            time.monotonic() - time_start, host=host)
+            Metrics.inc("pkiccu_http_requests_total",
+                        host=host, status=response_return.status_code)
+            # retries done by the urllib3 adapter
+            history = getattr(getattr(response_return.raw, "retries", None),
+                              "history", None)
+            if history:
+                Metrics.inc("pkiccu_http_retries_total",
+                            len(history), host=host)
             response_return.raise_for_status()
         except BaseException as e:
+            if response_return is None:
+                Metrics.inc("pkiccu_http_requests_total",
+                            host=host, status="error")
             print(str(e))
             raise e
 
@@ -115,6 +134,8 @@ class HttpUtils:
 
         if response:
             strReturn = response.text
+            Metrics.inc("pkiccu_http_bytes_total", len(
+                response.content), host=urlparse(url).hostname)
 
         return strReturn
 
@@ -159,6 +180,7 @@ class HttpUtils:
         """
         """
         path_return: Path = self.constructPath(filename)
+        path_tmp: Path = None
 
         success: bool = False
 
@@ -189,7 +211,12 @@ class HttpUtils:
 
                     path_return.parent.mkdir(parents=True, exist_ok=True)
 
-                    with open(str(path_return), 'wb') as fd:
+                    # download next to the file and replace it when done, the
+                    # file may be hard linked from an older generation that
+                    # readers are using (and a failed download leaves it be)
+                    path_tmp = path_return.parent / \
+                        f".{path_return.name}.download"
+                    with open(str(path_tmp), 'wb') as fd:
                         chunk_size: int = self.chunk_size
                         downloaded: int = 0
                         with tqdm(total=file_size, desc=progress_label, unit="B", disable=noprogress, smoothing=0.1) as pbar:
@@ -198,29 +225,37 @@ class HttpUtils:
                                     if (chunk):
                                         written: int = fd.write(chunk)
                                         pbar.update(written)
+                                        downloaded += written
                             except BaseException as ex:
                                 pbar.set_description(f"Failed #{attempt}")
                                 raise ex
+                            finally:
+                                Metrics.inc("pkiccu_http_bytes_total", downloaded,
+                                            host=urlparse(url).hostname)
                     if self.check_file_size:
-                        dl_file_size = path_return.stat().st_size
+                        dl_file_size = path_tmp.stat().st_size
                         if dl_file_size != file_size:
                             logging.debug(
                                 f"Downloaded file '{path_return.name}' has invalid size of {dl_file_size} and should be {file_size}")
                             raise RuntimeError(
                                 f"Downloaded file '{path_return.name}' has invalid size of {dl_file_size} and should be {file_size}")
+                    os.replace(str(path_tmp), str(path_return))
 
                     success = True
                     break
             except BaseException as e:
                 logging.exception(
-                    f"Error downloading file '{path_return.name}': {str(e)}")
+                    f"Error downloading file '{path_return.name}': {str(e)}", extra={"url": url, "attempt": attempt})
                 if attempt < self.retries:
-                    logging.debug(f"Retrying {attempt+1} of {self.retries}")
+                    Metrics.inc("pkiccu_http_retries_total",
+                                host=urlparse(url).hostname)
+                    logging.debug(f"Retrying {attempt+1} of {self.retries}",
+                                  extra={"url": url, "attempt": attempt + 1})
                     time.sleep(attempt)
 
         if not success:
-            if path_return.exists():
-                os.remove(path_return)
+            if path_tmp and path_tmp.exists():
+                os.remove(path_tmp)
             logging.debug(
                 f"Could not download '{path_return.name}'.  {self.retries} failed attempts.")
             raise RuntimeError(
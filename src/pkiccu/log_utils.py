@@ -0,0 +1,170 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import datetime
+import logging
+import logging.handlers
+import threading
+import queue
+import json
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line.  Besides the time, level
+    and message, the context fields below are included when the record has
+    them, e.g. from logging.info("...", extra={"ca": ca, "url": url}).
+    """
+
+    FIELDS = ["stage", "ca", "url", "attempt", "duration"]
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(),
+                 "level": record.levelname,
+                 "message": record.getMessage(),
+                 "thread": record.threadName}
+        for field in JsonFormatter.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value if isinstance(
+                    value, (int, float, bool)) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if getattr(record, "tracebacks_suppressed", 0):
+            entry["tracebacks_suppressed"] = record.tracebacks_suppressed
+        return json.dumps(entry)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current stage (LogUtils.stage) to records that don't have one."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "stage", None) is None:
+            record.stage = LogUtils.stage
+        return True
+
+
+class TracebackRateLimitFilter(logging.Filter):
+    """
+    Keeps the same failure from filling the log with tracebacks, e.g. every
+    retry of a download that keeps failing.  Records with a traceback are
+    grouped by where they were logged and the exception type.  Only the first
+    "limit" tracebacks of a group in each "interval" seconds are kept, later
+    records of the group are still logged but without the traceback.  The
+    next traceback that is kept says how many were suppressed.
+    """
+
+    def __init__(self, limit: int = 5, interval: float = 60.0):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.interval = interval
+        self.lock = threading.Lock()
+        # key => [window start, count in window, suppressed]
+        self.groups = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.exc_info and self.limit is not None:
+            exc_type = record.exc_info[0]
+            key = (record.pathname, record.lineno,
+                   exc_type.__name__ if exc_type else None)
+            now = time.monotonic()
+            with self.lock:
+                group = self.groups.get(key)
+                if group is None or now - group[0] > self.interval:
+                    suppressed = group[2] if group else 0
+                    group = [now, 0, 0]
+                    self.groups[key] = group
+                    if suppressed:
+                        record.tracebacks_suppressed = suppressed
+                        record.msg = f"{record.msg} ({suppressed} similar tracebacks suppressed)"
+                group[1] += 1
+                if group[1] > self.limit:
+                    group[2] += 1
+                    record.exc_info = None
+                    record.exc_text = None
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the QueueListener thread without formatting them, so the
+    threads that log only pay for putting the record on the queue.  Only the
+    message is merged with its arguments here, in case they change later.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogUtils:
+    # the stage being run, added to log records by ContextFilter
+    stage = None
+
+    handler = None
+    listener = None
+
+    # Configure the root logger to write to filename.  If queued, records go
+    # through a queue to a listener thread that does the formatting and
+    # writing.  If json, records are written as JSON lines (see
+    # JsonFormatter), otherwise with the logging format fmt.  traceback_limit
+    # and traceback_interval configure TracebackRateLimitFilter, a limit of
+    # None keeps every traceback.  Like logging.basicConfig(), nothing is done
+    # if the root logger already has handlers (e.g. PKICCU is used through
+    # the API by a program that configures logging itself).
+    def configure(filename: str, filemode: str = "w", level: str = "INFO", fmt: str = None, json_format: bool = False,
+                  queued: bool = True, traceback_limit: int = None, traceback_interval: float = 60.0):
+        root = logging.getLogger()
+        if root.handlers:
+            return
+        file_handler = logging.FileHandler(filename, mode=filemode)
+        file_handler.setFormatter(JsonFormatter() if json_format
+                                  else logging.Formatter(fmt))
+        filters = [ContextFilter()]
+        if traceback_limit is not None:
+            filters.append(TracebackRateLimitFilter(
+                limit=traceback_limit, interval=traceback_interval))
+        if queued:
+            handler = QueueHandler(queue.Queue(-1))
+            LogUtils.listener = logging.handlers.QueueListener(
+                handler.queue, file_handler, respect_handler_level=True)
+            LogUtils.listener.start()
+        else:
+            handler = file_handler
+        for log_filter in filters:
+            handler.addFilter(log_filter)
+        LogUtils.handler = handler
+        root.addHandler(handler)
+        root.setLevel(logging.getLevelName(level))
+
+    # Flush and remove the handler configure() added
+    def shutdown():
+        if LogUtils.handler:
+            logging.getLogger().removeHandler(LogUtils.handler)
+        if LogUtils.listener:
+            # writes everything still in the queue
+            LogUtils.listener.stop()
+        if LogUtils.handler:
+            for handler in (LogUtils.listener.handlers if LogUtils.listener else [LogUtils.handler]):
+                handler.close()
+        LogUtils.handler = None
+        LogUtils.listener = None
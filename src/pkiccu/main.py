@@ -23,33 +23,66 @@
 # function is the last function in the class all the way at the bottom.  It
 # shows the basic flow of the program.
 
+# The stage modules (and requests, cryptography, bs4, etc. they use) are
+# imported by the stages that need them, so "--version", "query" and runs with
+# stages turned off don't pay for loading them.
+
 from pathlib import Path
+from pkiccu import STAGES
 from pkiccu.arg_utils import ArgUtils
 from pkiccu.config_utils import ConfigUtils
-from pkiccu.http_utils import HttpUtils
-from pkiccu.disa_downloader import DisaDownloader
-from pkiccu.url_downloader import UrlDownloader
-from pkiccu.cert_bundler import CertBundler
-from pkiccu.script_runner import ScriptRunner
-import tempfile
-import certifi
+from pkiccu.stage_recorder import StageRecorder
+from pkiccu.metrics import Metrics
+from pkiccu.log_utils import LogUtils
 import os
 from datetime import datetime
 import logging
+import time
 import sys
 
 
 class Main:
+    # stages of a run, in the order they run
+    STAGES = STAGES
+
     # constructor
     def __init__(self):
         self.args = None
         self.config = None
         self.temp_ca_file = None
         self.http_utils = None
+        # bundle name => whether the bundle was rewritten.  None if bundles
+        # weren't made this run.
+        self.changed_bundles = None
+        self.catalog = None
+        # results of the user scripts that ran
+        self.script_results = None
+        # time.monotonic() time after which no more downloads are started
+        self.deadline = None
+        # downloads skipped because of the deadline
+        self.deadline_skipped = []
+        # a StageRecorder result for each stage that ran
+        self.stage_results = []
+        self.touched_files = []
+        # where the log file (and profiles) go
+        self.log_dir = "."
 
     # initialize this object.  Called from self.main()
     def init(self):
-        # Read config file
+        # the API can hand us a config instead of a file name
+        if self.config is None:
+            self.load_config()
+        # config logging
+        self.config_logging()
+        # the http subsystem is set up by the first stage that needs it, see
+        # self.get_http_utils()
+        self.temp_ca_file = None
+        self.http_utils = None
+        # open the catalog of managed files
+        self.config_catalog()
+
+    # Read config file
+    def load_config(self):
         config_fn = self.args.get('config')
         if not config_fn:
             raise RuntimeError("Config file name could not be determined.")
@@ -58,12 +91,17 @@ class Main:
             raise RuntimeError(
                 f"Config file '{config_fn}' does not exist.")
         self.config = ConfigUtils.load(self.args.get('config'))
-        # config logging
-        self.config_logging()
-        # config http subsystem
-        self.temp_ca_file = None
-        self.http_utils = None
-        self.config_http()
+
+    # open the SQLite catalog if it's enabled
+    def config_catalog(self):
+        from pkiccu.catalog import Catalog
+        self.catalog = None
+        catalog_config = self.get_param(self.config, "catalog", {})
+        if self.get_param(catalog_config, "enabled", False):
+            filename = self.get_param(catalog_config, "filename", None)
+            if not filename:
+                raise RuntimeError("Catalog is enabled but has no filename.")
+            self.catalog = Catalog(filename)
 
     # init python logging system
     def config_logging(self):
@@ -82,16 +120,34 @@ class Main:
             # Windows can't have colons in the time part -- invalid filename
             filename = filename.replace(":", "-")
             Path(filename).parent.mkdir(parents=True, exist_ok=True)
-            logging.basicConfig(level=logging.getLevelName(self.get_param(logging_config, "level")),
-                                filename=filename,
-                                filemode=self.get_param(
-                                    logging_config, "filemode"),
-                                format=self.get_param(logging_config, "format"))
+            self.log_dir = str(Path(filename).parent)
+            LogUtils.configure(filename=filename,
+                               filemode=self.get_param(
+                                   logging_config, "filemode", "w"),
+                               level=self.get_param(
+                                   logging_config, "level", "INFO"),
+                               fmt=self.get_param(logging_config, "format"),
+                               json_format=self.get_param(
+                                   logging_config, "json", False),
+                               queued=self.get_param(
+                                   logging_config, "queue", True),
+                               traceback_limit=self.get_param(
+                                   logging_config, "traceback_limit", None),
+                               traceback_interval=self.get_param(logging_config, "traceback_interval", 60))
         except:
             print("Cannot initialize logging system.")
 
+    # the HttpUtils for downloading, set up on first use
+    def get_http_utils(self):
+        if self.http_utils is None:
+            self.config_http()
+        return self.http_utils
+
     # init http subsystem
     def config_http(self):
+        from pkiccu.http_utils import HttpUtils
+        import tempfile
+        import certifi
         http_config = self.get_param(self.config, "http", {})
         retries = self.get_param(http_config, "retries", 5)
         timeout = self.get_param(http_config, "timeout", 5)
@@ -153,6 +209,7 @@ class Main:
 
     # do the DISA downloading step
     def download_disa(self):
+        from pkiccu.disa_downloader import DisaDownloader
         envs = self.get_param(self.config, "disa_downloader", {})
         # can be multiple configs in here for prod and jitc.
         for env_name in envs.keys():
@@ -176,6 +233,8 @@ class Main:
                     download_crls = self.get_param(env, "download_crls", True)
                     use_all_crl_zip = self.get_param(
                         env, "use_all_crl_zip", True)
+                    crl_max_age = self.get_param(
+                        env, "crl_max_age", 24)
                     archive_crl_zips = self.get_param(
                         env, "archive_crl_zips", True)
                     crl_zip_archive_dir = None
@@ -183,9 +242,24 @@ class Main:
                         crl_zip_archive_dir = self.get_param(
                             env, "crl_zip_archive_dir", f'{data_dir}/crl_zips')
 
+                category_weights = self.get_param(
+                    env, "category_weights", None)
+                quarantine_dir = self.get_param(
+                    env, "quarantine_dir", None)
+                validate_chains = self.get_param(
+                    env, "validate_chains", False)
+                validate_categories = self.get_param(
+                    env, "validate_categories", None)
+                validation_workers = self.get_param(
+                    env, "validation_workers", None)
+                check_crl_signature = self.get_param(
+                    env, "check_crl_signature", False)
+
                 if data_dir:
                     downloader = DisaDownloader(
-                        base_dir=data_dir, url_disa=disa_url, http_utils=self.http_utils)
+                        base_dir=data_dir, url_disa=disa_url, http_utils=self.get_http_utils(), catalog=self.catalog,
+                        deadline=self.deadline, category_weights=category_weights,
+                        quarantine_dir=quarantine_dir)
 
                     if download_certs:
                         if self.noprogress() != True:
@@ -202,12 +276,42 @@ class Main:
                                 f"\nDOWNLOADING DOD CRLS ({env_name.upper()})...\n")
                         logging.info(
                             f"DOWNLOADING DOD CRLS ({env_name.upper()})...")
-                        if use_all_crl_zip:
+                        if str(use_all_crl_zip).lower() == "auto":
+                            downloader.download_crls_auto(
+                                crl_zip_archive_dir=crl_zip_archive_dir, noprogress=self.noprogress(),
+                                check_parse=check_crl_parse, max_age=crl_max_age)
+                        elif use_all_crl_zip:
                             downloader.download_crls_zip(
                                 crl_zip_archive_dir=crl_zip_archive_dir, noprogress=self.noprogress(), check_parse=check_crl_parse)
                         else:
                             downloader.download_crls(
                                 noprogress=self.noprogress(), check_parse=check_crl_parse)
+
+                    if validate_chains:
+                        if self.noprogress() != True:
+                            print(
+                                f"\nVALIDATING CERT CHAINS ({env_name.upper()})...\n")
+                        logging.info(
+                            f"VALIDATING CERT CHAINS ({env_name.upper()})...")
+                        downloader.validate_chains(categories=validate_categories,
+                                                   max_workers=validation_workers)
+
+                    if check_crl_signature:
+                        if self.noprogress() != True:
+                            print(
+                                f"\nCHECKING CRL SIGNATURES ({env_name.upper()})...\n")
+                        logging.info(
+                            f"CHECKING CRL SIGNATURES ({env_name.upper()})...")
+                        downloader.check_crl_signatures(
+                            max_workers=validation_workers)
+
+                    self.deadline_skipped.extend(
+                        f"{env_name}: {item}" for item in downloader.skipped)
+
+                    # pick up files that weren't downloaded (e.g. roots copied in
+                    # by hand) and drop ones that were removed
+                    if self.catalog:
+                        self.catalog.scan_dir(data_dir)
             except BaseException as e:
                 logging.exception(
                     f"Error downloading DoD info ({env_name.upper()}): : {str(e)}")
@@ -215,6 +319,7 @@ class Main:
 
     # Do the URL downloaind step
     def url_download(self):
+        from pkiccu.url_downloader import UrlDownloader
         try:
             url_download = self.get_param(
                 self.config, "url_downloader.url_download", True)
@@ -222,7 +327,8 @@ class Main:
                 downloads = self.get_param(
                     self.config, "url_downloader.downloads")
                 if downloads:
-                    url_downloader = UrlDownloader(http_utils=self.http_utils)
+                    url_downloader = UrlDownloader(
+                        http_utils=self.get_http_utils(), catalog=self.catalog)
                     if self.noprogress() != True:
                         print("\nDOWNLOADING OTHER FILES...\n")
                     logging.info("DOWNLOADING OTHER FILES...")
@@ -235,6 +341,10 @@ class Main:
     # do the cert bundle creation step
 
     def make_bundles(self):
+        from pkiccu.cert_bundler import CertBundler
+        from pkiccu.cert_cache import CertCache
+        from pkiccu.dir_index import DirIndex
+        from pkiccu.catalog import Catalog
         try:
             cert_bundler = self.get_param(self.config, "cert_bundler", {})
             make_bundles = self.get_param(cert_bundler, "make_bundles", False)
@@ -246,6 +356,15 @@ class Main:
                         print("\nMAKING CERT BUNDLES...\n")
                     logging.info(
                         f"MAKING CERT BUNDLES...")
+                    # bundles overlap a lot, so share parsed certs between them
+                    cert_cache = CertCache(self.get_param(
+                        cert_bundler, "cert_cache_file", None))
+                    # and share directory listings too, the same source
+                    # directories are in most bundles
+                    dir_index = DirIndex(self.get_param(
+                        cert_bundler, "dir_index_file", None))
+                    dir_index.load()
+                    self.changed_bundles = {}
                     for bundle_name in bundles.keys():
                         try:
                             logging.info(
@@ -260,21 +379,43 @@ class Main:
                             sources = self.get_param(
                                 bundle, "sources", None)
                             if isinstance(filename, str) and isinstance(sources, list):
+                                bundle_type = self.get_param(
+                                    bundle, "type", CertBundler.TYPE_CERT)
+                                bundle_format = self.get_param(
+                                    bundle, "format", CertBundler.FORMAT_FILE)
                                 match = self.get_param(
-                                    bundle, "match", r"*.cer")
+                                    bundle, "match", r"*.crl" if bundle_type == CertBundler.TYPE_CRL else r"*.cer")
+                                dedupe = self.get_param(
+                                    bundle, "dedupe", None)
+                                drop_expired = self.get_param(
+                                    bundle, "drop_expired", False)
                                 Path(filename).parent.mkdir(
                                     parents=True, exist_ok=True)
-                                CertBundler.write_bundle(fn_bundle=filename,
-                                                         src_list=sources, match=match, recursive=recursive)
+                                changed = CertBundler.write_bundle(fn_bundle=filename,
+                                                                   src_list=sources, match=match, recursive=recursive,
+                                                                   cert_cache=cert_cache, dedupe=dedupe,
+                                                                   drop_expired=drop_expired, bundle_type=bundle_type,
+                                                                   bundle_format=bundle_format, dir_index=dir_index)
+                                self.changed_bundles[bundle_name] = changed
+                                if self.catalog and bundle_format == CertBundler.FORMAT_FILE:
+                                    self.catalog.update_file(
+                                        filename, kind=Catalog.KIND_BUNDLE, category="bundle")
                         except BaseException as ex:
                             logging.exception(
                                 f"Error making bundle '{bundle_name}': {str(ex)}")
+                    cert_cache.save()
+                    cert_cache.log_stats()
+                    dir_index.prune()
+                    dir_index.save()
+                    logging.info(
+                        f"Directory index: {dir_index.scanned} directories read, {dir_index.reused} reused")
         except BaseException as e:
             logging.exception(f"Error making bundles: {str(e)}")
             print(str(e))
 
     # do the script running step
     def run_scripts(self):
+        from pkiccu.script_runner import ScriptRunner
         try:
             script_runner = self.get_param(self.config, "script_runner", {})
             run_scripts = self.get_param(script_runner, "run_scripts", False)
@@ -283,54 +424,344 @@ class Main:
                 if run_list and isinstance(run_list, list):
                     if self.noprogress() != True:
                         print("\nRUNNING USER SCRIPTS...\n")
-                    ScriptRunner.run_scripts(run_list)
+                    max_workers = self.get_param(
+                        script_runner, "max_workers", 1)
+                    state_file = self.get_param(
+                        script_runner, "state_file", None)
+                    self.script_results = ScriptRunner.run_scripts(
+                        run_list, noprogress=self.noprogress(), changed_bundles=self.changed_bundles, max_workers=max_workers, state_file=state_file)
         except BaseException as e:
             logging.exception(f"Error running scripts: {str(e)}")
             print(str(e))
 
+    # print catalog rows as tab separated columns
+    def print_rows(self, rows: list, columns: list):
+        for row in rows:
+            print("\t".join(str(row[column]) if row[column] is not None else "-"
+                            for column in columns))
+
+    # answer a "pkiccu query" from the catalog
+    def query(self) -> int:
+        exit_status_return: int = 0
+        self.load_config()
+        self.config_catalog()
+        if not self.catalog:
+            raise RuntimeError(
+                "The catalog is not enabled in the config file.")
+        if self.args.get("expiring") is not None:
+            self.print_rows(self.catalog.query_expiring(self.args.get("expiring")),
+                            ["not_after", "category", "subject", "path"])
+        elif self.args.get("stale_crls") is not None:
+            self.print_rows(self.catalog.query_stale_crls(self.args.get("stale_crls")),
+                            ["next_update", "category", "issuer", "path"])
+        elif self.args.get("ca"):
+            self.print_rows(self.catalog.query_ca(self.args.get("ca")),
+                            ["kind", "category", "not_after", "next_update", "subject", "issuer", "path"])
+        elif self.args.get("changed"):
+            self.print_rows(self.catalog.query_changed(),
+                            ["last_changed", "kind", "category", "path"])
+        elif self.args.get("sql"):
+            rows = self.catalog.query_sql(self.args.get("sql"))
+            if rows:
+                self.print_rows(rows, rows[0].keys())
+        else:
+            print("Nothing to query.  See 'query --help'.")
+            exit_status_return = 1
+        return exit_status_return
+
+    # files and directories a stage writes to, for the stage's results
+    def get_stage_paths(self, stage: str) -> list:
+        list_return = []
+        if stage == "disa_download":
+            envs = self.get_param(self.config, "disa_downloader", {}) or {}
+            list_return = [self.get_param(env, "data_dir", None)
+                           for env in envs.values()]
+        elif stage == "url_download":
+            downloads = self.get_param(
+                self.config, "url_downloader.downloads", []) or []
+            list_return = [download.get("dst") for download in downloads
+                           if isinstance(download, dict)]
+        elif stage == "bundles":
+            bundles = self.get_param(
+                self.config, "cert_bundler.bundles", {}) or {}
+            list_return = [self.get_param(bundle, "filename", None)
+                           for bundle in bundles.values()]
+        elif stage == "scripts":
+            # scripts can change the data too, and the Merkle manifest has to
+            # know about it
+            list_return = [self.get_param(
+                self.config, "merkle.root", None)]
+        return list_return
+
+    # Run a stage, recording its result in self.stage_results and profiling
+    # it if asked to
+    def run_stage(self, stage: str, func):
+        LogUtils.stage = stage
+        with StageRecorder(stage, self.get_stage_paths(stage), self.stage_results) as recorder:
+            if self.args.get("profile", False):
+                from pkiccu.stage_profiler import StageProfiler
+                with StageProfiler(stage, out_dir=self.log_dir,
+                                   memory=self.args.get(
+                                       "profile_memory", False),
+                                   top=self.args.get("profile_top", 25)):
+                    func()
+            else:
+                func()
+            if stage == "bundles" and self.changed_bundles is not None:
+                recorder.result["details"]["changed_bundles"] = self.changed_bundles
+            elif stage == "scripts" and self.script_results is not None:
+                recorder.result["details"]["scripts"] = self.script_results
+            elif stage == "disa_download" and self.deadline_skipped:
+                recorder.result["details"]["deadline_skipped"] = self.deadline_skipped
+        self.touched_files.extend(recorder.touched)
+        LogUtils.stage = None
+
+    # run the "pkiccu serve" mirror server until interrupted
+    def serve(self) -> int:
+        from pkiccu.mirror_server import MirrorServer
+        self.load_config()
+        self.config_logging()
+        mirror_config = self.get_param(self.config, "mirror", {})
+        root = self.args.get("root") or self.get_param(
+            mirror_config, "root", None)
+        if not root or not Path(root).is_dir():
+            raise RuntimeError(
+                f"Mirror root directory '{root}' does not exist.")
+        bind = self.args.get("bind") or self.get_param(
+            mirror_config, "bind", "")
+        port = self.args.get("port") or self.get_param(
+            mirror_config, "port", 8080)
+        server = MirrorServer(root, bind=bind, port=port,
+                              exclude=self.get_param(mirror_config, "exclude", []))
+        print(f"Serving '{root}' on http://{bind or '0.0.0.0'}:{port}/ (Ctrl-C to stop)")
+        logging.info(f"Serving mirror of '{root}' on {bind or '*'}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    # answer a "pkiccu sync" from another node's Merkle manifest
+    def sync(self) -> int:
+        from pkiccu.url_downloader import UrlDownloader
+        self.load_config()
+        self.config_logging()
+        self.config_catalog()
+        source = self.args.get("from")
+        dst = self.args.get("to") or self.get_param(
+            self.config, "merkle.root", None)
+        if not dst:
+            raise RuntimeError(
+                "No directory to sync into.  Use --to or set merkle.root in the config file.")
+        url_downloader = UrlDownloader(
+            http_utils=self.get_http_utils() if UrlDownloader.is_url(source) else None,
+            catalog=self.catalog)
+        result = url_downloader.sync_merkle(source, dst, delete=self.args.get("delete", False),
+                                            noprogress=self.noprogress())
+        print(f"Synced '{dst}' from '{source}': {result.get('downloaded')} downloaded, "
+              f"{result.get('removed')} removed, {result.get('failed')} failed")
+        return 1 if result.get("failed") else 0
+
+    # answer a "pkiccu snapshot export" or "pkiccu snapshot import"
+    def snapshot(self) -> int:
+        from pkiccu.snapshot import Snapshot
+        self.load_config()
+        self.config_logging()
+        dirs = self.get_param(self.config, "snapshot.dirs", {})
+        if not dirs:
+            raise RuntimeError(
+                "No snapshot directories are set in the config file.")
+        if self.args.get("snapshot_command") == "export":
+            manifest = Snapshot.export(dirs, self.args.get(
+                "output"), base_fn=self.args.get("base"))
+            print(f"Wrote snapshot '{self.args.get('output')}' ({manifest.get('id')})")
+        else:
+            self.config_catalog()
+            result = Snapshot.import_snapshot(dirs, self.args.get("file"))
+            if self.catalog:
+                for fn in result.get("touched"):
+                    if Path(fn).is_file():
+                        self.catalog.update_file(
+                            fn, source_url=self.args.get("file"))
+                    else:
+                        self.catalog.remove_file(fn)
+            self.touched_files = result.get("touched")
+            self.update_merkle()
+            print(f"Imported snapshot '{self.args.get('file')}': {result.get('added')} added, "
+                  f"{result.get('changed')} changed, {result.get('removed')} removed")
+        return 0
+
+    # Run the stages (all of them if stages is None) that are enabled by the
+    # program arguments.  Returns true if none of them had errors.
+    def run(self, stages: list = None) -> bool:
+        self.stage_results = []
+        self.touched_files = []
+        Metrics.reset()
+        time_start = time.monotonic()
+        self.deadline_skipped = []
+        self.deadline = None
+        deadline = self.get_param(self.config, "deadline", None)
+        if deadline:
+            self.deadline = time_start + float(deadline) * 60
+        logging.info(f"Starting...")
+        if self.catalog:
+            self.catalog.begin_run()
+
+        def enabled(stage: str, arg_disable: str = None) -> bool:
+            return (stages is None or stage in stages) and \
+                (not arg_disable or not self.args.get(arg_disable, False))
+
+        # STEP 1: download from DISA
+        if enabled("disa_download"):
+            self.run_stage("disa_download", self.download_disa)
+
+        # STEP 2: download from URLs
+        if enabled("url_download", "nourldownload"):
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                logging.warning("Deadline reached, skipped the URL downloads")
+                self.deadline_skipped.append("url_download")
+            else:
+                self.run_stage("url_download", self.url_download)
+
+        # STEP 3: make cert bundles
+        if enabled("bundles", "nobundles"):
+            self.run_stage("bundles", self.make_bundles)
+
+        # STEP 3b: publish the results as a new generation, before the
+        # scripts so they see it
+        self.publish_generation()
+
+        # STEP 4: run integration scripts
+        if enabled("scripts", "noscripts"):
+            self.run_stage("scripts", self.run_scripts)
+
+        # STEP 5: update the Merkle manifest with what the run changed
+        self.update_merkle()
+
+        Metrics.set("pkiccu_deadline_skipped", len(self.deadline_skipped))
+        if self.deadline_skipped:
+            print(f"Deadline reached, {len(self.deadline_skipped)} downloads were skipped",
+                  file=sys.stderr)
+        self.write_metrics(time.monotonic() - time_start)
+
+        if self.noprogress() != True:
+            print("\nDone.\n")
+        logging.info(f"Done...")
+        if self.catalog:
+            self.catalog.end_run()
+        return all(result.get("ok") for result in self.stage_results)
+
+    # hard link the data into a new generation and switch the current
+    # symlink to it, if generations are enabled and the run changed anything
+    def publish_generation(self):
+        gen_config = self.get_param(self.config, "generations", {})
+        if self.get_param(gen_config, "enabled", False):
+            from pkiccu.generations import Generations
+            try:
+                generations = Generations(self.get_param(gen_config, "dirs", {}),
+                                          self.get_param(
+                                              gen_config, "dir", "generations"),
+                                          self.get_param(
+                                              gen_config, "current", "current"),
+                                          keep=self.get_param(gen_config, "keep", 3))
+                if self.touched_files or generations.get_current() is None:
+                    name = generations.publish()
+                    logging.info(f"Published generation '{name}'")
+                else:
+                    logging.info(
+                        "Nothing changed, not publishing a new generation")
+                generations.collect_garbage()
+            except BaseException as e:
+                logging.exception(
+                    f"Error publishing a new generation: {str(e)}")
+                print(str(e), file=sys.stderr)
+
+    # bring the Merkle manifest of merkle.root up to date, only looking at
+    # the files this run touched unless merkle.full_scan is set
+    def update_merkle(self):
+        root = self.get_param(self.config, "merkle.root", None)
+        if root:
+            from pkiccu.merkle_manifest import MerkleManifest
+            try:
+                Path(root).mkdir(parents=True, exist_ok=True)
+                merkle = MerkleManifest(root)
+                full_scan = not merkle.load() or self.get_param(
+                    self.config, "merkle.full_scan", False)
+                with Metrics.timer("pkiccu_merkle_update_seconds"):
+                    digest = merkle.update(
+                        None if full_scan else self.touched_files)
+                merkle.save()
+                logging.info(
+                    f"Merkle manifest of '{root}' has root {digest} ({merkle.nodes_written} new nodes)")
+            except BaseException as e:
+                logging.exception(
+                    f"Error updating the Merkle manifest of '{root}': {str(e)}")
+                print(str(e), file=sys.stderr)
+
+    # write the run's metrics to the files named in the config
+    def write_metrics(self, duration: float):
+        metrics_config = self.get_param(self.config, "metrics", {})
+        json_file = self.get_param(metrics_config, "json_file", None)
+        prometheus_file = self.get_param(
+            metrics_config, "prometheus_file", None)
+        if json_file or prometheus_file:
+            try:
+                Metrics.record_stages(self.stage_results, duration)
+                if json_file:
+                    Metrics.write_json(json_file)
+                if prometheus_file:
+                    Metrics.write_prometheus(prometheus_file)
+            except BaseException as e:
+                logging.exception(f"Error writing metrics: {str(e)}")
+
+    # release what init() set up
+    def close(self):
+        if self.catalog:
+            self.catalog.close()
+            self.catalog = None
+        # remove temp file possible created in self.config_http()
+        if self.temp_ca_file and Path(self.temp_ca_file).exists():
+            try:
+                os.remove(self.temp_ca_file)
+            except:
+                pass
+        # write out log records still queued
+        LogUtils.shutdown()
+
     # Primary entry point
     def main(self) -> int:
         exist_status_return: int = 0
         # Parse program arguments
         self.args = ArgUtils.parse()
+        if self.args.get("command") in ("query", "serve", "sync", "snapshot"):
+            try:
+                if self.args.get("command") == "query":
+                    exist_status_return = self.query()
+                elif self.args.get("command") == "serve":
+                    exist_status_return = self.serve()
+                elif self.args.get("command") == "sync":
+                    exist_status_return = self.sync()
+                else:
+                    exist_status_return = self.snapshot()
+            except BaseException as e:
+                print(str(e))
+                exist_status_return = 1
+            finally:
+                self.close()
+            return exist_status_return
         try:
             # Initialize the main program
             self.init()
 
-            logging.info(f"Starting...")
-
-            # STEP 1: download from DISA
-            self.download_disa()
-
-            # STEP 2: download from URLs
-            url_download = not self.args.get("nourldownload", False)
-            if url_download:
-                self.url_download()
-
-            # STEP 3: make cert bundles
-            make_bundles = not self.args.get("nobundles", False)
-            if make_bundles:
-                self.make_bundles()
-
-            # STEP 4: run integration scripts
-            run_scripts = not self.args.get("noscripts", False)
-            if run_scripts:
-                self.run_scripts()
-
-            if self.noprogress() != True:
-                print("\nDone.\n")
-            logging.info(f"Done...")
+            self.run()
         except BaseException as e:
             logging.exception(f"An error occurred.: {str(e)}")
             print(str(e))
             exist_status_return = 1
         finally:
-            # remove temp file possible created in self.config_http()
-            if self.temp_ca_file and Path(self.temp_ca_file).exists():
-                try:
-                    os.remove(self.temp_ca_file)
-                except:
-                    pass
+            self.close()
         return exist_status_return
 
 
@@ -338,4 +769,8 @@ class Main:
 # Actually call Main.go()
 ###
 if __name__ == '__main__':
+    # signature checks run in a process pool, which needs this when frozen
+    # by PyInstaller
+    import multiprocessing
+    multiprocessing.freeze_support()
     sys.exit(Main().main())
@@ -0,0 +1,250 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from datetime import datetime
+from pkiccu.file_manifest import FileManifest
+from pkiccu.file_utils import FileUtils
+import hashlib
+import json
+import os
+
+
+class MerkleManifest:
+    """
+    A hierarchical hash manifest (Merkle tree) of a directory tree, kept in a
+    hidden .pkiccu_merkle directory at the top of the tree:
+
+      root.json        {"root": digest of the top directory, "generated": time}
+      nodes/<d>.json   the entries of the directory whose digest is <d>:
+                       {name: {"type": "file", "size": n, "sha256": digest}
+                        or {"type": "dir", "sha256": digest}}
+      state.json       local bookkeeping, never published
+
+    A directory's digest is the SHA-256 of its node file, so a node can be
+    checked against the digest it was asked for, and two trees are the same
+    if their root digests are.  Syncing compares the roots and only walks
+    into the directories whose digests differ.
+
+    update() with a list of touched paths only rehashes those files and rolls
+    up the directories above them.  Without it every file is checked, which
+    costs one stat() per unchanged file.  Hidden files aren't included.
+    """
+
+    DIR_NAME = ".pkiccu_merkle"
+    ROOT_FILE = "root.json"
+    NODES_DIR = "nodes"
+    STATE_FILE = "state.json"
+
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+        self.path_dir = self.root / MerkleManifest.DIR_NAME
+        self.manifest = FileManifest(
+            str(self.path_dir / MerkleManifest.STATE_FILE))
+        # {relative dir ("" for the top): {name: entry}}
+        self.dirs = {}
+        # {relative dir: digest}
+        self.digests = {}
+        self.nodes_written = 0
+
+    # the digest of the canonical JSON of a directory's entries, and the JSON
+    def hash_entries(entries: dict) -> tuple:
+        node = json.dumps(entries, sort_keys=True,
+                          separators=(",", ":")).encode("utf-8")
+        return hashlib.sha256(node).hexdigest(), node
+
+    # path of a node relative to the top of a tree, e.g. for a mirror URL
+    def get_node_path(digest: str) -> str:
+        return f"{MerkleManifest.DIR_NAME}/{MerkleManifest.NODES_DIR}/{digest}.json"
+
+    def get_root_path() -> str:
+        return f"{MerkleManifest.DIR_NAME}/{MerkleManifest.ROOT_FILE}"
+
+    # is a path relative to the top of a tree part of what's published?
+    def is_published(path_rel: str) -> bool:
+        return path_rel == MerkleManifest.get_root_path() or \
+            (path_rel.startswith(f"{MerkleManifest.DIR_NAME}/{MerkleManifest.NODES_DIR}/")
+             and path_rel.count("/") == 2)
+
+    def get_root(self) -> str:
+        return self.digests.get("")
+
+    def load(self) -> bool:
+        bool_return = self.manifest.load()
+        self.dirs = self.manifest.data.get("dirs", {})
+        self.digests = self.manifest.data.get("digests", {})
+        return bool_return and "" in self.digests
+
+    def save(self):
+        self.path_dir.mkdir(parents=True, exist_ok=True)
+        with FileUtils.open_atomic(str(self.path_dir / MerkleManifest.ROOT_FILE), "w") as file:
+            json.dump({"root": self.get_root(),
+                       "generated": datetime.now().isoformat()}, file)
+        self.prune_nodes()
+        self.manifest.data["dirs"] = self.dirs
+        self.manifest.data["digests"] = self.digests
+        self.manifest.save()
+
+    # Bring the manifest up to date.  With touched (files or directories that
+    # were added, changed or removed) only those are looked at, otherwise, or
+    # if there's no manifest yet, the whole tree is.  Returns the root digest.
+    def update(self, touched: list = None) -> str:
+        self.nodes_written = 0
+        if touched is None or "" not in self.digests:
+            self.dirs = {}
+            self.digests = {}
+            dirty = self.__scan_dir("")
+            self.manifest.prune([str(self.root / dn_rel / name)
+                                 for dn_rel, entries in self.dirs.items()
+                                 for name, entry in entries.items() if entry.get("type") == "file"])
+        else:
+            dirty = set()
+            for path in touched:
+                path_rel = self.get_relative(path)
+                if path_rel:
+                    dirty |= self.__update_path(path_rel)
+        self.__roll_up(dirty)
+        return self.get_root()
+
+    # the path relative to the top of the tree, or None if it's outside of
+    # it or hidden
+    def get_relative(self, path: str) -> str:
+        path = os.path.abspath(str(path))
+        try:
+            path_rel = Path(os.path.realpath(os.path.dirname(path)), os.path.basename(path)).relative_to(
+                self.root).as_posix()
+        except ValueError:
+            return None
+        if path_rel == "." or any(part.startswith(".") for part in path_rel.split("/")):
+            return None
+        return path_rel
+
+    def __get_file_entry(self, path_rel: str) -> dict:
+        entry = self.manifest.get_entry(str(self.root / path_rel))
+        return {"type": "file", "size": entry.get("size"), "sha256": entry.get("sha256")}
+
+    # record a whole directory (and everything under it), returning the
+    # directories that need their digests computed
+    def __scan_dir(self, dir_rel: str) -> set:
+        set_return = set()
+        stack = [dir_rel]
+        while stack:
+            dn_rel = stack.pop()
+            entries = {}
+            with os.scandir(str(self.root / dn_rel)) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name.startswith("."):
+                        continue
+                    path_rel = f"{dn_rel}/{dir_entry.name}" if dn_rel else dir_entry.name
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        entries[dir_entry.name] = {"type": "dir", "sha256": None}
+                        stack.append(path_rel)
+                    elif dir_entry.is_file():
+                        entries[dir_entry.name] = self.__get_file_entry(
+                            path_rel)
+            self.dirs[dn_rel] = entries
+            set_return.add(dn_rel)
+        return set_return
+
+    def __remove_dir(self, dir_rel: str):
+        prefix = dir_rel + "/"
+        for dn_rel in [dn for dn in self.dirs if dn == dir_rel or dn.startswith(prefix)]:
+            for name, entry in self.dirs.pop(dn_rel).items():
+                if entry.get("type") == "file":
+                    self.manifest.files.pop(
+                        str(self.root / dn_rel / name), None)
+            self.digests.pop(dn_rel, None)
+
+    # record a change to one path, returning the directories that need their
+    # digests computed again
+    def __update_path(self, path_rel: str) -> set:
+        set_return = set()
+        parent_rel, _, name = path_rel.rpartition("/")
+        path = self.root / path_rel
+        if path.is_dir() and not path.is_symlink():
+            self.__remove_dir(path_rel)
+            set_return |= self.__scan_dir(path_rel)
+            entry = {"type": "dir", "sha256": None}
+        elif path.is_file():
+            if path_rel in self.dirs:
+                self.__remove_dir(path_rel)
+            entry = self.__get_file_entry(path_rel)
+        else:
+            entry = None
+            self.__remove_dir(path_rel)
+            self.manifest.files.pop(str(path), None)
+        # put the entry in its directory, and the directories in theirs
+        while True:
+            entries = self.dirs.setdefault(parent_rel, {})
+            if entry is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = entry
+            set_return.add(parent_rel)
+            if parent_rel == "":
+                break
+            if (self.root / parent_rel).is_dir():
+                entry = {"type": "dir", "sha256": None}
+            else:
+                # the directory is gone too
+                self.__remove_dir(parent_rel)
+                entry = None
+            parent_rel, _, name = parent_rel.rpartition("/")
+        return set_return
+
+    # compute the digests of the dirty directories, deepest first so the
+    # digests of subdirectories are known, and write their nodes
+    def __roll_up(self, dirty: set):
+        path_nodes = self.path_dir / MerkleManifest.NODES_DIR
+        path_nodes.mkdir(parents=True, exist_ok=True)
+        for dn_rel in sorted((dn for dn in dirty if dn in self.dirs),
+                             key=lambda dn: -1 if dn == "" else dn.count("/"), reverse=True):
+            entries = self.dirs.get(dn_rel)
+            for name, entry in list(entries.items()):
+                if entry.get("type") == "dir":
+                    sub_rel = f"{dn_rel}/{name}" if dn_rel else name
+                    if not (self.root / sub_rel).is_dir():
+                        # removed along with everything in it, which for an
+                        # empty directory isn't in the touched list
+                        self.__remove_dir(sub_rel)
+                        del entries[name]
+                    else:
+                        entry["sha256"] = self.digests.get(sub_rel)
+            digest, node = MerkleManifest.hash_entries(entries)
+            self.digests[dn_rel] = digest
+            path_node = path_nodes / f"{digest}.json"
+            if not path_node.exists():
+                with FileUtils.open_atomic(str(path_node), "wb") as file:
+                    file.write(node)
+                self.nodes_written += 1
+
+    # remove nodes that aren't in the tree anymore.  The nodes of the previous
+    # tree are kept too so a sync that's walking it doesn't lose them.
+    def prune_nodes(self):
+        current = set(self.digests.values())
+        keep = current | set(self.manifest.data.get("previous_nodes", []))
+        path_nodes = self.path_dir / MerkleManifest.NODES_DIR
+        if path_nodes.is_dir():
+            with os.scandir(str(path_nodes)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.name[:-5] not in keep:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+        self.manifest.data["previous_nodes"] = sorted(current)
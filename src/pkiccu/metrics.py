@@ -0,0 +1,198 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pkiccu.file_utils import FileUtils
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import copy
+import json
+import time
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms collected during a run, written at the
+    end of the run as a JSON report and/or a Prometheus node_exporter textfile.
+    Metrics are kept at the class level so any module can record them without
+    passing an object around.  Each metric is identified by its name and
+    labels, e.g. Metrics.inc("pkiccu_http_requests_total", host="x", status=200).
+    """
+
+    # latency buckets in seconds
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+    HELP = {
+        "pkiccu_http_requests_total": "HTTP requests by host and status",
+        "pkiccu_http_retries_total": "HTTP request and download retries by host",
+        "pkiccu_http_bytes_total": "Bytes downloaded by host",
+        "pkiccu_http_request_seconds": "Time until HTTP response headers by host",
+        "pkiccu_files_total": "Files handled by a stage by kind and result",
+        "pkiccu_parse_seconds": "Time spent parsing certs and CRLs",
+        "pkiccu_bundle_bytes": "Size of each bundle file",
+        "pkiccu_bundle_entries": "Certs or CRLs in each bundle",
+        "pkiccu_bundle_changed": "1 if the bundle was rewritten this run",
+        "pkiccu_script_seconds": "Wall time of each user script",
+        "pkiccu_script_cpu_seconds": "CPU time of each user script",
+        "pkiccu_script_max_rss_bound_bytes": "Upper bound of each user script's peak RSS, includes PKICCU's memory at the fork",
+        "pkiccu_script_exit_code": "Exit code of each user script",
+        "pkiccu_stage_seconds": "Duration of each stage",
+        "pkiccu_stage_ok": "1 if the stage ran without errors",
+        "pkiccu_stage_files": "Files under a stage's paths by state",
+        "pkiccu_stage_bytes": "Bytes of the files a stage added or changed",
+        "pkiccu_crl_strategy_estimate_seconds": "Estimated time of each CRL download strategy",
+        "pkiccu_deadline_skipped": "Downloads skipped because the run's deadline passed",
+        "pkiccu_crls_stale": "CRLs that were stale before the download",
+        "pkiccu_merkle_update_seconds": "Time to update the Merkle manifest",
+        "pkiccu_run_seconds": "Duration of the run",
+        "pkiccu_run_ok": "1 if the run had no errors",
+        "pkiccu_run_timestamp_seconds": "Unix time the run finished",
+    }
+
+    lock = threading.Lock()
+    counters = {}
+    gauges = {}
+    histograms = {}
+
+    def reset():
+        with Metrics.lock:
+            Metrics.counters = {}
+            Metrics.gauges = {}
+            Metrics.histograms = {}
+
+    def __key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None)))
+
+    def inc(name: str, value: float = 1, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + value
+
+    def set(name: str, value: float, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            Metrics.gauges[key] = value
+
+    def observe(name: str, value: float, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            histogram = Metrics.histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(Metrics.BUCKETS),
+                             "count": 0,
+                             "sum": 0.0}
+                Metrics.histograms[key] = histogram
+            for i, bound in enumerate(Metrics.BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    # a copy of a histogram (count, sum and buckets), or None
+    def get_histogram(name: str, **labels) -> dict:
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            histogram = Metrics.histograms.get(key)
+            return copy.deepcopy(histogram) if histogram else None
+
+    # observe how long a "with" block takes
+    @contextmanager
+    def timer(name: str, **labels):
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            Metrics.observe(name, time.monotonic() - time_start, **labels)
+
+    def to_dict() -> dict:
+        with Metrics.lock:
+            return {"time": datetime.now().isoformat(),
+                    "counters": [{"name": name, "labels": dict(labels), "value": value}
+                                 for (name, labels), value in sorted(Metrics.counters.items())],
+                    "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                               for (name, labels), value in sorted(Metrics.gauges.items())],
+                    "histograms": [{"name": name, "labels": dict(labels),
+                                    "buckets": dict(zip([str(bound) for bound in Metrics.BUCKETS], histogram.get("buckets"))),
+                                    "count": histogram.get("count"), "sum": histogram.get("sum")}
+                                   for (name, labels), histogram in sorted(Metrics.histograms.items())]}
+
+    def write_json(fn: str):
+        with FileUtils.open_atomic(fn, "w") as file:
+            json.dump(Metrics.to_dict(), file, indent=1)
+
+    def __format_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        escaped = [(key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                   for key, value in items]
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    # Prometheus text exposition format, for node_exporter's textfile
+    # collector.  The file is replaced atomically so the collector never
+    # reads half of it.
+    def to_prometheus() -> str:
+        lines = []
+        with Metrics.lock:
+            families = {}
+            for kind, metrics in (("counter", Metrics.counters), ("gauge", Metrics.gauges), ("histogram", Metrics.histograms)):
+                for (name, labels), value in metrics.items():
+                    families.setdefault(name, (kind, []))[1].append(
+                        (labels, value))
+            for name in sorted(families.keys()):
+                kind, samples = families.get(name)
+                lines.append(
+                    f"# HELP {name} {Metrics.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(samples, key=lambda sample: sample[0]):
+                    if kind == "histogram":
+                        for bound, count in zip(Metrics.BUCKETS, value.get("buckets")):
+                            lines.append(
+                                f"{name}_bucket{Metrics.__format_labels(labels, (('le', str(bound)),))} {count}")
+                        lines.append(
+                            f"{name}_bucket{Metrics.__format_labels(labels, (('le', '+Inf'),))} {value.get('count')}")
+                        lines.append(
+                            f"{name}_sum{Metrics.__format_labels(labels)} {value.get('sum')}")
+                        lines.append(
+                            f"{name}_count{Metrics.__format_labels(labels)} {value.get('count')}")
+                    else:
+                        lines.append(
+                            f"{name}{Metrics.__format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(fn: str):
+        with FileUtils.open_atomic(fn, "w") as file:
+            file.write(Metrics.to_prometheus())
+
+    # record the StageRecorder results of a run
+    def record_stages(stage_results: list, duration: float):
+        for result in stage_results:
+            stage = result.get("stage")
+            Metrics.set("pkiccu_stage_seconds",
+                        result.get("duration"), stage=stage)
+            Metrics.set("pkiccu_stage_ok", 1 if result.get("ok")
+                        else 0, stage=stage)
+            Metrics.set("pkiccu_stage_bytes",
+                        result.get("bytes"), stage=stage)
+            for state in ("added", "changed", "removed", "unchanged"):
+                Metrics.set("pkiccu_stage_files", result.get(
+                    f"files_{state}"), stage=stage, state=state)
+        Metrics.set("pkiccu_run_seconds", duration)
+        Metrics.set("pkiccu_run_ok", 1 if all(result.get("ok")
+                                              for result in stage_results) else 0)
+        Metrics.set("pkiccu_run_timestamp_seconds", int(time.time()))
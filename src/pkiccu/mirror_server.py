@@ -0,0 +1,215 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from email.utils import formatdate
+from urllib.parse import unquote, urlparse
+from pkiccu.file_manifest import FileManifest
+from pkiccu.merkle_manifest import MerkleManifest
+from pkiccu.file_utils import FileUtils
+import threading
+import hashlib
+import fnmatch
+import logging
+import json
+import re
+import os
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    """
+    Publishes a directory tree (e.g. the managed PKI data) over HTTP so other
+    PKICCU nodes can sync from it (see UrlDownloader's "mirror" type) instead
+    of all downloading from DISA.
+
+      /index.json   every file with its size, mtime and SHA-256
+      /<path>       the file, with an ETag of its SHA-256, If-None-Match and
+                    single Range requests
+
+      /.pkiccu_merkle/root.json and /.pkiccu_merkle/nodes/<digest>.json
+                    the tree's Merkle manifest, if it has one, for "pkiccu
+                    sync"
+
+    Other hidden files and files matching the exclude patterns aren't
+    published.
+    File digests come from a FileManifest so unchanged files are only hashed
+    once while the server runs.
+    """
+
+    INDEX_PATH = "/index.json"
+    CHUNK_SIZE = FileUtils.CHUNK_SIZE
+
+    daemon_threads = True
+
+    def __init__(self, root: str, bind: str = "", port: int = 8080, exclude: list = None):
+        self.root = Path(root).resolve()
+        self.exclude = exclude or []
+        self.manifest = FileManifest()
+        self.lock = threading.Lock()
+        HTTPServer.__init__(self, (bind, port), MirrorRequestHandler)
+
+    def is_published(self, path_rel: str) -> bool:
+        if MerkleManifest.is_published(path_rel):
+            return True
+        parts = path_rel.split("/")
+        return not any(part.startswith(".") or part == "" for part in parts) and \
+            not any(fnmatch.fnmatch(parts[-1], pattern) or fnmatch.fnmatch(path_rel, pattern)
+                    for pattern in self.exclude)
+
+    # {relative path: {size, mtime_ns, sha256}} of every published file
+    def get_index(self) -> dict:
+        dict_return = {}
+        with self.lock:
+            fn_list = []
+            for dn, dirs, files in os.walk(str(self.root)):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                for name in files:
+                    fn = os.path.join(dn, name)
+                    path_rel = Path(fn).relative_to(
+                        self.root).as_posix()
+                    if self.is_published(path_rel):
+                        try:
+                            dict_return[path_rel] = dict(
+                                self.manifest.get_entry(fn))
+                            fn_list.append(fn)
+                        except OSError:
+                            # removed while we were looking
+                            pass
+            self.manifest.prune(fn_list)
+        return dict_return
+
+    # the file for a request path, or None if it isn't published
+    def get_file(self, path: str) -> Path:
+        path_rel = unquote(urlparse(path).path).lstrip("/")
+        if not path_rel or not self.is_published(path_rel):
+            return None
+        path_file = (self.root / path_rel).resolve()
+        try:
+            path_file.relative_to(self.root)
+        except ValueError:
+            return None
+        return path_file if path_file.is_file() else None
+
+    def get_digest(self, path_file: Path) -> str:
+        with self.lock:
+            return self.manifest.get_digest(str(path_file))
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    server_version = "PKICCU-Mirror"
+
+    RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    def log_message(self, format: str, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_GET(self, send_body: bool = True):
+        try:
+            if urlparse(self.path).path == MirrorServer.INDEX_PATH:
+                body = json.dumps({"files": self.server.get_index()},
+                                  sort_keys=True).encode("utf-8")
+                etag = '"' + hashlib.sha256(body).hexdigest() + '"'
+                if self.not_modified(etag):
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+                return
+            path_file = self.server.get_file(self.path)
+            if path_file is None:
+                self.send_error(404)
+                return
+            etag = '"' + self.server.get_digest(path_file) + '"'
+            if self.not_modified(etag):
+                return
+            stat = path_file.stat()
+            start, end = 0, stat.st_size - 1
+            status = 200
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if range_header and (not if_range or if_range == etag):
+                match = MirrorRequestHandler.RANGE_RE.match(
+                    range_header.strip())
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), end)
+                    else:
+                        # suffix range, the last N bytes
+                        start = max(0, stat.st_size - int(match.group(2)))
+                    if start >= stat.st_size or start > end:
+                        self.send_response(416)
+                        self.send_header(
+                            "Content-Range", f"bytes */{stat.st_size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    status = 206
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(max(0, length)))
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified",
+                             formatdate(stat.st_mtime, usegmt=True))
+            if status == 206:
+                self.send_header("Content-Range",
+                                 f"bytes {start}-{end}/{stat.st_size}")
+            self.end_headers()
+            if send_body:
+                with open(str(path_file), "rb") as file:
+                    file.seek(start)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = file.read(
+                            min(MirrorServer.CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except BaseException as e:
+            logging.exception(f"Error serving '{self.path}': {str(e)}")
+            try:
+                self.send_error(500)
+            except BaseException:
+                pass
+
+    # answer 304 if the client already has this version
+    def not_modified(self, etag: str) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and (if_none_match.strip() == "*" or
+                              etag in [tag.strip() for tag in if_none_match.split(",")]):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return True
+        return False
@@ -18,12 +18,28 @@
 
 from pathlib import Path
 from tqdm import tqdm
+from pkiccu.file_utils import FileUtils
+from pkiccu.file_manifest import FileManifest
+from pkiccu.metrics import Metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
 import subprocess
+import hashlib
+import glob
+import threading
+import signal
+import time
+import sys
 import os
 import logging
 
 
 class ScriptRunner:
+    # Default output_log_limit (bytes) and output_tail_lines of scripts
+    OUTPUT_LOG_LIMIT = 1024 * 1024
+    OUTPUT_TAIL_LINES = 200
+    # seconds between checks for a script's exit once its output has closed
+    WAIT_POLL_INTERVAL = 0.02
 
     def run(script_def: dict):
         args = script_def.get("cmd_line", None)
@@ -51,39 +67,307 @@ class ScriptRunner:
                     args = [*args]
                     args[0] = str(arg0_path.resolve())
 
-            Path(cwd).mkdir(parents=True, exist_ok=True)
+            if cwd:
+                Path(cwd).mkdir(parents=True, exist_ok=True)
 
             logging.debug(f"Running script '{name}'...")
+            result = {"name": name}
             try:
-                completed = subprocess.run(args=args,
+                ScriptRunner.__run_process(result, args=args,
                                            shell=shell,
                                            cwd=cwd,
                                            timeout=timeout,
                                            env=env,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT,
-                                           universal_newlines=True)
-                if len(completed.stdout) > 0:
-                    logging.info(
-                        f"Process output (stdout+stderr): \n--- BEGIN OUTPUT ({name}) ---\n{completed.stdout}--- END OUTPUT ({name}) ---")
-                if completed.returncode != success_return_code:
+                                           output_log_limit=script_def.get(
+                                               "output_log_limit", ScriptRunner.OUTPUT_LOG_LIMIT),
+                                           output_tail_lines=script_def.get(
+                                               "output_tail_lines", ScriptRunner.OUTPUT_TAIL_LINES))
+                if result.get("timed_out"):
                     raise RuntimeError(
-                        f"non-zero exit code {completed.returncode}")
-                return completed
+                        f"timed out after {timeout} seconds")
+                if result.get("returncode") != success_return_code:
+                    raise RuntimeError(
+                        f"non-zero exit code {result.get('returncode')}")
+                return result
             except BaseException as e:
                 logging.exception(f"Error running script '{name}': {str(e)}")
-                raise RuntimeError(f"Script '{name}' failed: {str(e)}")
+                result.setdefault("returncode", None)
+                result["error"] = str(e)
+                error = RuntimeError(f"Script '{name}' failed: {str(e)}")
+                # so callers can report what the failed script did too
+                error.result = result
+                raise error
 
-    def run_scripts(run_list: list, noprogress: bool = False):
-        if isinstance(run_list, list):
-            with tqdm(total=len(run_list), desc="Running Scripts...", unit="Scripts", disable=noprogress, smoothing=0.1) as pbar:
-                for script_def in run_list:
+    # Run a process, logging its output (stdout+stderr) a line at a time as
+    # it is written.  Only the first output_log_limit bytes are logged as they
+    # come, after that just the last output_tail_lines lines are kept and
+    # logged when the process ends, so a chatty process can't use up memory.
+    # The return code, wall and CPU time, and an upper bound of the peak RSS
+    # go in result.
+    def __run_process(result: dict, args: list, shell: bool, cwd: str, timeout: float, env: dict, output_log_limit: int, output_tail_lines: int):
+        name = result.get("name")
+        time_start = time.monotonic()
+        process = subprocess.Popen(args=args,
+                                   shell=shell,
+                                   cwd=cwd,
+                                   env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True,
+                                   errors="replace",
+                                   bufsize=1,
+                                   # its own process group, so a timeout
+                                   # kills whatever it started too (POSIX)
+                                   start_new_session=hasattr(os, "killpg"))
+        lock = threading.Lock()
+        reaped = False
+
+        def kill():
+            with lock:
+                if not reaped:
+                    result["timed_out"] = True
+                    if hasattr(os, "killpg"):
+                        # children that inherited the output pipe would
+                        # otherwise keep it open, and us reading it
+                        try:
+                            os.killpg(process.pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    else:
+                        process.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        output_bytes = 0
+        output_lines = 0
+        lines_logged = 0
+        tail = deque(maxlen=max(0, output_tail_lines or 0))
+        try:
+            with process.stdout:
+                for line in process.stdout:
+                    output_bytes += len(line)
+                    output_lines += 1
+                    if output_log_limit is None or output_bytes <= output_log_limit:
+                        logging.info(f"[{name}] {line.rstrip()}")
+                        lines_logged += 1
+                    else:
+                        tail.append(line.rstrip())
+            rusage = None
+            if hasattr(os, "wait4"):
+                # Poll instead of blocking so the check and the reaping happen
+                # under the lock.  Otherwise kill() could run after the child
+                # is reaped but before reaped is set, and signal a PID that
+                # may belong to another process by then.
+                while not reaped:
+                    with lock:
+                        pid, status, rusage = os.wait4(
+                            process.pid, os.WNOHANG)
+                        if pid:
+                            reaped = True
+                            # os.waitstatus_to_exitcode() needs Python 3.9
+                            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(
+                                status) else os.WEXITSTATUS(status)
+                    if not reaped:
+                        time.sleep(ScriptRunner.WAIT_POLL_INTERVAL)
+            else:
+                process.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            if process.returncode is None:
+                if hasattr(os, "killpg"):
                     try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                else:
+                    process.kill()
+                process.wait()
+        if output_lines > lines_logged:
+            logging.info(
+                f"Output of script '{name}' passed the {output_log_limit} byte log limit, {output_lines - lines_logged} lines not logged, last {len(tail)} lines:\n"
+                f"--- BEGIN OUTPUT TAIL ({name}) ---\n" + "\n".join(tail) + f"\n--- END OUTPUT TAIL ({name}) ---")
+        result["returncode"] = process.returncode
+        result["wall_time"] = time.monotonic() - time_start
+        result["output_bytes"] = output_bytes
+        result["output_lines"] = output_lines
+        if rusage:
+            result["cpu_time"] = rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is in kilobytes, except on macOS where it's bytes.
+            # It counts the child from the fork, when it still had a copy of
+            # PKICCU's memory, so it's only an upper bound of the script's
+            # peak RSS.
+            result["max_rss_bound"] = rusage.ru_maxrss * \
+                (1 if sys.platform == "darwin" else 1024)
+        Metrics.set("pkiccu_script_seconds",
+                    result.get("wall_time"), script=name)
+        Metrics.set("pkiccu_script_exit_code",
+                    process.returncode, script=name)
+        if rusage:
+            Metrics.set("pkiccu_script_cpu_seconds",
+                        result.get("cpu_time"), script=name)
+            Metrics.set("pkiccu_script_max_rss_bound_bytes",
+                        result.get("max_rss_bound"), script=name)
+        logging.info(
+            f"Script '{name}' exited with {process.returncode}: wall {result.get('wall_time'):.2f}s"
+            + (f", CPU {result.get('cpu_time'):.2f}s, peak RSS at most {result.get('max_rss_bound') // (1024 * 1024)} MiB" if rusage else "")
+            + f", {output_lines} lines of output", extra={"duration": result.get("wall_time")})
+
+    # Should the script run given which bundles changed?  Scripts can set
+    # "only_if_bundles_changed" to true (any bundle) or to a list of bundle
+    # names.  If bundles weren't made this run (changed_bundles is None) the
+    # script always runs.
+    def bundles_changed(script_def: dict, changed_bundles: dict = None) -> bool:
+        bool_return = True
+        only_if = script_def.get("only_if_bundles_changed", None)
+        if only_if and changed_bundles is not None:
+            if isinstance(only_if, str):
+                only_if = [only_if]
+            if isinstance(only_if, list):
+                bool_return = any(changed_bundles.get(bundle_name, False)
+                                  for bundle_name in only_if)
+            else:
+                bool_return = any(changed_bundles.values())
+        return bool_return
+
+    # Digest of the files named by a script's "watch" paths and globs
+    # (directories include every file under them), with the digest of each
+    # file coming from the manifest so unchanged files aren't read again.
+    # The watched files are added to watched_files.
+    def get_watch_digest(script_def: dict, manifest: FileManifest, watched_files: set) -> str:
+        watch = script_def.get("watch", [])
+        if isinstance(watch, str):
+            watch = [watch]
+        fn_list = set()
+        for pattern in watch:
+            for path in glob.glob(str(pattern), recursive=True):
+                if Path(path).is_dir():
+                    fn_list.update(FileUtils.get_matching_files(
+                        path, "*", recursive=True))
+                elif Path(path).is_file():
+                    fn_list.add(path)
+        digest = hashlib.sha256()
+        for fn in sorted(os.path.abspath(fn) for fn in fn_list):
+            digest.update(
+                f"{fn}\0{manifest.get_digest(fn)}\n".encode("utf-8"))
+            watched_files.add(fn)
+        return digest.hexdigest()
+
+    # Work out the indexes of the scripts each script in the run list waits
+    # for.  A script with "depends_on" (a script name or list of names) waits
+    # for just those scripts.  Otherwise it waits for every script before it
+    # in the list, except those in the same "parallel_group", so a list
+    # without either option runs one script at a time as it always has.
+    def get_dependencies(run_list: list) -> list:
+        list_return = []
+        indexes = {}
+        for i, script_def in enumerate(run_list):
+            indexes.setdefault(script_def.get("name", "Unknown"), []).append(i)
+        for i, script_def in enumerate(run_list):
+            depends_on = script_def.get("depends_on", None)
+            if depends_on is not None:
+                if isinstance(depends_on, str):
+                    depends_on = [depends_on]
+                deps = set()
+                for dep_name in depends_on:
+                    if dep_name not in indexes:
+                        raise RuntimeError(
+                            f"Script '{script_def.get('name', 'Unknown')}' depends on unknown script '{dep_name}'")
+                    deps.update(j for j in indexes.get(dep_name) if j != i)
+            else:
+                group = script_def.get("parallel_group", None)
+                deps = set(j for j in range(i)
+                           if group is None or run_list[j].get("parallel_group", None) != group)
+            list_return.append(deps)
+        return list_return
+
+    # Run the scripts in the run list, up to max_workers at a time, as their
+    # dependencies (see get_dependencies()) finish.  When a script fails, the
+    # scripts that explicitly depend on it are skipped, the others still run.
+    # Scripts with "watch" paths only run if the watched files changed since
+    # the script last succeeded, as remembered in state_file.
+    # Returns the results (see run()) of the scripts that ran.
+    def run_scripts(run_list: list, noprogress: bool = False, changed_bundles: dict = None, max_workers: int = 1, state_file: str = None):
+        if isinstance(run_list, list):
+            manifest = FileManifest(state_file)
+            manifest.load()
+            watch_digests = manifest.data.setdefault("watch_digests", {})
+            watched_files = set()
+            digests = {}
+            deps = ScriptRunner.get_dependencies(run_list)
+            pending = set(range(len(run_list)))
+            failed = set()
+            running = {}
+            results = []
+            with tqdm(total=len(run_list), desc="Running Scripts...", unit="Scripts", disable=noprogress, smoothing=0.1) as pbar, \
+                    ThreadPoolExecutor(max_workers=max(1, max_workers or 1)) as executor:
+                while pending or running:
+                    for i in sorted(pending):
+                        if len(running) >= max(1, max_workers or 1):
+                            break
+                        if deps[i] & (pending | set(running.values())):
+                            continue
+                        pending.discard(i)
+                        script_def = run_list[i]
                         name = script_def.get("name", "Unknown")
-                        pbar.set_description(name)
-                        logging.info(f"Running script '{name}'")
-                        completed = ScriptRunner.run(script_def)
-                    except BaseException as e:
-                        print(str(e))
-                    pbar.update(1)
+                        if "depends_on" in script_def and deps[i] & failed:
+                            logging.warning(
+                                f"Skipping script '{name}' because a script it depends on failed")
+                            failed.add(i)
+                            pbar.update(1)
+                        elif not ScriptRunner.bundles_changed(script_def, changed_bundles):
+                            logging.info(
+                                f"Skipping script '{name}' because its bundles did not change")
+                            pbar.update(1)
+                        elif "watch" in script_def and state_file and \
+                                watch_digests.get(name) == digests.setdefault(i, ScriptRunner.get_watch_digest(script_def, manifest, watched_files)):
+                            logging.info(
+                                f"Skipping script '{name}' because its watched files did not change")
+                            pbar.update(1)
+                        else:
+                            logging.info(f"Running script '{name}'")
+                            pbar.set_description(name)
+                            running[executor.submit(
+                                ScriptRunner.run, script_def)] = i
+                    if not running:
+                        if pending:
+                            names = [run_list[i].get("name", "Unknown")
+                                     for i in sorted(pending)]
+                            logging.error(
+                                f"Not running scripts with circular dependencies: {names}")
+                            print(
+                                f"Not running scripts with circular dependencies: {names}")
+                        break
+                    done, not_done = wait(
+                        running.keys(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = running.pop(future)
+                        try:
+                            results.append(future.result())
+                            if i in digests:
+                                watch_digests[run_list[i].get(
+                                    "name", "Unknown")] = digests.get(i)
+                        except BaseException as e:
+                            failed.add(i)
+                            result = getattr(e, "result", None)
+                            if result is None:
+                                # failed before it ran, so run() didn't log it
+                                name = run_list[i].get("name", "Unknown")
+                                logging.error(
+                                    f"Error running script '{name}': {str(e)}")
+                                result = {"name": name,
+                                          "returncode": None, "error": str(e)}
+                            results.append(result)
+                            print(str(e))
+                        pbar.update(1)
                 pbar.set_description("Scripts complete.")
+            if state_file:
+                names = set(script_def.get("name", "Unknown")
+                            for script_def in run_list)
+                manifest.data["watch_digests"] = {name: digest for name, digest in watch_digests.items()
+                                                  if name in names}
+                manifest.prune(watched_files)
+                manifest.save()
+            return results
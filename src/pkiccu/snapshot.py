@@ -0,0 +1,335 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from datetime import datetime
+from pkiccu.file_manifest import FileManifest
+from pkiccu.file_utils import FileUtils
+import posixpath
+import hashlib
+import tarfile
+import logging
+import shutil
+import json
+import io
+import os
+
+
+class Snapshot:
+    """
+    Portable snapshots of the data directories (certs, CRLs, bundles) for
+    hosts that can't download them, e.g. carried into an air-gapped enclave.
+
+    A snapshot is a compressed tar file whose first member, manifest.json,
+    lists every file of every directory with its size and SHA-256:
+
+      {"format": 1, "id": ..., "base": ..., "created": ...,
+       "dirs": {name: {relative path: {"size": n, "sha256": digest}}},
+       "directories": {name: [relative paths of the subdirectories]}}
+
+    and whose other members are files/<name>/<relative path>.  A full
+    snapshot has every file.  A delta snapshot is made against a base
+    snapshot and only has the files that were added or changed since then;
+    files missing from the listing were removed.  The id is the digest of the
+    listing, so a delta's base is the id of the snapshot it was made against.
+    The directories are listed so that empty ones are the same too.
+
+    Importing checks that every file the snapshot doesn't carry is already
+    here with the right digest and that every file it carries has the right
+    digest, builds the new version of each directory next to it (unchanged
+    files are hard linked) and then swaps the directories in, so a failed or
+    interrupted import leaves the directories as they were.  Hidden files,
+    like PKICCU's own manifests, aren't in snapshots and are kept on import.
+    """
+
+    FORMAT = 1
+    MANIFEST_NAME = "manifest.json"
+    FILES_DIR = "files"
+    STAGING_SUFFIX = ".pkiccu_import"
+    OLD_SUFFIX = ".pkiccu_old"
+
+    # tarfile compression for a snapshot file name, xz unless it says otherwise
+    def get_compression(fn: str) -> str:
+        name = Path(fn).name.lower()
+        if name.endswith(".tar.gz") or name.endswith(".tgz"):
+            return "gz"
+        elif name.endswith(".tar.bz2"):
+            return "bz2"
+        elif name.endswith(".tar"):
+            return ""
+        return "xz"
+
+    # {relative path: {size, sha256}} of the files in and under dn, except
+    # hidden ones
+    def list_files(dn: str) -> dict:
+        dict_return = {}
+        if Path(dn).is_dir():
+            for dn_walk, dirs, files in os.walk(dn):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                for name in files:
+                    if not name.startswith("."):
+                        fn = os.path.join(dn_walk, name)
+                        if os.path.isfile(fn):
+                            path_rel = Path(fn).relative_to(dn).as_posix()
+                            dict_return[path_rel] = {"size": os.path.getsize(fn),
+                                                     "sha256": FileManifest.hash_file(fn)}
+        return dict_return
+
+    # relative paths of the subdirectories of dn, except hidden ones
+    def list_dirs(dn: str) -> list:
+        list_return = []
+        if Path(dn).is_dir():
+            for dn_walk, dirs, files in os.walk(dn):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                list_return.extend(Path(dn_walk, name).relative_to(dn).as_posix()
+                                   for name in dirs)
+        return sorted(list_return)
+
+    def get_id(listing: dict, directories: dict) -> str:
+        return hashlib.sha256(json.dumps([listing, directories], sort_keys=True, separators=(",", ":"))
+                              .encode("utf-8")).hexdigest()
+
+    # read just the manifest of a snapshot, which is its first member
+    def read_manifest(fn: str) -> dict:
+        with tarfile.open(fn, "r:*") as tar:
+            member = tar.next()
+            if member is None or member.name != Snapshot.MANIFEST_NAME:
+                raise RuntimeError(
+                    f"'{fn}' is not a PKICCU snapshot (no {Snapshot.MANIFEST_NAME})")
+            manifest = json.load(io.TextIOWrapper(
+                tar.extractfile(member), encoding="utf-8"))
+        if manifest.get("format") != Snapshot.FORMAT:
+            raise RuntimeError(
+                f"'{fn}' has snapshot format {manifest.get('format')}, expected {Snapshot.FORMAT}")
+        return manifest
+
+    # Write a snapshot of dirs ({name: directory}) to fn.  With base_fn, only
+    # files added or changed since that snapshot are written.  Also writes
+    # fn.sha256 with the digest of the snapshot file.  Returns the manifest.
+    def export(dirs: dict, fn: str, base_fn: str = None) -> dict:
+        base_listing = {}
+        base_id = None
+        if base_fn:
+            base_manifest = Snapshot.read_manifest(base_fn)
+            base_listing = base_manifest.get("dirs", {})
+            base_id = base_manifest.get("id")
+        listing = {name: Snapshot.list_files(str(dn))
+                   for name, dn in dirs.items()}
+        directories = {name: Snapshot.list_dirs(str(dn))
+                       for name, dn in dirs.items()}
+        manifest = {"format": Snapshot.FORMAT,
+                    "id": Snapshot.get_id(listing, directories),
+                    "base": base_id,
+                    "created": datetime.now().isoformat(),
+                    "dirs": listing,
+                    "directories": directories}
+        count = 0
+        with FileUtils.open_atomic(fn, "wb") as file:
+            with tarfile.open(fileobj=file, mode="w:" + Snapshot.get_compression(fn)) as tar:
+                data = json.dumps(manifest, indent=1,
+                                  sort_keys=True).encode("utf-8")
+                member = tarfile.TarInfo(Snapshot.MANIFEST_NAME)
+                member.size = len(data)
+                member.mtime = int(datetime.now().timestamp())
+                tar.addfile(member, io.BytesIO(data))
+                for name, files in sorted(listing.items()):
+                    base_files = base_listing.get(name, {})
+                    for path_rel, entry in sorted(files.items()):
+                        if base_files.get(path_rel, {}).get("sha256") != entry.get("sha256"):
+                            tar.add(os.path.join(str(dirs.get(name)), path_rel),
+                                    arcname=f"{Snapshot.FILES_DIR}/{name}/{path_rel}",
+                                    recursive=False)
+                            count += 1
+        with FileUtils.open_atomic(fn + ".sha256", "w") as file:
+            file.write(f"{FileManifest.hash_file(fn)}  {Path(fn).name}\n")
+        logging.info(
+            f"Wrote {'delta' if base_fn else 'full'} snapshot '{fn}' ({manifest.get('id')}) with {count} files")
+        return manifest
+
+    # Check a snapshot and apply it to dirs ({name: directory}).  Returns
+    # counts of the files added, changed, removed and unchanged, and the
+    # touched files.
+    def import_snapshot(dirs: dict, fn: str) -> dict:
+        dict_return = {"added": 0, "changed": 0,
+                       "removed": 0, "unchanged": 0, "touched": []}
+        fn_digest = fn + ".sha256"
+        if Path(fn_digest).exists():
+            digest = FileUtils.read_text_file(fn_digest).split()[0]
+            if digest != FileManifest.hash_file(fn):
+                raise RuntimeError(
+                    f"'{fn}' doesn't match the digest in '{fn_digest}'")
+        manifest = Snapshot.read_manifest(fn)
+        listing = manifest.get("dirs", {})
+        directories = manifest.get("directories", {})
+        if Snapshot.get_id(listing, directories) != manifest.get("id"):
+            raise RuntimeError(f"The manifest of '{fn}' is damaged")
+        unknown = set(listing) - set(dirs)
+        if unknown:
+            raise RuntimeError(
+                f"'{fn}' has directories {sorted(unknown)} that aren't in the snapshot config")
+        for name, files in listing.items():
+            for path_rel in list(files) + directories.get(name, []):
+                if posixpath.normpath(path_rel) != path_rel or path_rel.startswith("/") or \
+                        any(part.startswith(".") for part in path_rel.split("/")):
+                    raise RuntimeError(
+                        f"'{fn}' has an invalid path '{path_rel}' in its manifest")
+        stagings = {}
+        try:
+            for name, files in listing.items():
+                stagings[name] = Snapshot.__stage_dir(
+                    str(dirs.get(name)), files, directories.get(name, []))
+            Snapshot.__extract(fn, listing, stagings)
+            # everything not in the snapshot has to be here already
+            for name, files in listing.items():
+                dn = str(dirs.get(name))
+                for path_rel, entry in files.items():
+                    fn_staged = os.path.join(stagings.get(name), path_rel)
+                    if not os.path.isfile(fn_staged):
+                        raise RuntimeError(
+                            f"'{path_rel}' of '{name}' is in neither '{fn}' nor '{dn}'.  Import the base snapshot {manifest.get('base')} first.")
+                    fn_dst = os.path.join(dn, path_rel)
+                    if not os.path.isfile(fn_dst):
+                        dict_return["added"] += 1
+                        dict_return["touched"].append(fn_dst)
+                    elif os.path.samefile(fn_dst, fn_staged):
+                        # hard linked, so it's the file we have
+                        if FileManifest.hash_file(fn_staged) != entry.get("sha256"):
+                            raise RuntimeError(
+                                f"'{fn_dst}' isn't the file in the snapshot.  Import the base snapshot {manifest.get('base')} first.")
+                        dict_return["unchanged"] += 1
+                    else:
+                        dict_return["changed"] += 1
+                        dict_return["touched"].append(fn_dst)
+                for path_rel in Snapshot.list_paths(dn):
+                    if path_rel not in files:
+                        dict_return["removed"] += 1
+                        dict_return["touched"].append(
+                            os.path.join(dn, path_rel))
+            Snapshot.__swap(dirs, stagings)
+        finally:
+            for dn_staging in stagings.values():
+                shutil.rmtree(dn_staging, ignore_errors=True)
+        logging.info(
+            f"Imported snapshot '{fn}' ({manifest.get('id')}): {dict((k, v) for k, v in dict_return.items() if k != 'touched')}")
+        return dict_return
+
+    # relative paths of the files in and under dn, except hidden ones
+    def list_paths(dn: str) -> list:
+        list_return = []
+        if Path(dn).is_dir():
+            for dn_walk, dirs, files in os.walk(dn):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                list_return.extend(Path(dn_walk, name).relative_to(dn).as_posix()
+                                   for name in files if not name.startswith("."))
+        return list_return
+
+    # a copy of dn next to it, made of hard links, with the files and
+    # directories that aren't in files and directories left out (hidden ones
+    # are kept)
+    def __stage_dir(dn: str, files: dict, directories: list) -> str:
+        path = Path(os.path.abspath(dn))
+        directories = set(directories)
+        dn_staging = str(path.parent / f".{path.name}{Snapshot.STAGING_SUFFIX}")
+        shutil.rmtree(dn_staging, ignore_errors=True)
+        os.makedirs(dn_staging)
+        if path.is_dir():
+            for dn_walk, dirs, names in os.walk(str(path)):
+                dn_rel = os.path.relpath(dn_walk, str(path))
+                for name in dirs:
+                    path_rel = posixpath.normpath(
+                        Path(dn_rel, name).as_posix())
+                    if path_rel in directories or any(part.startswith(".") for part in path_rel.split("/")):
+                        os.makedirs(os.path.join(
+                            dn_staging, path_rel), exist_ok=True)
+                # don't go into the directories that were left out
+                dirs[:] = [name for name in dirs if os.path.isdir(
+                    os.path.join(dn_staging, dn_rel, name))]
+                for name in names:
+                    path_rel = posixpath.normpath(
+                        Path(dn_rel, name).as_posix())
+                    hidden = any(part.startswith(".")
+                                 for part in path_rel.split("/"))
+                    if hidden or path_rel in files:
+                        fn_src = os.path.join(dn_walk, name)
+                        fn_dst = os.path.join(dn_staging, path_rel)
+                        try:
+                            os.link(fn_src, fn_dst)
+                        except OSError:
+                            shutil.copy2(fn_src, fn_dst)
+        for dn_rel in directories:
+            os.makedirs(os.path.join(dn_staging, dn_rel), exist_ok=True)
+        return dn_staging
+
+    # write the files in the snapshot to the staging directories, checking
+    # each one's digest
+    def __extract(fn: str, listing: dict, stagings: dict):
+        with tarfile.open(fn, "r:*") as tar:
+            for member in tar:
+                if member.name == Snapshot.MANIFEST_NAME:
+                    continue
+                parts = member.name.split("/", 2)
+                if len(parts) != 3 or parts[0] != Snapshot.FILES_DIR or not member.isfile():
+                    raise RuntimeError(
+                        f"Unexpected member '{member.name}' in '{fn}'")
+                name, path_rel = parts[1], parts[2]
+                entry = listing.get(name, {}).get(path_rel)
+                if entry is None:
+                    raise RuntimeError(
+                        f"'{member.name}' in '{fn}' isn't in its manifest")
+                fn_dst = os.path.join(stagings.get(name), path_rel)
+                os.makedirs(os.path.dirname(fn_dst), exist_ok=True)
+                digest = hashlib.sha256()
+                # replace rather than write through, the staged file may be a
+                # hard link to the live one
+                with FileUtils.open_atomic(fn_dst, "wb") as file:
+                    source = tar.extractfile(member)
+                    for block in iter(lambda: source.read(FileManifest.HASH_BLOCK_SIZE), b""):
+                        digest.update(block)
+                        file.write(block)
+                if digest.hexdigest() != entry.get("sha256"):
+                    raise RuntimeError(
+                        f"'{member.name}' in '{fn}' doesn't match its digest")
+                os.utime(fn_dst, (member.mtime, member.mtime))
+
+    # move the staged directories into place, putting the old ones back if
+    # one of them can't be
+    def __swap(dirs: dict, stagings: dict):
+        # [directory, where the old one went, was the new one moved in]
+        swapped = []
+        try:
+            for name, dn_staging in stagings.items():
+                path = Path(os.path.abspath(str(dirs.get(name))))
+                dn_old = str(path.parent / f".{path.name}{Snapshot.OLD_SUFFIX}")
+                shutil.rmtree(dn_old, ignore_errors=True)
+                swap = [str(path), None, False]
+                swapped.append(swap)
+                if path.exists():
+                    os.rename(str(path), dn_old)
+                    swap[1] = dn_old
+                os.rename(dn_staging, str(path))
+                swap[2] = True
+        except BaseException as e:
+            for dn, dn_old, moved in reversed(swapped):
+                if moved:
+                    shutil.rmtree(dn, ignore_errors=True)
+                if dn_old:
+                    os.rename(dn_old, dn)
+            raise e
+        for dn, dn_old, moved in swapped:
+            if dn_old:
+                shutil.rmtree(dn_old, ignore_errors=True)
@@ -0,0 +1,104 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from datetime import datetime
+import io
+import logging
+import cProfile
+import pstats
+import tracemalloc
+
+
+class StageProfiler:
+    """
+    Profiles a stage of a run with cProfile (and tracemalloc if memory is
+    true) while used as a "with" block.  Afterwards it writes
+    <out_dir>/PKICCU_<time>_<stage>.pstats, which can be loaded with pstats or
+    viewers like snakeviz, and <out_dir>/PKICCU_<time>_<stage>.profile.txt, a
+    summary of the top functions by cumulative and own time plus the peak
+    memory and the sites holding the most memory at the end of the stage.
+    The summary is logged too.  Memory freed before the stage ends counts
+    toward the peak but its allocation sites aren't listed.
+
+    cProfile only sees the thread that runs the stage, so the time spent in
+    script worker threads and signature checking processes shows up as
+    waiting in the stage's thread.
+    """
+
+    def __init__(self, stage: str, out_dir: str = ".", memory: bool = False, top: int = 25):
+        self.stage = stage
+        self.out_dir = Path(out_dir or ".")
+        self.memory = memory
+        self.top = top
+        self.profile = None
+        self.started_tracemalloc = False
+
+    def get_prefix(self) -> Path:
+        ts = datetime.now().replace(microsecond=0).isoformat()
+        # Windows can't have colons in the time part -- invalid filename
+        return self.out_dir / f"PKICCU_{ts}_{self.stage}".replace(":", "-")
+
+    def __enter__(self):
+        if self.memory:
+            if tracemalloc.is_tracing():
+                logging.warning(
+                    f"tracemalloc is already running, not reporting the memory of stage '{self.stage}'")
+            else:
+                tracemalloc.start(10)
+                self.started_tracemalloc = True
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        # look at memory before making the reports allocates more
+        snapshot = None
+        if self.started_tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__)])
+        try:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            prefix = self.get_prefix()
+            fn_stats = str(prefix) + ".pstats"
+            self.profile.dump_stats(fn_stats)
+            summary = io.StringIO()
+            summary.write(f"Profile of stage '{self.stage}' ({fn_stats})\n")
+            stats = pstats.Stats(self.profile, stream=summary)
+            stats.sort_stats("cumulative").print_stats(self.top)
+            stats.sort_stats("tottime").print_stats(self.top)
+            if snapshot:
+                summary.write(
+                    f"Memory: peak {peak / (1024 * 1024):.1f} MiB traced, {current / (1024 * 1024):.1f} MiB still allocated at the end of the stage\n")
+                summary.write(
+                    f"Top {self.top} sites of memory still allocated:\n")
+                for stat in snapshot.statistics("lineno")[:self.top]:
+                    summary.write(f"  {stat}\n")
+            with open(str(prefix) + ".profile.txt", "w") as file:
+                file.write(summary.getvalue())
+            logging.info(summary.getvalue())
+        except BaseException as e:
+            logging.exception(
+                f"Error writing the profile of stage '{self.stage}': {str(e)}")
+        finally:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        return False
@@ -0,0 +1,131 @@
+# Copyright 2019 Gradkell Systems, Inc.
+#
+# Author: Mike R. Prevost, mprevost@gradkell.com
+#
+# This file is part of PKICCU.
+#
+# PKICCU is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# PKICCU is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from datetime import datetime
+import logging
+import time
+import os
+
+
+class StageRecorder(logging.Handler):
+    """
+    Records the result of one stage of a run as a dict:
+
+      stage            stage name
+      ok               false if the stage logged any errors
+      started          ISO time the stage started
+      duration         seconds the stage took
+      files_added      files under the stage's paths that are new,
+      files_changed    changed (size or mtime),
+      files_removed    gone,
+      files_unchanged  or the same as before the stage
+      bytes            total size of the added and changed files
+      errors           messages of the errors logged during the stage
+      details          stage specific results
+
+    Stages catch and log their own exceptions, so errors are collected by
+    listening to the log while the stage runs.  Used as a "with" block around
+    the stage, the result is appended to results when the block exits, and
+    touched lists the files that were added, changed or removed.
+    """
+
+    MAX_ERRORS = 100
+
+    def __init__(self, stage: str, paths: list = None, results: list = None):
+        logging.Handler.__init__(self, level=logging.ERROR)
+        self.paths = [str(path) for path in (paths or []) if path]
+        self.results = results
+        self.result = {"stage": stage,
+                       "ok": True,
+                       "started": None,
+                       "duration": 0.0,
+                       "files_added": 0,
+                       "files_changed": 0,
+                       "files_removed": 0,
+                       "files_unchanged": 0,
+                       "bytes": 0,
+                       "errors": [],
+                       "details": {}}
+        self.before = {}
+        self.touched = []
+        self.time_start = None
+
+    # size and mtime of every file in or under paths, except hidden
+    # bookkeeping files like manifests
+    def stat_files(paths: list) -> dict:
+        dict_return = {}
+        stack = list(paths)
+        while stack:
+            path = stack.pop()
+            try:
+                if Path(path).is_dir():
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            if entry.name.startswith("."):
+                                continue
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file():
+                                stat = entry.stat()
+                                dict_return[entry.path] = (
+                                    stat.st_size, stat.st_mtime_ns)
+                elif Path(path).is_file():
+                    stat = os.stat(path)
+                    dict_return[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+        return dict_return
+
+    def emit(self, record: logging.LogRecord):
+        self.result["ok"] = False
+        if len(self.result.get("errors")) < StageRecorder.MAX_ERRORS:
+            self.result.get("errors").append(record.getMessage())
+
+    def __enter__(self):
+        self.before = StageRecorder.stat_files(self.paths)
+        self.result["started"] = datetime.now().isoformat()
+        self.time_start = time.monotonic()
+        logging.getLogger().addHandler(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logging.getLogger().removeHandler(self)
+        self.result["duration"] = time.monotonic() - self.time_start
+        if exc_value:
+            self.result["ok"] = False
+            self.result.get("errors").append(str(exc_value))
+        after = StageRecorder.stat_files(self.paths)
+        for path, (size, mtime_ns) in after.items():
+            before = self.before.get(path)
+            if before is None:
+                self.result["files_added"] += 1
+                self.result["bytes"] += size
+                self.touched.append(path)
+            elif before != (size, mtime_ns):
+                self.result["files_changed"] += 1
+                self.result["bytes"] += size
+                self.touched.append(path)
+            else:
+                self.result["files_unchanged"] += 1
+        removed = [path for path in self.before if path not in after]
+        self.result["files_removed"] = len(removed)
+        self.touched.extend(removed)
+        if self.results is not None:
+            self.results.append(self.result)
+        return False
@@ -18,18 +18,29 @@
 
 
 from pkiccu.http_utils import HttpUtils
+from pkiccu.metrics import Metrics
+from pkiccu.file_manifest import FileManifest
+from pkiccu.file_utils import FileUtils
 from pkiccu.x509_utils import X509Utils
+from pkiccu.catalog import Catalog
 from tqdm import tqdm
 from pathlib import Path
+from urllib.parse import quote, urlparse
 import shutil
+import json
 import sys
+import os
 import logging
 
 
 class UrlDownloader:
+    # download type that syncs a directory from a "pkiccu serve" mirror
+    TYPE_MIRROR = "mirror"
+    MIRROR_STATE_FILE = ".pkiccu_mirror_state"
 
-    def __init__(self, http_utils: HttpUtils = None):
+    def __init__(self, http_utils: HttpUtils = None, catalog: Catalog = None):
         self.http_utils = http_utils
+        self.catalog = catalog
         if not self.http_utils:
             self.http_utils = HttpUtils()
 
@@ -45,6 +56,10 @@ class UrlDownloader:
                         if not src or not dst or not typ or not fmt:
                             raise RuntimeError(
                                 f"Invalid download spec: {download}")
+                        elif typ == UrlDownloader.TYPE_MIRROR:
+                            pbar.set_description(src)
+                            self.sync_mirror(src, dst, delete=download.get(
+                                "delete", False), noprogress=noprogress)
                         else:
                             path_dst = Path(dst)
                             pbar.set_description(path_dst.name)
@@ -60,9 +75,263 @@ class UrlDownloader:
                                     X509Utils.write_cert_pem_to_der(path_dl)
                                 if path_dl.exists() and typ.lower() == 'cer' and fmt.lower() == 'pem':
                                     X509Utils.write_cert_pem_to_der(path_dl)
+                                if self.catalog and path_dl.exists():
+                                    self.catalog.update_file(
+                                        str(path_dl), source_url=src)
+                                Metrics.inc("pkiccu_files_total", stage="url_download",
+                                            kind=typ, result="downloaded")
+                            else:
+                                Metrics.inc("pkiccu_files_total", stage="url_download",
+                                            kind=typ, result="unchanged")
                     except BaseException as ex:
+                        Metrics.inc("pkiccu_files_total",
+                                    stage="url_download", result="failed")
                         logging.exception(
                             f"Error downloading file: '{str(ex)}'")
                         print(str(ex), file=sys.stderr)
                     pbar.update(1)
                 pbar.set_description("File Downloads Complete")
+
+    # Sync the directory dst with a "pkiccu serve" mirror at src_url.  Only
+    # files whose SHA-256 differs from the mirror's index are downloaded, and
+    # if nothing changed since the last sync the index request gets a 304.
+    # Downloads go to a hidden ".part" file that is checked against the index
+    # digest before it replaces the real file, and an interrupted download is
+    # resumed with a Range request.  With delete, files that aren't on the
+    # mirror anymore are removed.  Returns counts of the files downloaded,
+    # unchanged, removed and failed.
+    def sync_mirror(self, src_url: str, dst: str, delete: bool = False, noprogress: bool = None) -> dict:
+        dict_return = {"downloaded": 0, "unchanged": 0,
+                       "removed": 0, "failed": 0}
+        base_url = src_url.rstrip("/") + "/"
+        path_dst = Path(dst)
+        path_dst.mkdir(parents=True, exist_ok=True)
+        state = FileManifest(str(path_dst / UrlDownloader.MIRROR_STATE_FILE))
+        state.load()
+        index = state.data.get("index", {})
+        # only ask for "not modified" if the local copy still matches the
+        # index it was synced to
+        headers = {}
+        if state.data.get("etag") and self.__mirror_matches(path_dst, index, state):
+            headers["If-None-Match"] = state.data.get("etag")
+        response = self.http_utils.doHttpRequest(
+            base_url + "index.json", headers=headers)
+        etag = response.headers.get("ETag")
+        if response.status_code == 304:
+            logging.info(f"Mirror '{base_url}' has not changed")
+            dict_return["unchanged"] = len(index)
+            Metrics.inc("pkiccu_files_total", len(index),
+                        stage="url_download", kind=UrlDownloader.TYPE_MIRROR, result="unchanged")
+            return dict_return
+        index = response.json().get("files", {})
+        fn_list = []
+        with tqdm(total=len(index), desc="Syncing...", unit="Files", disable=noprogress, smoothing=0.1) as pbar:
+            for path_rel, entry in sorted(index.items()):
+                try:
+                    pbar.set_description(Path(path_rel).name)
+                    path_file = (path_dst / path_rel).resolve()
+                    # don't let the mirror write outside of dst
+                    path_file.relative_to(path_dst.resolve())
+                    if path_file.is_file() and state.get_digest(str(path_file)) == entry.get("sha256"):
+                        result = "unchanged"
+                    else:
+                        self.__download_mirror_file(
+                            base_url + quote(path_rel), path_file, entry)
+                        state.get_digest(str(path_file))
+                        result = "downloaded"
+                        if self.catalog:
+                            self.catalog.update_file(
+                                str(path_file), source_url=base_url + path_rel)
+                    fn_list.append(str(path_file))
+                except BaseException as ex:
+                    result = "failed"
+                    logging.exception(
+                        f"Error syncing '{path_rel}' from mirror '{base_url}': {str(ex)}", extra={"url": base_url + path_rel})
+                    print(str(ex), file=sys.stderr)
+                dict_return[result] += 1
+                Metrics.inc("pkiccu_files_total", stage="url_download",
+                            kind=UrlDownloader.TYPE_MIRROR, result=result)
+                pbar.update(1)
+        if delete:
+            keep = set(fn_list) | set(str((path_dst / path_rel).resolve())
+                                      for path_rel in index.keys())
+            for dn, dirs, files in os.walk(str(path_dst)):
+                dirs[:] = [name for name in dirs if not name.startswith(".")]
+                for name in files:
+                    fn = str(Path(dn, name).resolve())
+                    if not name.startswith(".") and fn not in keep:
+                        os.remove(fn)
+                        dict_return["removed"] += 1
+                        if self.catalog:
+                            self.catalog.remove_file(fn)
+        state.prune(fn_list)
+        # a failed file has to be tried again, so forget the ETag
+        state.data = {"etag": etag if dict_return.get("failed") == 0 else None,
+                      "index": index}
+        state.save()
+        logging.info(
+            f"Synced mirror '{base_url}' to '{dst}': {dict_return}")
+        return dict_return
+
+    # do the local files still have the digests of the mirror's index?
+    def __mirror_matches(self, path_dst: Path, index: dict, state: FileManifest) -> bool:
+        try:
+            return all(state.get_digest(str((path_dst / path_rel).resolve())) == entry.get("sha256")
+                       for path_rel, entry in index.items())
+        except OSError:
+            return False
+
+    # download one file from the mirror to a hidden .part file, resuming a
+    # previous partial download, and move it into place once its digest
+    # matches the index
+    def __download_mirror_file(self, url: str, path_file: Path, entry: dict):
+        path_file.parent.mkdir(parents=True, exist_ok=True)
+        path_part = path_file.parent / f".{path_file.name}.part"
+        headers = {}
+        offset = path_part.stat().st_size if path_part.exists() else 0
+        if 0 < offset < entry.get("size", 0):
+            # resume, but only if the mirror still has the same file
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = '"' + entry.get("sha256") + '"'
+        response = self.http_utils.doHttpRequest(
+            url, stream=True, headers=headers)
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(str(path_part), mode) as file:
+            for chunk in response.iter_content(chunk_size=FileUtils.CHUNK_SIZE):
+                file.write(chunk)
+                Metrics.inc("pkiccu_http_bytes_total", len(chunk),
+                            host=urlparse(url).hostname)
+        digest = FileManifest.hash_file(str(path_part))
+        if digest != entry.get("sha256"):
+            os.remove(str(path_part))
+            raise RuntimeError(
+                f"Downloaded '{path_file.name}' has SHA-256 {digest}, the mirror's index says {entry.get('sha256')}")
+        os.replace(str(path_part), str(path_file))
+
+    # Sync the directory dst from the Merkle manifest of source, which is a
+    # "pkiccu serve" mirror URL or a directory.  The root digests are compared
+    # first, so an unchanged tree costs one small request, and then only the
+    # directories whose digests differ are walked and only the files whose
+    # digests differ are fetched.  With delete, local files that aren't in
+    # source are removed.  dst's own Merkle manifest is updated to match.
+    # Returns counts of the files downloaded, unchanged (in the directories
+    # that were walked), removed and failed, and of the nodes fetched.
+    def sync_merkle(self, source: str, dst: str, delete: bool = False, noprogress: bool = None) -> dict:
+        from pkiccu.merkle_manifest import MerkleManifest
+        dict_return = {"downloaded": 0, "unchanged": 0,
+                       "removed": 0, "failed": 0, "nodes": 0}
+        # the manifest URL or file can be given instead of the top of the tree
+        source = str(source)
+        if source.rstrip("/").endswith(MerkleManifest.get_root_path()):
+            source = source.rstrip("/")[:-len(MerkleManifest.get_root_path())]
+        if UrlDownloader.is_url(source):
+            source = source.rstrip("/") + "/"
+        path_dst = Path(dst)
+        path_dst.mkdir(parents=True, exist_ok=True)
+        local = MerkleManifest(dst)
+        local.load()
+        local.update()
+        root = json.loads(self.__read_source(
+            source, MerkleManifest.get_root_path()).decode("utf-8")).get("root")
+        if not root:
+            raise RuntimeError(f"'{source}' has no Merkle manifest")
+        if root == local.get_root():
+            logging.info(f"'{dst}' is already in sync with '{source}'")
+            local.save()
+            return dict_return
+        touched = []
+        with tqdm(desc="Syncing...", unit="Files", disable=noprogress, smoothing=0.1) as pbar:
+            stack = [("", root)]
+            while stack:
+                dir_rel, digest = stack.pop()
+                if local.digests.get(dir_rel) == digest:
+                    continue
+                node = self.__read_source(
+                    source, MerkleManifest.get_node_path(digest))
+                dict_return["nodes"] += 1
+                if MerkleManifest.hash_entries(json.loads(node.decode("utf-8")))[0] != digest:
+                    raise RuntimeError(
+                        f"Merkle node {digest} from '{source}' doesn't match its digest")
+                entries = json.loads(node.decode("utf-8"))
+                local_entries = local.dirs.get(dir_rel, {})
+                for name, entry in sorted(entries.items()):
+                    path_rel = f"{dir_rel}/{name}" if dir_rel else name
+                    path_file = path_dst / path_rel
+                    local_entry = local_entries.get(name, {})
+                    try:
+                        if local.get_relative(str(path_file)) != path_rel:
+                            raise RuntimeError(
+                                f"Invalid path '{path_rel}' in Merkle node {digest}")
+                        if local_entry.get("type", entry.get("type")) != entry.get("type"):
+                            # a file became a directory or the other way around
+                            if path_file.is_dir():
+                                shutil.rmtree(str(path_file))
+                            else:
+                                os.remove(str(path_file))
+                            touched.append(str(path_file))
+                            local_entry = {}
+                        if entry.get("type") == "dir":
+                            path_file.mkdir(parents=True, exist_ok=True)
+                            stack.append((path_rel, entry.get("sha256")))
+                            continue
+                        if local_entry.get("sha256") == entry.get("sha256"):
+                            result = "unchanged"
+                        else:
+                            if UrlDownloader.is_url(source):
+                                self.__download_mirror_file(
+                                    source + quote(path_rel), path_file, entry)
+                            else:
+                                self.__copy_mirror_file(
+                                    str(Path(source, path_rel)), path_file, entry)
+                            touched.append(str(path_file))
+                            result = "downloaded"
+                            if self.catalog:
+                                self.catalog.update_file(
+                                    str(path_file), source_url=source + path_rel)
+                    except BaseException as ex:
+                        result = "failed"
+                        logging.exception(
+                            f"Error syncing '{path_rel}' from '{source}': {str(ex)}", extra={"url": source + path_rel})
+                        print(str(ex), file=sys.stderr)
+                    dict_return[result] += 1
+                    Metrics.inc("pkiccu_files_total", stage="sync",
+                                kind="merkle", result=result)
+                    pbar.update(1)
+                if delete:
+                    for name, local_entry in local_entries.items():
+                        if name not in entries:
+                            path_file = path_dst / dir_rel / name
+                            if local_entry.get("type") == "dir":
+                                shutil.rmtree(str(path_file))
+                            else:
+                                os.remove(str(path_file))
+                                if self.catalog:
+                                    self.catalog.remove_file(str(path_file))
+                            touched.append(str(path_file))
+                            dict_return["removed"] += 1
+        local.update(touched)
+        local.save()
+        logging.info(
+            f"Synced '{dst}' from '{source}': {dict_return}, root is now {local.get_root()}")
+        return dict_return
+
+    def is_url(source: str) -> bool:
+        return urlparse(source).scheme in ("http", "https")
+
+    # the contents of a file relative to the top of a sync source
+    def __read_source(self, source: str, path_rel: str) -> bytes:
+        if UrlDownloader.is_url(source):
+            return self.http_utils.doHttpRequest(source + quote(path_rel)).content
+        return Path(source, path_rel).read_bytes()
+
+    # copy one file from a local sync source, checking it like a download
+    def __copy_mirror_file(self, fn_src: str, path_file: Path, entry: dict):
+        path_file.parent.mkdir(parents=True, exist_ok=True)
+        path_part = path_file.parent / f".{path_file.name}.part"
+        shutil.copyfile(fn_src, str(path_part))
+        digest = FileManifest.hash_file(str(path_part))
+        if digest != entry.get("sha256"):
+            os.remove(str(path_part))
+            raise RuntimeError(
+                f"Copied '{path_file.name}' has SHA-256 {digest}, the Merkle manifest says {entry.get('sha256')}")
+        os.replace(str(path_part), str(path_file))
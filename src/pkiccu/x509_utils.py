@@ -19,10 +19,16 @@
 
 from typing import Dict
 import datetime
+import hashlib
+import base64
+import os
 from pathlib import Path
+from pkiccu.file_utils import FileUtils
 from cryptography.x509 import Certificate, CertificateRevocationList, load_der_x509_certificate, load_pem_x509_certificate, load_der_x509_crl, load_pem_x509_crl
+from cryptography.x509 import SubjectKeyIdentifier, AuthorityKeyIdentifier, ExtensionNotFound
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, dsa, ed25519, ed448, padding
 
 
 class X509Utils:
@@ -31,10 +37,14 @@ class X509Utils:
         cert_return = None
         if (fn and Path(fn).exists()):
             with open(fn, "rb") as file:
-                data = file.read()
-                if data and len(data) > 0:
-                    cert_return = load_der_x509_certificate(
-                        data, default_backend())
+                cert_return = X509Utils.load_cert_der_data(file.read())
+        return cert_return
+
+    # load a DER cert that has already been read
+    def load_cert_der_data(data: bytes) -> Certificate:
+        cert_return = None
+        if data and len(data) > 0:
+            cert_return = load_der_x509_certificate(data, default_backend())
         return cert_return
 
     def load_crl_der(fn: str) -> CertificateRevocationList:
@@ -79,15 +89,81 @@ class X509Utils:
     def cert_get_valid_to(cert: Certificate) -> datetime:
         return cert.not_valid_after
 
+    def cert_get_serial(cert: Certificate) -> str:
+        return format(cert.serial_number, "X")
+
+    # subject key identifier as hex, or None
+    def cert_get_ski(cert: Certificate) -> str:
+        try:
+            return cert.extensions.get_extension_for_class(SubjectKeyIdentifier).value.digest.hex().upper()
+        except ExtensionNotFound:
+            return None
+
+    # authority key identifier of a cert or CRL as hex, or None
+    def get_aki(cert_or_crl) -> str:
+        try:
+            key_id = cert_or_crl.extensions.get_extension_for_class(
+                AuthorityKeyIdentifier).value.key_identifier
+            return key_id.hex().upper() if key_id else None
+        except ExtensionNotFound:
+            return None
+
+    def crl_get_issuer(crl: CertificateRevocationList) -> str:
+        return crl.issuer.rfc4514_string()
+
+    def crl_get_this_update(crl: CertificateRevocationList) -> datetime:
+        return crl.last_update
+
+    def crl_get_next_update(crl: CertificateRevocationList) -> datetime:
+        return crl.next_update
+
+    # Verify that a cert or CRL was signed by the key in issuer's cert.
+    # Raises InvalidSignature (or ValueError for an unsupported algorithm) if
+    # not.
+    def verify_signed_by(cert_or_crl, issuer: Certificate):
+        if isinstance(cert_or_crl, CertificateRevocationList):
+            tbs = cert_or_crl.tbs_certlist_bytes
+        else:
+            tbs = cert_or_crl.tbs_certificate_bytes
+        signature = cert_or_crl.signature
+        hash_algorithm = cert_or_crl.signature_hash_algorithm
+        # newer cryptography versions know the padding (e.g. RSA-PSS)
+        params = getattr(cert_or_crl, "signature_algorithm_parameters", None)
+        public_key = issuer.public_key()
+        if isinstance(public_key, rsa.RSAPublicKey):
+            if not isinstance(params, (padding.PSS, padding.PKCS1v15)):
+                params = padding.PKCS1v15()
+            public_key.verify(signature, tbs, params, hash_algorithm)
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(signature, tbs, ec.ECDSA(hash_algorithm))
+        elif isinstance(public_key, dsa.DSAPublicKey):
+            public_key.verify(signature, tbs, hash_algorithm)
+        elif isinstance(public_key, (ed25519.Ed25519PublicKey, ed448.Ed448PublicKey)):
+            public_key.verify(signature, tbs)
+        else:
+            raise ValueError(
+                f"Unsupported issuer key type {type(public_key).__name__}")
+
+    def cert_get_fingerprint(cert: Certificate) -> str:
+        return cert.fingerprint(hashes.SHA256()).hex().upper()
+
+    # the human readable info block written above each cert in a bundle
+    def convert_cert_info(cert: Certificate) -> str:
+        info_return = None
+        if cert:
+            info_return = "################################################################\n"
+            info_return += f"Subject: {X509Utils.cert_get_subject(cert)}\n"
+            info_return += f"Issuer:  {X509Utils.cert_get_issuer(cert)}\n"
+            info_return += f"Valid From: {X509Utils.cert_get_valid_from(cert)} GMT\n"
+            info_return += f"Valid To:   {X509Utils.cert_get_valid_to(cert)} GMT\n"
+        return info_return
+
     def convert_cert_pem(cert: Certificate, include_info: bool = True) -> str:
         pem_return = None
         if cert:
+            pem_return = ""
             if include_info:
-                pem_return = "################################################################\n"
-                pem_return += f"Subject: {X509Utils.cert_get_subject(cert)}\n"
-                pem_return += f"Issuer:  {X509Utils.cert_get_issuer(cert)}\n"
-                pem_return += f"Valid From: {X509Utils.cert_get_valid_from(cert)} GMT\n"
-                pem_return += f"Valid To:   {X509Utils.cert_get_valid_to(cert)} GMT\n"
+                pem_return = X509Utils.convert_cert_info(cert)
             pem_return += cert.public_bytes(
                 encoding=serialization.Encoding.PEM).decode("ascii")
         return pem_return
@@ -109,15 +185,212 @@ class X509Utils:
 
     def write_cert_pem(cert: Certificate, fn: str, include_info: bool = True):
         if cert and fn:
-            with open(fn, "w") as file:
+            with FileUtils.open_atomic(fn, "w") as file:
                 file.write(X509Utils.convert_cert_pem(
                     cert, include_info=include_info))
 
     def write_cert_der(cert: Certificate, fn: str, include_info: bool = True):
         if cert and fn:
-            with open(fn, "wb") as file:
+            with FileUtils.open_atomic(fn, "wb") as file:
                 file.write(X509Utils.convert_cert_der(cert))
 
+    # DER string types that OpenSSL lower cases and re-encodes as UTF8String
+    # when computing name hashes, mapped to their python codec.
+    DER_CANON_STRING_TYPES = {0x0C: "utf-8",       # UTF8String
+                              0x13: "latin-1",     # PrintableString
+                              0x14: "latin-1",     # T61String
+                              0x16: "latin-1",     # IA5String
+                              0x1A: "latin-1",     # VisibleString
+                              0x1C: "utf-32-be",   # UniversalString
+                              0x1E: "utf-16-be"}   # BMPString
+
+    # Read the tag and length of the DER element starting at offset.  Returns
+    # (tag, offset of the contents, length of the contents).
+    def der_read_header(data: bytes, offset: int = 0) -> tuple:
+        if offset + 2 > len(data):
+            raise ValueError("Truncated DER data")
+        tag = data[offset]
+        if tag & 0x1F == 0x1F:
+            raise ValueError("Unsupported DER tag")
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            num_bytes = length & 0x7F
+            if num_bytes == 0 or num_bytes > 4 or offset + num_bytes > len(data):
+                raise ValueError("Invalid DER length")
+            length = int.from_bytes(data[offset:offset + num_bytes], "big")
+            offset += num_bytes
+        return (tag, offset, length)
+
+    def der_encode(tag: int, content: bytes) -> bytes:
+        length = len(content)
+        if length < 0x80:
+            header = bytes([tag, length])
+        else:
+            len_bytes = length.to_bytes((length.bit_length() + 7) // 8, "big")
+            header = bytes([tag, 0x80 | len(len_bytes)]) + len_bytes
+        return header + content
+
+    # OpenSSL's canonical form of a name string: strip, collapse whitespace
+    # and lower case ASCII characters
+    def __canon_name_string(value: bytes) -> bytes:
+        whitespace = b" \t\n\v\f\r"
+        value = value.strip(whitespace)
+        canon_return = bytearray()
+        for c in value:
+            if c in whitespace:
+                if canon_return[-1:] != b" ":
+                    canon_return.append(0x20)
+            elif 0x41 <= c <= 0x5A:
+                canon_return.append(c + 0x20)
+            else:
+                canon_return.append(c)
+        return bytes(canon_return)
+
+    # Compute the OpenSSL subject/issuer name hash (as in "openssl x509
+    # -subject_hash") of a DER encoded Name.  This is the SHA-1 of the
+    # canonical encoding of the name's RDNs.
+    def name_hash(name_der: bytes) -> str:
+        tag, pos, length = X509Utils.der_read_header(name_der)
+        if tag != 0x30:
+            raise ValueError("DER Name is not a SEQUENCE")
+        end = pos + length
+        canon = b""
+        while pos < end:
+            tag, set_pos, set_len = X509Utils.der_read_header(name_der, pos)
+            set_end = set_pos + set_len
+            atvs = []
+            atv_start = set_pos
+            while atv_start < set_end:
+                tag, oid_start, atv_len = X509Utils.der_read_header(
+                    name_der, atv_start)
+                tag, oid_pos, oid_len = X509Utils.der_read_header(
+                    name_der, oid_start)
+                val_start = oid_pos + oid_len
+                val_tag, val_pos, val_len = X509Utils.der_read_header(
+                    name_der, val_start)
+                value = name_der[val_start:val_pos + val_len]
+                codec = X509Utils.DER_CANON_STRING_TYPES.get(val_tag)
+                if codec:
+                    text = name_der[val_pos:val_pos + val_len].decode(codec)
+                    value = X509Utils.der_encode(
+                        0x0C, X509Utils.__canon_name_string(text.encode("utf-8")))
+                atvs.append(X509Utils.der_encode(
+                    0x30, name_der[oid_start:val_start] + value))
+                atv_start = oid_start + atv_len
+            # DER orders the members of a SET OF by their encoding
+            canon += X509Utils.der_encode(0x31, b"".join(sorted(atvs)))
+            pos = set_end
+        digest = hashlib.sha1(canon).digest()
+        return "%08x" % int.from_bytes(digest[:4], "little")
+
+    def cert_get_subject_hash(cert: Certificate) -> str:
+        return X509Utils.name_hash(cert.subject.public_bytes(default_backend()))
+
+    # Get the DER encoded issuer Name of a DER CRL without parsing the whole
+    # CRL (which can be many megabytes).
+    def der_crl_get_issuer(data: bytes) -> bytes:
+        tag, pos, length = X509Utils.der_read_header(data)  # CertificateList
+        tag, pos, length = X509Utils.der_read_header(data, pos)  # tbsCertList
+        tag, content, length = X509Utils.der_read_header(data, pos)
+        if tag == 0x02:  # optional version
+            pos = content + length
+            tag, content, length = X509Utils.der_read_header(data, pos)
+        pos = content + length  # skip signature AlgorithmIdentifier
+        tag, content, length = X509Utils.der_read_header(data, pos)
+        if tag != 0x30:
+            raise ValueError("CRL issuer is not a DER Name")
+        return data[pos:content + length]
+
+    def read_crl_issuer_hash(fn: str, max_header: int = 64 * 1024) -> str:
+        with open(fn, "rb") as file:
+            data = file.read(max_header)
+        return X509Utils.name_hash(X509Utils.der_crl_get_issuer(data))
+
+    # decode a DER UTCTime (tag 0x17) or GeneralizedTime (tag 0x18)
+    def der_decode_time(tag: int, content: bytes) -> datetime.datetime:
+        text = content.decode("ascii").rstrip("Z")
+        if tag == 0x17:
+            # RFC 5280: two digit years 50-99 are 19xx
+            year = int(text[:2])
+            text = str(1900 + year if year >= 50 else 2000 + year) + text[2:]
+        elif tag != 0x18:
+            raise ValueError("Not a DER time")
+        return datetime.datetime.strptime(text[:14], "%Y%m%d%H%M%S")
+
+    # Get the thisUpdate and nextUpdate times (nextUpdate can be None) of a
+    # DER CRL without parsing the whole CRL, like der_crl_get_issuer().
+    def der_crl_get_update_times(data: bytes) -> tuple:
+        tag, pos, length = X509Utils.der_read_header(data)  # CertificateList
+        tag, pos, length = X509Utils.der_read_header(data, pos)  # tbsCertList
+        tag, content, length = X509Utils.der_read_header(data, pos)
+        if tag == 0x02:  # optional version
+            pos = content + length
+            tag, content, length = X509Utils.der_read_header(data, pos)
+        pos = content + length  # skip signature AlgorithmIdentifier
+        tag, content, length = X509Utils.der_read_header(data, pos)
+        pos = content + length  # skip issuer
+        tag, content, length = X509Utils.der_read_header(data, pos)
+        this_update = X509Utils.der_decode_time(
+            tag, data[content:content + length])
+        next_update = None
+        pos = content + length
+        if pos < len(data):
+            tag, content, length = X509Utils.der_read_header(data, pos)
+            if tag in (0x17, 0x18):
+                next_update = X509Utils.der_decode_time(
+                    tag, data[content:content + length])
+        return (this_update, next_update)
+
+    def read_crl_update_times(fn: str, max_header: int = 64 * 1024) -> tuple:
+        with open(fn, "rb") as file:
+            data = file.read(max_header)
+        return X509Utils.der_crl_get_update_times(data)
+
+    # bytes of DER read at a time when streaming to PEM.  A multiple of 48 so
+    # each chunk base64 encodes to whole 64 character PEM lines.
+    PEM_STREAM_CHUNK_SIZE = 48 * 1024
+
+    # Cheap structural check that data (or, if total_size is given, the start
+    # of data) is a single DER SEQUENCE, as certs and CRLs are, whose length
+    # accounts for exactly total_size bytes.  Raises ValueError if not.
+    def der_check_sequence(data: bytes, total_size: int = None):
+        if total_size is None:
+            total_size = len(data)
+        tag, content, length = X509Utils.der_read_header(data)
+        if tag != 0x30:
+            raise ValueError("Data is not a DER SEQUENCE")
+        if content + length != total_size:
+            raise ValueError(
+                f"DER SEQUENCE length {content + length} does not match data length {total_size}")
+
+    # Stream DER from a binary file object to PEM in a binary file object
+    # without parsing it.  Only the outer SEQUENCE is checked (see
+    # der_check_sequence()) before anything is written, so a bundle is written
+    # at the speed of the disk rather than of an ASN.1 parser.
+    def write_der_pem_stream(file_in, file_out, label: str = "CERTIFICATE", check: bool = True):
+        chunk = file_in.read(X509Utils.PEM_STREAM_CHUNK_SIZE)
+        if check:
+            X509Utils.der_check_sequence(
+                chunk, os.fstat(file_in.fileno()).st_size)
+        file_out.write(f"-----BEGIN {label}-----\n".encode("ascii"))
+        while chunk:
+            b64 = base64.b64encode(chunk)
+            file_out.write(b"\n".join(b64[i:i + 64]
+                                      for i in range(0, len(b64), 64)))
+            file_out.write(b"\n")
+            chunk = file_in.read(X509Utils.PEM_STREAM_CHUNK_SIZE)
+        file_out.write(f"-----END {label}-----\n".encode("ascii"))
+
+    # Wrap DER bytes as PEM with the given label, e.g. "X509 CRL", without
+    # parsing them (see write_der_pem_stream())
+    def convert_der_pem(der: bytes, label: str = "CERTIFICATE", check: bool = True) -> str:
+        if check:
+            X509Utils.der_check_sequence(der)
+        b64 = base64.b64encode(der).decode("ascii")
+        lines = [b64[i:i + 64] for i in range(0, len(b64), 64)]
+        return f"-----BEGIN {label}-----\n" + "\n".join(lines) + f"\n-----END {label}-----\n"
+
     def rename_filename(fn_from: str, fn_to: str = None, new_ext: str = None) -> str:
         fn_return: str = None
         if fn_from:
@@ -19,9 +19,15 @@
 # this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from pathlib import Path
+from pkiccu.file_utils import FileUtils
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import subprocess
+import tempfile
+import hashlib
+import shutil
 import sys
+import os
 import json
 
 
@@ -100,6 +106,18 @@ class RunDBsignCrlUpdater:
                             action="store_true",
                             help="Parse certs/CRLs")
 
+        parser.add_argument("--state_file",
+                            required=False,
+                            help="File that remembers what was imported into each instance.  When given, only the certs/CRLs that changed since the last successful import are imported")
+
+        parser.add_argument("--parallel_instances",
+                            action="store_true",
+                            help="Run the DBsign CRL Updater for each instance at the same time")
+
+        parser.add_argument("--single_launch",
+                            action="store_true",
+                            help="Import certs and CRLs into the same instances with one run of the DBsign CRL Updater (the updater must accept --certFile and --crlFile together)")
+
         _args = parser.parse_args()
 
         if _args:
@@ -107,7 +125,10 @@ class RunDBsignCrlUpdater:
 
         return args_return
 
-    def run_crl_updater(self, java: str, java_opts: str, jar: str, config: str, args: list) -> int:
+    # Run the DBsign CRL Updater.  When prefix is given the output is
+    # prefixed with it a line at a time so that the output of updaters running
+    # at the same time can be told apart.
+    def run_crl_updater(self, java: str, java_opts: str, jar: str, config: str, args: list, prefix: str = None) -> int:
         exit_status_return: int = 0
         try:
             java_opts_list = []
@@ -118,68 +139,248 @@ class RunDBsignCrlUpdater:
             cmd_line = [java, *java_opts_list, "-jar",
                         jar, f"--configFile={config}", *args]
             print(
-                f">>> Running DBsign CRL Updater, command line: {' '.join(cmd_line)}")
-            completed = subprocess.run(args=cmd_line,
-                                       stdout=sys.stdout,
-                                       stderr=sys.stderr,
-                                       universal_newlines=True)
-            exit_status_return = completed.returncode
+                f">>> {prefix + ' ' if prefix else ''}Running DBsign CRL Updater, command line: {' '.join(cmd_line)}", flush=True)
+            if prefix:
+                with subprocess.Popen(args=cmd_line,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      universal_newlines=True,
+                                      errors="replace") as process:
+                    for line in process.stdout:
+                        print(f"{prefix} {line.rstrip()}", flush=True)
+                exit_status_return = process.returncode
+            else:
+                completed = subprocess.run(args=cmd_line,
+                                           stdout=sys.stdout,
+                                           stderr=sys.stderr,
+                                           universal_newlines=True)
+                exit_status_return = completed.returncode
         except BaseException as e:
             print(f"Error running DBsign CRL Updater: {str(e)}")
             exit_status_return = 1
         return exit_status_return
 
-    def import_certs(self) -> int:
-        exit_status_return: int = 0
+    # updater arguments to import the certs or CRLs (kind) in path
+    def get_import_args(self, kind: str, path: str, recurse: bool) -> list:
         args: list = []
-        args.append(f"--instances={self.args.get('cert_instances')}")
-        args.append(f"--delim={self.args.get('cert_delim')}")
-        args.append(f"--certFile={self.args.get('cert_dir')}")
-        args.append(f"--fileExt={self.args.get('cert_ext')}")
-        if (self.args.get('cert_dir_recurse') == True):
+        if kind == "cert":
+            args.append(f"--certFile={path}")
+            args.append(f"--fileExt={self.args.get('cert_ext')}")
+        else:
+            args.append(f"--crlFile={path}")
+            args.append(f"--fileExt={self.args.get('crl_ext')}")
+        if recurse:
             args.append("--recurse")
-        if (self.args.get('parse') == True):
-            args.append("--parse")
-        print("###")
-        print("### IMPORTING CERTS...")
-        print("###")
-        exit_status_return = self.run_crl_updater(java=self.args.get("java"),
-                                                  java_opts=self.args.get(
-                                                      "java_opts"),
-                                                  jar=self.args.get("jar"),
-                                                  config=self.args.get(
-                                                      "config"),
-                                                  args=args)
-        return exit_status_return
+        return args
+
+    def import_certs(self) -> int:
+        return self.run_import(self.args.get("cert_instances"), self.args.get("cert_delim"),
+                               {"cert": (self.args.get("cert_dir"), self.args.get("cert_dir_recurse") == True)})
 
     def import_crls(self) -> int:
-        exit_status_return: int = 0
+        return self.run_import(self.args.get("crl_instances"), self.args.get("crl_delim"),
+                               {"crl": (self.args.get("crl_dir"), self.args.get("crl_dir_recurse") == True)})
+
+    # Run the updater once to import the certs and/or CRLs in sources
+    # ({kind: (path, recurse)}) into the delimited list of instances.
+    def run_import(self, instances: str, delim: str, sources: dict, prefix: str = None) -> int:
         args: list = []
-        args.append(f"--instances={self.args.get('cert_instances')}")
-        args.append(f"--delim={self.args.get('crl_delim')}")
-        args.append(f"--crlFile={self.args.get('crl_dir')}")
-        args.append(f"--fileExt={self.args.get('crl_ext')}")
-        args.append(f"--recurse={str(self.args.get('crl_dir_recurse'))}")
-        if (self.args.get('crl_dir_recurse') == True):
-            args.append("--recurse")
+        args.append(f"--instances={instances}")
+        args.append(f"--delim={delim}")
+        for kind, (path, recurse) in sources.items():
+            args += [arg for arg in self.get_import_args(kind, path, recurse)
+                     if arg not in args]
+        if len(sources) > 1 and self.args.get("cert_ext") != self.args.get("crl_ext"):
+            # one launch can only have one file extension, the staged
+            # directories only have certs or CRLs in them so drop it
+            args = [arg for arg in args if not arg.startswith("--fileExt=")]
+            print(f"Not passing --fileExt, certs (.{self.args.get('cert_ext')}) and CRLs "
+                  f"(.{self.args.get('crl_ext')}) are imported in one launch")
         if (self.args.get('parse') == True):
             args.append("--parse")
         print("###")
-        print("### IMPORTING CRLs...")
-        print("###")
-        exit_status_return = self.run_crl_updater(java=self.args.get("java"),
-                                                  java_opts=self.args.get(
-                                                  "java_opts"),
-                                                  jar=self.args.get("jar"),
-                                                  config=self.args.get(
-                                                      "config"),
-                                                  args=args)
+        print(
+            f"### IMPORTING {' AND '.join('CERTS' if kind == 'cert' else 'CRLs' for kind in sources)}{' (' + instances + ')' if prefix else ''}...")
+        print("###", flush=True)
+        return self.run_crl_updater(java=self.args.get("java"),
+                                    java_opts=self.args.get("java_opts"),
+                                    jar=self.args.get("jar"),
+                                    config=self.args.get("config"),
+                                    args=args,
+                                    prefix=prefix)
+
+    def find_files(self, dir: str, ext: str, recurse: bool) -> list:
+        list_return = []
+        path_dir = Path(dir)
+        if path_dir.is_dir():
+            pattern = f"*.{ext}"
+            paths = path_dir.rglob(pattern) if recurse else path_dir.glob(
+                pattern)
+            list_return = sorted(str(path.resolve())
+                                 for path in paths if path.is_file())
+        elif path_dir.is_file():
+            list_return = [str(path_dir.resolve())]
+        return list_return
+
+    def load_state(self) -> dict:
+        state_return = {"files": {}, "imported": {}}
+        fn = self.args.get("state_file")
+        if fn and Path(fn).exists():
+            try:
+                with open(fn, "r") as file:
+                    state_return = {**state_return, **json.load(file)}
+            except (OSError, ValueError) as e:
+                print(
+                    f"Ignoring unreadable state file '{fn}', importing everything: {str(e)}")
+        return state_return
+
+    def save_state(self, state: dict):
+        fn = self.args.get("state_file")
+        if fn:
+            Path(fn).parent.mkdir(parents=True, exist_ok=True)
+            with FileUtils.open_atomic(fn, "w") as file:
+                json.dump(state, file, indent=1, sort_keys=True)
+
+    # SHA-256 of a file, only read again if its size or mtime changed since
+    # it was recorded in the state file
+    def get_digest(self, state: dict, fn: str) -> str:
+        stat = os.stat(fn)
+        entry = state.get("files").get(fn)
+        if not entry or entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            digest = hashlib.sha256()
+            with open(fn, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+            entry = {"size": stat.st_size,
+                     "mtime_ns": stat.st_mtime_ns,
+                     "sha256": digest.hexdigest()}
+            state.get("files")[fn] = entry
+        return entry.get("sha256")
+
+    # Where to make the staging directory: next to the state file, or else
+    # next to the first source dir, so it's on the same file system as the
+    # files and they can be hard linked instead of copied.  Not inside a
+    # source dir, which may be imported or published.
+    def get_stage_parent(self, dirs: list) -> str:
+        str_return = None
+        candidates = [self.args.get("state_file")] + list(dirs)
+        for fn in candidates:
+            if fn:
+                path_parent = Path(fn).resolve().parent
+                if path_parent.is_dir() and os.access(str(path_parent), os.W_OK):
+                    str_return = str(path_parent)
+                    break
+        return str_return
+
+    # Link (or copy) files into a new temp directory so the updater only sees
+    # them.  Files keep their path relative to the source dir so names from
+    # different sub directories can't collide.
+    def stage_files(self, dn_stage: str, dir: str, fn_list: list) -> str:
+        path_dir = Path(dir).resolve()
+        path_stage = Path(tempfile.mkdtemp(dir=dn_stage))
+        for fn in fn_list:
+            path = Path(fn)
+            try:
+                path_rel = path.relative_to(path_dir)
+            except ValueError:
+                path_rel = Path(path.name)
+            path_dst = path_stage / path_rel
+            path_dst.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(fn, str(path_dst))
+            except OSError:
+                shutil.copy2(fn, str(path_dst))
+        return str(path_stage)
+
+    # Import only what changed since the last successful import into each
+    # instance, as recorded in the state file.
+    def run_delta(self) -> int:
+        exit_status_return: int = 0
+        state = self.load_state()
+        kinds = {}
+        if self.args.get("cert_dir"):
+            kinds["cert"] = (self.args.get("cert_dir"), self.args.get("cert_ext"), self.args.get("cert_dir_recurse") == True,
+                             self.args.get("cert_instances"), self.args.get("cert_delim"))
+        if self.args.get("crl_dir"):
+            kinds["crl"] = (self.args.get("crl_dir"), self.args.get("crl_ext"), self.args.get("crl_dir_recurse") == True,
+                            self.args.get("crl_instances"), self.args.get("crl_delim"))
+        digests = {}
+        for kind, (dir, ext, recurse, instances, delim) in kinds.items():
+            digests[kind] = {fn: self.get_digest(state, fn)
+                             for fn in self.find_files(dir, ext, recurse)}
+        # [(instances, delim, [kinds])], one job per run of the updater
+        jobs = []
+        if self.args.get("parallel_instances"):
+            per_instance = {}
+            for kind, (dir, ext, recurse, instances, delim) in kinds.items():
+                for instance in instances.split(delim):
+                    per_instance.setdefault(instance, []).append(kind)
+            for instance, instance_kinds in per_instance.items():
+                if self.args.get("single_launch"):
+                    jobs.append((instance, ",", instance_kinds))
+                else:
+                    jobs += [(instance, ",", [kind])
+                             for kind in instance_kinds]
+        elif self.args.get("single_launch") and len(kinds) > 1 and \
+                kinds.get("cert")[3:] == kinds.get("crl")[3:]:
+            jobs.append((*kinds.get("cert")[3:], list(kinds.keys())))
+        else:
+            jobs += [(kinds.get(kind)[3], kinds.get(kind)[4], [kind])
+                     for kind in kinds]
+
+        dn_stage = tempfile.mkdtemp(prefix=".run_dbsign_crl_updater.",
+                                    dir=self.get_stage_parent([kind[0] for kind in kinds.values()]))
+        try:
+            launches = []
+            for instances, delim, job_kinds in jobs:
+                imported = [state.get("imported").setdefault(
+                    instance, {}) for instance in instances.split(delim)]
+                sources = {}
+                changed = {}
+                for kind in job_kinds:
+                    dir, ext, recurse = kinds.get(kind)[:3]
+                    changed[kind] = sorted(fn for fn, digest in digests.get(kind).items()
+                                           if any(entry.get(kind, {}).get(fn) != digest for entry in imported))
+                    print(
+                        f"{len(changed[kind])} of {len(digests.get(kind))} {kind.upper()}s changed since the last import into '{instances}'")
+                    if changed[kind]:
+                        sources[kind] = (self.stage_files(
+                            dn_stage, dir, changed[kind]), True)
+                if sources:
+                    launches.append((instances, delim, sources, changed))
+            prefix = len(launches) > 1 and self.args.get("parallel_instances")
+            with ThreadPoolExecutor(max_workers=max(1, len(launches) if prefix else 1)) as executor:
+                futures = [(executor.submit(self.run_import, instances, delim, sources, f"[{instances}]" if prefix else None), instances, delim, changed)
+                           for instances, delim, sources, changed in launches]
+                for future, instances, delim, changed in futures:
+                    exit_status = future.result()
+                    if exit_status == 0:
+                        for instance in instances.split(delim):
+                            entry = state.get("imported").get(instance)
+                            for kind, fn_list in changed.items():
+                                entry.setdefault(kind, {}).update(
+                                    {fn: digests.get(kind).get(fn) for fn in fn_list})
+                    elif exit_status_return == 0:
+                        exit_status_return = exit_status
+        finally:
+            shutil.rmtree(dn_stage, ignore_errors=True)
+        # forget files that are gone
+        for kind in kinds:
+            for entry in state.get("imported").values():
+                if kind in entry:
+                    entry[kind] = {fn: digest for fn, digest in entry.get(kind).items()
+                                   if fn in digests.get(kind)}
+        state["files"] = {fn: entry for fn, entry in state.get("files").items()
+                          if any(fn in kind_digests for kind_digests in digests.values())}
+        self.save_state(state)
         return exit_status_return
 
     def main(self):
         exit_status_return: int = 0
         self.args = self.parse_args()
         print(f"Arguments: {self.args}")
+        if self.args.get("state_file") or self.args.get("parallel_instances") or self.args.get("single_launch"):
+            return self.run_delta()
         exit_status_certs: int = 0
         exit_status_crls: int = 0
         if self.args.get('cert_dir'):
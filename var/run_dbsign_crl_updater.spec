@@ -4,7 +4,7 @@ block_cipher = None
 
 
 a = Analysis(['../src/scripts/run_dbsign_crl_updater.py'],
-             pathex=['.'],
+             pathex=['.', '../src'],
              binaries=[],
              datas=[],
              hiddenimports=[],